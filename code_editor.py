@@ -1,55 +1,3674 @@
-import tkinter as tk
-from tkinter import ttk, filedialog, messagebox, scrolledtext
+import time
+STARTUP_TIME = time.perf_counter()  # start of the module import, for --profile-startup
 import os
+import sys
+import glob
+import argparse
+import re
+import keyword
+import builtins
+import ast
 import json
-import openai
+import difflib
+import fnmatch
+import hashlib
+import zlib
+import math
+import random
+import heapq
+import array
+import csv
+import sqlite3
+import mmap
+import asyncio
+import importlib.util
 from pathlib import Path
+from collections import namedtuple, deque
 import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed, CancelledError
 import queue
 import datetime
 
+# Tkinter is only imported for the GUI (see import_tkinter) so the command line runs without a display
+tk = ttk = filedialog = messagebox = scrolledtext = None
+
+def import_tkinter():
+    # Import Tkinter into the module globals used by the GUI
+    global tk, ttk, filedialog, messagebox, scrolledtext
+    import tkinter as tk
+    from tkinter import ttk, filedialog, messagebox, scrolledtext
+
+# Milliseconds after the window appears before the OpenAI SDK is imported and the API client created
+# in the background, so the first request doesn't pay for them
+CLIENT_WARM_UP_DELAY_MS = 500
+
+# The OpenAI SDK is the slowest import by far, so it is imported when the API client is first
+# created (EditEngine.ensure_client) - in the editor that happens on a background thread after startup
+openai = httpx = None
+
+def import_openai():
+    # Import openai and httpx (installed with it) into the module globals used by the API client
+    global openai, httpx
+    if openai is None:
+        import httpx
+        import openai
+
+class StartupProfiler:
+    # Time spent in each startup phase, printed to stderr with --profile-startup.
+    # mark() ends the current phase on the UI thread; measure() times a phase that runs on its own,
+    # such as a background warm-up or a tab built on first use. Disabled profilers only keep time.
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.last = STARTUP_TIME
+    
+    def report(self, phase, seconds, note=""):
+        if self.enabled:
+            print(f"[startup] {phase:<32}{seconds * 1000:9.1f} ms{note}", file=sys.stderr)
+    
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.report(phase, now - self.last)
+        self.last = now
+    
+    def total(self, phase):
+        # Time from the start of the module import to now
+        self.report(phase, time.perf_counter() - STARTUP_TIME, " (total)")
+    
+    def measure(self, phase, function, *args):
+        start = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            self.report(phase, time.perf_counter() - start)
+
+# Interval for writing streamed text into widgets (roughly one frame)
+STREAM_FRAME_MS = 16
+
+class StreamBuffer:
+    # Thread-safe buffer for streamed text deltas.
+    # Worker threads append tokens as they arrive and the UI drains them once per frame,
+    # so a fast token stream results in one widget insert per frame instead of one per token.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.parts = []
+    
+    def append(self, text):
+        # Add a delta (called from worker threads)
+        with self.lock:
+            self.parts.append(text)
+    
+    def drain(self):
+        # Take everything buffered since the last drain as one string (called from the UI thread)
+        with self.lock:
+            parts, self.parts = self.parts, []
+        return "".join(parts)
+
+# Worker -> UI messages: shortest time between two dispatches (a burst of messages is handled
+# once per frame), and the polling interval used if the Tk loop can't be woken from other threads
+UI_DISPATCH_MIN_MS = STREAM_FRAME_MS
+UI_POLL_MS = 100
+
+# Progress messages where only the latest one in a batch matters
+UI_COALESCED_MESSAGES = frozenset(['edit_parallel_progress', 'edit_stream_progress'])
+
+def coalesce_messages(messages):
+    # Keep only the last of each UI_COALESCED_MESSAGES type in a batch; other messages keep their order
+    seen = set()
+    kept = []
+    for message in reversed(messages):
+        if message[0] in UI_COALESCED_MESSAGES:
+            if message[0] in seen:
+                continue
+            seen.add(message[0])
+        kept.append(message)
+    kept.reverse()
+    return kept
+
+class UIMessageChannel:
+    # Queue of (type, data) messages from worker threads to the UI that wakes the Tk event loop when
+    # something arrives, so results are handled at once and an idle app never wakes up to poll.
+    # Only the first message after a dispatch wakes the loop, and the handler gets everything queued
+    # since then as one batch. A dispatch less than UI_DISPATCH_MIN_MS after the previous one waits
+    # for the next frame, so fast producers are coalesced instead of flooding the loop.
+    # On Unix the wakeup is a byte written to a pipe watched by a Tk file handler; elsewhere it is a
+    # virtual event, which Tk passes to its own thread when Tcl is built with threads. Without either
+    # the channel falls back to polling.
+    def __init__(self, root, handler):
+        self.root = root
+        self.handler = handler
+        self.lock = threading.Lock()
+        self.messages = []
+        self.wake_pending = False
+        self.dispatch_scheduled = False
+        self.dispatching = False
+        self.last_dispatch = 0.0
+        self.pipe = None
+        if os.name == 'posix' and hasattr(root.tk, 'createfilehandler'):
+            self.mode = 'pipe'
+            self.pipe = os.pipe()
+            for fd in self.pipe:
+                os.set_blocking(fd, False)
+            root.tk.createfilehandler(self.pipe[0], tk.READABLE, self.on_pipe_readable)
+        elif root.tk.eval('expr {[info exists tcl_platform(threaded)] && $tcl_platform(threaded)}') == '1':
+            self.mode = 'event'
+            root.bind('<<UIMessages>>', lambda event: self.on_wake())
+        else:
+            self.mode = 'poll'
+            root.after(UI_POLL_MS, self.poll)
+    
+    def put(self, message):
+        # Queue a message for the UI (called from any thread)
+        with self.lock:
+            self.messages.append(message)
+        self.wake()
+    
+    def wake(self):
+        # Make sure the handler runs soon, even with no message queued (called from any thread)
+        with self.lock:
+            if self.wake_pending:
+                return
+            self.wake_pending = True
+        if self.mode == 'pipe':
+            try:
+                os.write(self.pipe[1], b'\0')
+            except OSError:
+                pass  # The pipe is already readable, or the app is shutting down
+        elif self.mode == 'event':
+            try:
+                self.root.event_generate('<<UIMessages>>', when='tail')
+            except (RuntimeError, tk.TclError):
+                pass  # The window has been closed
+    
+    def on_pipe_readable(self, fd, mask):
+        try:
+            while os.read(fd, 512):
+                pass
+        except BlockingIOError:
+            pass
+        self.on_wake()
+    
+    def on_wake(self):
+        # Dispatch now, or at the next frame if the last dispatch was very recent
+        if self.dispatch_scheduled:
+            return
+        wait_ms = int((self.last_dispatch - time.monotonic()) * 1000) + UI_DISPATCH_MIN_MS
+        if wait_ms > 0 or self.dispatching:
+            self.dispatch_scheduled = True
+            self.root.after(max(1, wait_ms), self.dispatch)
+        else:
+            self.dispatch()
+    
+    def poll(self):
+        if not self.dispatching:
+            self.dispatch()
+        self.root.after(UI_POLL_MS, self.poll)
+    
+    def dispatch(self):
+        # Pass everything queued to the handler in one batch
+        self.dispatch_scheduled = False
+        if self.dispatching:
+            # The handler is showing a dialog, which runs a nested event loop - try again after it returns
+            self.dispatch_scheduled = True
+            self.root.after(UI_POLL_MS, self.dispatch)
+            return
+        with self.lock:
+            messages, self.messages = self.messages, []
+            self.wake_pending = False
+        self.last_dispatch = time.monotonic()
+        self.dispatching = True
+        try:
+            self.handler(coalesce_messages(messages))
+        finally:
+            self.dispatching = False
+
+# Debug Console: lines kept by default (older lines are dropped) and longest message logged
+DEBUG_LOG_MAX_LINES = 5000
+DEBUG_LOG_MAX_MESSAGE_CHARS = 2000
+
+# Debug Console level -> text color
+DEBUG_LOG_LEVEL_COLORS = {
+    "INFO": "black",
+    "API": "blue",
+    "REQUEST": "green",
+    "RESPONSE": "purple",
+    "ERROR": "red",
+    "WARNING": "orange",
+    "SYSTEM": "gray"
+}
+
+def truncate_log_message(message, limit=DEBUG_LOG_MAX_MESSAGE_CHARS):
+    # Cut an oversized log message down to the limit, noting how much was left out
+    message = str(message)
+    if len(message) <= limit:
+        return message
+    return f"{message[:limit]} ... [{len(message) - limit:,} more chars]"
+
+def describe_api_params(api_params):
+    # API parameters for the debug log, with message contents replaced by their roles and sizes
+    # (the messages can hold whole files, which are far too large to log on every request)
+    described = {key: value for key, value in api_params.items() if key != 'messages'}
+    messages = api_params.get('messages', [])
+    sizes = ", ".join(f"{message['role']} {len(message['content']):,}" for message in messages)
+    described['messages'] = f"{len(messages)} messages ({sizes} chars)"
+    return described
+
+def format_debug_record(record):
+    # One Debug Console line for a queued (timestamp, level, message) record
+    timestamp, level, message = record
+    clock = datetime.datetime.fromtimestamp(timestamp).strftime("%H:%M:%S.%f")[:-3]
+    return f"[{clock}] {level}: {message}\n"
+
+class CodeFenceStripper:
+    # Incrementally removes a markdown code fence wrapper from AI output.
+    # Text is released as soon as it can no longer belong to the opening or closing fence,
+    # so streamed edits can be shown while the response is still being generated.
+    def __init__(self):
+        self.buffer = ""
+        self.started = False
+        self.fenced = False
+        self.pending = []  # lines held back because they may be the closing fence
+        self.emitted_lines = 0
+        self.parts = []
+
+    @property
+    def text(self):
+        # All code text released so far
+        return "".join(self.parts)
+
+    def feed(self, chunk):
+        # Add a chunk of raw model output and return the code text that is safe to display
+        self.buffer += chunk
+        if not self.started:
+            head = self.buffer.lstrip()
+            # Wait until we know whether the response opens with a fence
+            if not head or (len(head) < 3 and '```'.startswith(head)):
+                return ""
+            if head.startswith('```'):
+                newline = head.find('\n')
+                if newline == -1:
+                    return ""  # Still inside the opening fence line (e.g. ```python)
+                self.fenced = True
+                self.buffer = head[newline + 1:]
+            else:
+                self.buffer = head
+            self.started = True
+        return self._release(final=False)
+
+    def finish(self):
+        # Flush whatever is left once the response is complete
+        if not self.started:
+            head = self.buffer.lstrip()
+            self.started = True
+            if head.startswith('```'):
+                # A lone opening fence with nothing after it
+                self.fenced = True
+                newline = head.find('\n')
+                self.buffer = head[newline + 1:] if newline != -1 else ""
+            else:
+                self.buffer = head
+        return self._release(final=True)
+
+    def _release(self, final):
+        if not self.fenced:
+            # Hold back trailing whitespace, matching a final strip() of the response
+            released = self.buffer.rstrip()
+            self.buffer = "" if final else self.buffer[len(released):]
+            self.parts.append(released)
+            return released
+
+        lines = self.buffer.split('\n')
+        self.buffer = "" if final else lines.pop()
+        complete = []
+        for line in lines:
+            if line.strip() == '```':
+                # Possible closing fence - only released if more code follows it
+                complete.extend(self.pending)
+                self.pending = [line]
+            elif self.pending and not line.strip():
+                self.pending.append(line)
+            else:
+                complete.extend(self.pending)
+                self.pending = []
+                complete.append(line)
+        if final:
+            # Whatever is still pending is the closing fence and trailing blank lines
+            self.pending = []
+
+        # Newlines are emitted before each line so the last code line has no trailing newline
+        released = []
+        for line in complete:
+            released.append(("\n" if self.emitted_lines else "") + line)
+            self.emitted_lines += 1
+        released = "".join(released)
+        self.parts.append(released)
+        return released
+
+# Files larger than this use search/replace edits when the edit protocol is "auto"
+SEARCH_REPLACE_MIN_CHARS = 4000
+
+# Minimum similarity for fuzzy anchoring of a SEARCH section that has no exact match
+FUZZY_MATCH_THRESHOLD = 0.85
+
+SEARCH_REPLACE_BLOCK = re.compile(
+    r'^<{5,9} ?SEARCH[^\n]*\n(.*?)^={5,9}[ \t]*\n(.*?)^>{5,9} ?REPLACE[^\n]*$',
+    re.DOTALL | re.MULTILINE)
+
+# Chunked edits: files with at least this many lines are edited chunk by chunk when the edit
+# protocol is "auto"; larger Python classes are split into methods, heuristic chunks are merged
+# up to a minimum size, and at most this many chunks are sent for one prompt
+CHUNK_EDIT_MIN_LINES = 400
+CHUNK_MAX_LINES = 300
+CHUNK_MIN_LINES = 20
+CHUNK_EDIT_MAX_TARGETS = 4
+
+# A short leading chunk (imports) is always sent so the AI can add imports
+CHUNK_HEADER_MAX_LINES = 60
+
+# Prompts with these phrases are about the whole file, so they are never sent as chunks
+WHOLE_FILE_PROMPT_PATTERN = re.compile(
+    r"\b(?:everywhere|throughout|globally"
+    r"|(?:entire|whole) (?:file|module|code|program|script)"
+    r"|across the (?:file|module|code)"
+    r"|(?:all|every|each)(?: of)?(?: the)? (?:\w+ )?(?:functions?|methods?|class(?:es)?|lines?|occurrences?|usages?|uses"
+    r"|places?|instances?|calls?|variables?|names?|imports?|strings?|comments?|definitions?|docstrings?|code))\b")
+
+# Parallel edits: target size of each section sent to a worker
+PARALLEL_SECTION_LINES = 250
+
+# File types split on braces rather than indentation
+BRACE_FILE_EXTENSIONS = ('.js', '.ts', '.java', '.cpp', '.c', '.h', '.css', '.ino', '.json')
+
+CHUNK_EDIT_BLOCK = re.compile(
+    r'^<{5,9} ?SECTION (\d+)[^\n]*\n(.*?)^>{5,9} ?END[^\n]*$',
+    re.DOTALL | re.MULTILINE)
+
+class PatchApplyError(Exception):
+    # Raised when AI search/replace blocks cannot be applied to the current content
+    pass
+
+def parse_search_replace_blocks(response):
+    # Extract (search, replace) pairs from SEARCH/REPLACE blocks in an AI response
+    # Any text outside the blocks (explanations, code fences) is ignored
+    blocks = SEARCH_REPLACE_BLOCK.findall(response)
+    if not blocks:
+        raise PatchApplyError("No SEARCH/REPLACE blocks found in response")
+    return blocks
+
+def _find_exact_matches(content, search):
+    # Offsets where search appears in content starting at the beginning of a line
+    matches = []
+    index = content.find(search)
+    while index != -1:
+        if index == 0 or content[index - 1] == "\n":
+            matches.append(index)
+        index = content.find(search, index + 1)
+    return matches
+
+def _find_line_window(content_lines, search_lines, normalize):
+    # Find where search_lines appear in content_lines when both are compared after normalize()
+    count = len(search_lines)
+    target = [normalize(line) for line in search_lines]
+    keys = [normalize(line) for line in content_lines]
+    for i in range(len(keys) - count + 1):
+        if keys[i:i + count] == target:
+            return i
+    return -1
+
+def _find_fuzzy_window(content_lines, search_lines):
+    # Find the window of lines most similar to search_lines, if it is similar enough
+    count = len(search_lines)
+    target = "".join(line.strip() + "\n" for line in search_lines)
+    matcher = difflib.SequenceMatcher(None, autojunk=False)
+    matcher.set_seq2(target)
+    best_index, best_ratio = -1, FUZZY_MATCH_THRESHOLD
+    for i in range(len(content_lines) - count + 1):
+        matcher.set_seq1("".join(line.strip() + "\n" for line in content_lines[i:i + count]))
+        if matcher.real_quick_ratio() < best_ratio or matcher.quick_ratio() < best_ratio:
+            continue
+        ratio = matcher.ratio()
+        if ratio > best_ratio:
+            best_index, best_ratio = i, ratio
+    return best_index
+
+def _leading_whitespace(lines):
+    for line in lines:
+        if line.strip():
+            return line[:len(line) - len(line.lstrip())]
+    return ""
+
+def _reindent(lines, old_indent, new_indent):
+    # Shift replacement lines from the indentation the AI used to the indentation in the file
+    if old_indent == new_indent:
+        return lines
+    result = []
+    for line in lines:
+        if line.strip() and line.startswith(old_indent):
+            line = new_indent + line[len(old_indent):]
+        result.append(line)
+    return result
+
+def apply_search_replace_blocks(content, blocks):
+    # Apply (search, replace) blocks in order, anchoring each SEARCH section with
+    # progressively looser matching: exact text at a line start, then whitespace-insensitive lines, then
+    # fuzzy similarity. An exact section found in several places is rejected as ambiguous.
+    # Returns the new content and a count of how each block was anchored.
+    match_counts = {"exact": 0, "whitespace": 0, "fuzzy": 0}
+    for number, (search, replace) in enumerate(blocks, 1):
+        if not search.strip():
+            # Empty SEARCH section - append the new code at the end of the file
+            content = content.rstrip("\n") + "\n" + replace if content.strip() else replace
+            match_counts["exact"] += 1
+            continue
+        
+        # Exact match at the start of a line; a section found in several places is ambiguous
+        matches = _find_exact_matches(content, search)
+        if len(matches) > 1:
+            first_line = search.strip().splitlines()[0]
+            raise PatchApplyError(f"Block {number}: SEARCH section matches {len(matches)} places in the file "
+                                  f"(starting with {first_line[:60]!r}) - include more surrounding lines")
+        if matches:
+            index = matches[0]
+            content = content[:index] + replace + content[index + len(search):]
+            match_counts["exact"] += 1
+            continue
+        
+        content_lines = content.splitlines(keepends=True)
+        search_lines = search.splitlines(keepends=True)
+        replace_lines = replace.splitlines(keepends=True)
+        
+        # Line match ignoring trailing whitespace, then ignoring indentation
+        kind = "whitespace"
+        start = _find_line_window(content_lines, search_lines, str.rstrip)
+        if start == -1:
+            start = _find_line_window(content_lines, search_lines, str.strip)
+        if start == -1:
+            kind = "fuzzy"
+            start = _find_fuzzy_window(content_lines, search_lines)
+        if start == -1:
+            first_line = search.strip().splitlines()[0]
+            raise PatchApplyError(f"Block {number}: SEARCH section not found in file (starting with {first_line[:60]!r})")
+        
+        end = start + len(search_lines)
+        matched = content_lines[start:end]
+        replace_lines = _reindent(replace_lines, _leading_whitespace(search_lines), _leading_whitespace(matched))
+        
+        # Keep the line break that followed the matched section
+        if replace_lines and matched[-1].endswith("\n") and not replace_lines[-1].endswith("\n"):
+            replace_lines[-1] += "\n"
+        
+        content = "".join(content_lines[:start] + replace_lines + content_lines[end:])
+        match_counts[kind] += 1
+    
+    return content, match_counts
+
+# Per-user folder for data kept between sessions (history databases, caches)
+APP_DATA_DIR = os.path.join(os.path.expanduser("~"), ".ai_code_editor")
+
+# File types shown in the file tree
+CODE_FILE_EXTENSIONS = ('.py', '.js', '.ts', '.html', '.css', '.java', '.cpp', '.c', '.h', '.json', '.xml', '.md', '.txt', '.ino')
+
+# Directory and file name patterns hidden from the file tree by default
+DEFAULT_TREE_IGNORE_PATTERNS = ['.git', '__pycache__', 'node_modules', '.vscode', '.idea']
+
+# Number of file tree nodes inserted per UI tick
+TREE_INSERT_BATCH_SIZE = 200
+
+def _python_chunks(lines, body, first_line, last_line, class_name=None):
+    # Chunks for a list of statements: one per function or class, runs of other statements grouped
+    starts = []
+    for node in body:
+        is_definition = isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef))
+        if not is_definition and starts and starts[-1][1] is None:
+            continue  # Part of the current run of plain statements
+        start = min([node.lineno] + [decorator.lineno for decorator in getattr(node, 'decorator_list', [])])
+        starts.append((start, node if is_definition else None))
+    if not starts or starts[0][0] > first_line:
+        starts.insert(0, (first_line, None))
+    
+    # Keep comments written just above a definition with it
+    adjusted = []
+    for index, (start, node) in enumerate(starts):
+        floor = adjusted[-1][0] + 1 if adjusted else first_line
+        while node is not None and start - 1 > floor and lines[start - 2].strip().startswith('#'):
+            start -= 1
+        adjusted.append((max(start, first_line), node))
+    
+    chunks = []
+    for index, (start, node) in enumerate(adjusted):
+        end = adjusted[index + 1][0] - 1 if index + 1 < len(adjusted) else last_line
+        if start > end:
+            continue
+        if node is None:
+            name = f"(statements) {lines[start - 1].strip()}"
+        else:
+            name = lines[node.lineno - 1].strip()
+        if class_name:
+            name += f"  (in class {class_name})"
+        # Split large classes into their methods
+        if isinstance(node, ast.ClassDef) and not class_name and end - start + 1 > CHUNK_MAX_LINES and len(node.body) > 1:
+            class_chunks = _python_chunks(lines, node.body, start, end, node.name)
+            first_start, first_end, first_name = class_chunks[0]
+            class_chunks[0] = (first_start, first_end, name)
+            chunks.extend(class_chunks)
+        else:
+            chunks.append((start, end, name))
+    return chunks
+
+def _heuristic_chunks(lines, braces):
+    # Chunks start at unindented lines at brace depth 0 that follow a blank line or a closed block
+    starts = [1]
+    depth = 0
+    boundary_allowed = True
+    for number, line in enumerate(lines, 1):
+        stripped = line.strip()
+        if (number > 1 and depth == 0 and stripped and boundary_allowed and not line[0].isspace()
+                and not stripped.startswith(('}', ')', ']'))):
+            starts.append(number)
+        if braces:
+            depth = max(0, depth + line.count('{') - line.count('}'))
+        boundary_allowed = not stripped or (braces and depth == 0 and stripped.endswith(('}', '};', ';')))
+    
+    # Merge small chunks into the one before them
+    merged = []
+    for start in starts:
+        if merged and start - merged[-1] < CHUNK_MIN_LINES:
+            continue
+        merged.append(start)
+    chunks = []
+    for index, start in enumerate(merged):
+        end = merged[index + 1] - 1 if index + 1 < len(merged) else len(lines)
+        name = next((l.strip() for l in lines[start - 1:end] if l.strip()), "(blank)")
+        chunks.append((start, end, name[:100]))
+    return chunks
+
+def split_code_chunks(content, file_path):
+    # Split a file into consecutive chunks covering every line: [(start_line, end_line, name)]
+    # Python files are split on top-level definitions (and methods of large classes) with ast;
+    # other files, and Python that doesn't parse, use a brace or indentation heuristic
+    lines = content.splitlines()
+    if not lines:
+        return []
+    if file_path.lower().endswith('.py'):
+        try:
+            tree = ast.parse(content)
+        except (SyntaxError, ValueError):
+            pass
+        else:
+            return _python_chunks(lines, tree.body, 1, len(lines))
+    return _heuristic_chunks(lines, file_path.lower().endswith(BRACE_FILE_EXTENSIONS))
+
+def is_whole_file_prompt(prompt):
+    # Whether a prompt asks for a change across the whole file ("add type hints everywhere",
+    # "document all public functions") - a bare quantifier ("fix all bugs in foo()") isn't enough
+    return bool(WHOLE_FILE_PROMPT_PATTERN.search(prompt.lower()))
+
+def select_target_chunks(content, chunks, prompt):
+    # Indexes of the chunks a prompt is about, ranked by TF-IDF overlap with the prompt
+    # Chunks whose own name (function, class) the prompt mentions get a large bonus
+    prompt_terms = set(index_terms(prompt))
+    if not prompt_terms or not chunks or is_whole_file_prompt(prompt):
+        return []
+    lines = content.splitlines()
+    chunk_terms = []
+    document_frequency = {}
+    for start, end, name in chunks:
+        counts = {}
+        for term in index_terms("\n".join(lines[start - 1:end])):
+            if term in prompt_terms:
+                counts[term] = counts.get(term, 0) + 1
+        chunk_terms.append(counts)
+        for term in counts:
+            document_frequency[term] = document_frequency.get(term, 0) + 1
+    
+    scores = []
+    for index, (start, end, name) in enumerate(chunks):
+        score = sum((1 + math.log(count)) * math.log(1 + len(chunks) / document_frequency[term])
+                    for term, count in chunk_terms[index].items())
+        defined = re.search(r'\b(?:def|class|function|fn|struct|interface)\s+([A-Za-z_]\w*)', name)
+        if defined and defined.group(1).lower() in prompt_terms:
+            score += 10 * math.log(1 + len(chunks))
+        scores.append((score, index))
+    best = max(scores)[0]
+    if best <= 0:
+        return []
+    ranked = sorted((item for item in scores if item[0] >= best * 0.5), reverse=True)
+    return sorted(index for score, index in ranked[:CHUNK_EDIT_MAX_TARGETS])
+
+def format_chunk_outline(chunks, marked=()):
+    return [f"[{index}]{'*' if index in marked else ' '} lines {start}-{end}: {name}"
+            for index, (start, end, name) in enumerate(chunks)]
+
+def build_chunk_edit_message(content, chunks, targets, prompt):
+    # Request for a chunked edit: an outline of the whole file and the full text of the target chunks
+    lines = content.splitlines()
+    outline = format_chunk_outline(chunks, targets)
+    sections = []
+    for index in targets:
+        start, end, name = chunks[index]
+        text = "\n".join(lines[start - 1:end])
+        sections.append(f"<<<<<<< SECTION {index} (lines {start}-{end})\n{text}\n>>>>>>> END")
+    return (f"File outline ({len(lines)} lines, sections shown in full are marked *):\n" + "\n".join(outline) +
+            "\n\nSections shown in full:\n\n" + "\n\n".join(sections) + f"\n\nUser request: {prompt}")
+
+def split_edit_sections(content, file_path, max_lines=PARALLEL_SECTION_LINES):
+    # Group consecutive chunks into sections of up to max_lines for parallel editing
+    # Returns (chunks, [(start_line, end_line)]); a single chunk longer than max_lines is its own section
+    chunks = split_code_chunks(content, file_path)
+    sections = []
+    for start, end, name in chunks:
+        if sections and end - sections[-1][0] + 1 <= max_lines:
+            sections[-1] = (sections[-1][0], end)
+        else:
+            sections.append((start, end))
+    return chunks, sections
+
+def build_section_edit_messages(content, file_path, prompt, max_lines=PARALLEL_SECTION_LINES):
+    # One request per section for a parallel edit: [(start_line, end_line, user message, section text)]
+    chunks, sections = split_edit_sections(content, file_path, max_lines)
+    lines = content.splitlines(keepends=True)
+    outline = "\n".join(format_chunk_outline(chunks))
+    requests = []
+    for number, (start, end) in enumerate(sections, 1):
+        text = "".join(lines[start - 1:end])
+        message = (f"File outline ({len(lines)} lines):\n{outline}\n\n"
+                   f"Section {number} of {len(sections)} (lines {start}-{end}):\n{text}\n"
+                   f"User request: {prompt}")
+        requests.append((start, end, message, text))
+    return requests
+
+def apply_chunk_edits(content, chunks, targets, response):
+    # Splice the sections returned by the AI back into the file by line range
+    # Returns (new content, number of sections replaced); raises PatchApplyError if nothing usable came back
+    replacements = {}
+    for match in CHUNK_EDIT_BLOCK.finditer(response):
+        index = int(match.group(1))
+        if index not in targets:
+            raise PatchApplyError(f"Section {index} was not one of the sections sent for editing")
+        replacements[index] = match.group(2)
+    if not replacements:
+        raise PatchApplyError("No SECTION blocks found in the response")
+    
+    lines = content.splitlines(keepends=True)
+    for index in sorted(replacements, reverse=True):
+        start, end, name = chunks[index]
+        text = replacements[index]
+        if end == len(lines) and not lines[-1].endswith('\n'):
+            text = text[:-1] if text.endswith('\n') else text  # Section at the end of a file without a final newline
+        lines[start - 1:end] = [text]
+    return "".join(lines), len(replacements)
+
+class GitIgnoreMatcher:
+    # Matches paths against the patterns of a project's root .gitignore.
+    # Supports the common subset of the format: globs, negation (!), directory-only
+    # patterns (trailing /) and patterns anchored to the root (leading or inner /).
+    def __init__(self, root_folder):
+        self.root_folder = root_folder
+        self.rules = []  # (pattern, negate, dir_only, anchored)
+        gitignore_path = os.path.join(root_folder, '.gitignore')
+        try:
+            with open(gitignore_path, 'r', encoding='utf-8', errors='replace') as f:
+                for line in f:
+                    self.add_rule(line)
+        except OSError:
+            pass
+    
+    def add_rule(self, line):
+        line = line.rstrip('\n').rstrip()
+        if not line or line.startswith('#'):
+            return
+        negate = line.startswith('!')
+        if negate:
+            line = line[1:]
+        dir_only = line.endswith('/')
+        line = line.rstrip('/')
+        anchored = '/' in line
+        line = line.lstrip('/')
+        if line:
+            self.rules.append((line, negate, dir_only, anchored))
+    
+    def is_ignored(self, path, is_dir):
+        # Check a path inside the root folder; the last matching rule wins
+        rel_path = os.path.relpath(path, self.root_folder).replace(os.sep, '/')
+        name = rel_path.rsplit('/', 1)[-1]
+        ignored = False
+        for pattern, negate, dir_only, anchored in self.rules:
+            if dir_only and not is_dir:
+                continue
+            target = rel_path if anchored else name
+            if fnmatch.fnmatchcase(target, pattern) or (anchored and fnmatch.fnmatchcase(rel_path, pattern + '/*')):
+                ignored = not negate
+        return ignored
+
+def scan_directory(path, ignore_patterns=(), gitignore=None):
+    # List one directory for the file tree using os.scandir dirent types (no extra stat calls)
+    # Returns sorted (name, path, is_dir, inode) tuples - folders first, then code files
+    folders, files = [], []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                name = entry.name
+                if any(fnmatch.fnmatch(name, pattern) for pattern in ignore_patterns):
+                    continue
+                try:
+                    is_dir = entry.is_dir()
+                    is_file = not is_dir and entry.is_file()
+                    inode = entry.inode()
+                except OSError:
+                    continue
+                if is_file and not name.lower().endswith(CODE_FILE_EXTENSIONS):
+                    continue
+                if not (is_dir or is_file):
+                    continue
+                if gitignore and gitignore.is_ignored(entry.path, is_dir):
+                    continue
+                (folders if is_dir else files).append((name, entry.path, is_dir, inode))
+    except (PermissionError, FileNotFoundError, NotADirectoryError):
+        pass
+    folders.sort(key=lambda item: item[0].lower())
+    files.sort(key=lambda item: item[0].lower())
+    return folders + files
+
+class DirectoryWatcher:
+    # Polls snapshots of the folders shown in the file tree and reports what changed.
+    # Each poll only stats the watched folders; a folder is re-listed when its mtime changes,
+    # and the new listing is diffed against the previous one to find added, removed and
+    # renamed (same inode, new name) entries. A single file (the open file) can also be
+    # watched for changes to its content.
+    def __init__(self, on_folder_changes, on_file_change):
+        self.on_folder_changes = on_folder_changes  # (generation, folder, added, removed, renamed)
+        self.on_file_change = on_file_change  # (path, stat or None if deleted)
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.folders = {}  # folder path -> (mtime_ns, {name: entry}, ignore_patterns, gitignore)
+        self.file_path = None
+        self.file_stat = None
+        self.interval = 0
+        self.thread = None
+    
+    def reset(self, generation):
+        # Forget all folders (the file tree was rebuilt)
+        with self.lock:
+            self.generation = generation
+            self.folders.clear()
+    
+    def watch_folder(self, generation, path, mtime, entries, ignore_patterns, gitignore):
+        # Start watching a folder whose listing is now shown in the tree; mtime is the folder's
+        # modification time from before it was listed, so anything changed since is found by the next poll
+        if mtime is None:
+            return
+        with self.lock:
+            if generation == self.generation:
+                self.folders[path] = (mtime, {entry[0]: entry for entry in entries}, ignore_patterns, gitignore)
+    
+    def unwatch_folder(self, path):
+        # Stop watching a folder and everything below it
+        prefix = path.rstrip(os.sep) + os.sep
+        with self.lock:
+            for folder in [f for f in self.folders if f == path or f.startswith(prefix)]:
+                del self.folders[folder]
+    
+    def watch_file(self, path):
+        # Watch one file for changes made outside the editor (None to stop)
+        with self.lock:
+            self.file_path = path
+            self.file_stat = self.get_file_stat(path) if path else None
+    
+    def get_file_stat(self, path):
+        try:
+            stat = os.stat(path)
+            return (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            return None
+    
+    def start(self, interval):
+        # Start (or retune) the polling thread; an interval of 0 pauses polling
+        self.interval = interval
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+    
+    def run(self):
+        while True:
+            time.sleep(self.interval if self.interval > 0 else 1.0)
+            if self.interval > 0:
+                self.poll()
+    
+    def poll(self):
+        # Check every watched folder and the watched file once
+        with self.lock:
+            generation = self.generation
+            folders = dict(self.folders)
+            file_path, file_stat = self.file_path, self.file_stat
+        
+        for path, (mtime, old_entries, ignore_patterns, gitignore) in folders.items():
+            try:
+                new_mtime = os.stat(path).st_mtime_ns
+            except OSError:
+                continue  # Folder removed - its parent reports the removal
+            if new_mtime == mtime:
+                continue
+            
+            new_entries = {entry[0]: entry for entry in scan_directory(path, ignore_patterns, gitignore)}
+            added = [entry for name, entry in new_entries.items() if name not in old_entries]
+            removed = [entry for name, entry in old_entries.items() if name not in new_entries]
+            
+            # An entry that disappeared and reappeared under a new name with the same inode was renamed
+            renamed = []
+            added_by_inode = {entry[3]: entry for entry in added if entry[3]}
+            for old_entry in list(removed):
+                new_entry = added_by_inode.get(old_entry[3])
+                if new_entry and new_entry[2] == old_entry[2]:
+                    renamed.append((old_entry, new_entry))
+                    removed.remove(old_entry)
+                    added.remove(new_entry)
+            
+            with self.lock:
+                if generation != self.generation or path not in self.folders:
+                    continue
+                self.folders[path] = (new_mtime, new_entries, ignore_patterns, gitignore)
+            if added or removed or renamed:
+                self.on_folder_changes(generation, path, added, removed, renamed)
+        
+        if file_path:
+            new_stat = self.get_file_stat(file_path)
+            if new_stat != file_stat:
+                with self.lock:
+                    if self.file_path != file_path:
+                        return
+                    self.file_stat = new_stat
+                self.on_file_change(file_path, new_stat)
+
+def walk_code_files(root, ignore_patterns=(), gitignore=None):
+    # Yield every code file below root that the file tree would show
+    folders = [root]
+    while folders:
+        for name, path, is_dir, inode in scan_directory(folders.pop(), ignore_patterns, gitignore):
+            if is_dir:
+                folders.append(path)
+            else:
+                yield path
+
+# Project index: snippet size in lines, overlap between neighbouring snippets, and skipped file sizes
+INDEX_SNIPPET_LINES = 40
+INDEX_SNIPPET_OVERLAP = 10
+INDEX_MAX_FILE_BYTES = 512 * 1024
+
+# Seconds between checks of the project folder for changed files
+INDEX_REFRESH_INTERVAL = 10.0
+
+INDEX_TERM_PATTERN = re.compile(r"[A-Za-z_][A-Za-z0-9_]*|\d+")
+INDEX_CAMEL_CASE_PATTERN = re.compile(r"[A-Z]+(?![a-z])|[A-Z]?[a-z]+|\d+")
+INDEX_STOP_WORDS = frozenset("""a an and are as at be by can do does for from how i if in is it me my of on or
+should the this that to use what when where which who why with you""".split())
+
+def index_terms(text):
+    # Lowercased identifiers plus their snake_case and camelCase parts
+    terms = []
+    for word in INDEX_TERM_PATTERN.findall(text):
+        lower = word.lower()
+        if len(lower) > 1 and lower not in INDEX_STOP_WORDS:
+            terms.append(lower)
+        parts = [part.lower() for piece in word.split('_') for part in INDEX_CAMEL_CASE_PATTERN.findall(piece)]
+        if len(parts) > 1:
+            terms.extend(part for part in parts if len(part) > 1 and part not in INDEX_STOP_WORDS)
+    return terms
+
+class ProjectIndex:
+    # Offline BM25 index over overlapping line-range snippets of the project's code files.
+    # Only term statistics and line ranges are kept in memory; snippet text is read back from
+    # disk when a search result is used. Files can be added, replaced and removed one at a time,
+    # so the index is kept up to date incrementally rather than rebuilt.
+    K1 = 1.5
+    B = 0.75
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.clear_locked()
+    
+    def clear_locked(self):
+        self.postings = {}  # term -> {snippet_id: term frequency}
+        self.snippets = {}  # snippet_id -> (file_path, start_line, end_line, length in terms, terms)
+        self.file_snippets = {}  # file_path -> [snippet_id]
+        self.total_length = 0
+        self.next_id = 0
+    
+    def reset(self):
+        # Empty the index; files indexed for an older generation are ignored
+        with self.lock:
+            self.generation += 1
+            self.clear_locked()
+            return self.generation
+    
+    def file_count(self):
+        return len(self.file_snippets)
+    
+    def snippet_count(self):
+        return len(self.snippets)
+    
+    def add_file(self, file_path, content, generation, root=None):
+        # Index (or re-index) one file, split into overlapping snippets
+        lines = content.splitlines()
+        path_terms = index_terms(os.path.relpath(file_path, root) if root else os.path.basename(file_path))
+        step = INDEX_SNIPPET_LINES - INDEX_SNIPPET_OVERLAP
+        snippets = []
+        for start in range(0, max(1, len(lines) - INDEX_SNIPPET_OVERLAP), step):
+            end = min(len(lines), start + INDEX_SNIPPET_LINES)
+            counts = {}
+            for term in index_terms("\n".join(lines[start:end])) + path_terms:
+                counts[term] = counts.get(term, 0) + 1
+            snippets.append((start + 1, end, counts))
+        
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.remove_file_locked(file_path)
+            ids = []
+            for start, end, counts in snippets:
+                snippet_id = self.next_id
+                self.next_id += 1
+                length = sum(counts.values())
+                self.snippets[snippet_id] = (file_path, start, end, length, tuple(counts))
+                self.total_length += length
+                for term, count in counts.items():
+                    self.postings.setdefault(term, {})[snippet_id] = count
+                ids.append(snippet_id)
+            self.file_snippets[file_path] = ids
+    
+    def remove_file(self, file_path):
+        with self.lock:
+            self.remove_file_locked(file_path)
+    
+    def remove_file_locked(self, file_path):
+        for snippet_id in self.file_snippets.pop(file_path, []):
+            snippet = self.snippets.pop(snippet_id)
+            self.total_length -= snippet[3]
+            for term in snippet[4]:
+                postings = self.postings[term]
+                del postings[snippet_id]
+                if not postings:
+                    del self.postings[term]
+    
+    def search(self, query, limit=8, per_file=2):
+        # Best snippets for a query as [(score, file_path, start_line, end_line)], at most per_file from each file
+        terms = set(index_terms(query))
+        with self.lock:
+            count = len(self.snippets)
+            if not count or not terms:
+                return []
+            average_length = self.total_length / count
+            scores = {}
+            for term in terms:
+                postings = self.postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+                for snippet_id, frequency in postings.items():
+                    length = self.snippets[snippet_id][3]
+                    norm = frequency * (self.K1 + 1) / (frequency + self.K1 * (1 - self.B + self.B * length / average_length))
+                    scores[snippet_id] = scores.get(snippet_id, 0.0) + idf * norm
+            ranked = [(score, self.snippets[snippet_id][:3]) for snippet_id, score in
+                      heapq.nlargest(limit * per_file * 2, scores.items(), key=lambda item: item[1])]
+        
+        results = []
+        taken = {}
+        for score, (file_path, start, end) in ranked:
+            if taken.get(file_path, 0) >= per_file:
+                continue
+            # Skip snippets overlapping one already chosen from the same file
+            if any(path == file_path and start <= other_end and end >= other_start
+                   for _, path, other_start, other_end in results):
+                continue
+            taken[file_path] = taken.get(file_path, 0) + 1
+            results.append((score, file_path, start, end))
+            if len(results) >= limit:
+                break
+        return results
+
+class ProjectIndexer:
+    # Keeps a ProjectIndex in sync with the project folder from a background thread.
+    # The first pass indexes every code file; later passes (every INDEX_REFRESH_INTERVAL seconds,
+    # or sooner when the editor saves a file) stat the files and re-index only the ones whose
+    # size or mtime changed, dropping files that were deleted.
+    def __init__(self, index, on_indexed):
+        self.index = index
+        self.on_indexed = on_indexed  # (root, indexed_count, removed_count, seconds, first_pass)
+        self.lock = threading.Lock()
+        self.root = None
+        self.ignore_patterns = ()
+        self.gitignore = None
+        self.generation = 0
+        self.file_stats = {}  # file_path -> (mtime_ns, size)
+        self.wakeup = threading.Event()
+        self.thread = None
+    
+    def set_root(self, root, ignore_patterns=(), gitignore=None):
+        # Index a new folder (or the same folder with new filters); None stops indexing
+        with self.lock:
+            self.root = root
+            self.ignore_patterns = tuple(ignore_patterns)
+            self.gitignore = gitignore
+            self.generation = self.index.reset()
+            self.file_stats = {}
+        if root and (self.thread is None or not self.thread.is_alive()):
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+        self.wakeup.set()
+    
+    def refresh(self):
+        # Check for changed files now instead of waiting for the next interval
+        self.wakeup.set()
+    
+    def run(self):
+        while True:
+            self.wakeup.wait(INDEX_REFRESH_INTERVAL)
+            self.wakeup.clear()
+            self.sync()
+    
+    def sync(self):
+        with self.lock:
+            root, ignore_patterns, gitignore = self.root, self.ignore_patterns, self.gitignore
+            generation, file_stats = self.generation, self.file_stats
+        if not root:
+            return
+        
+        start_time = time.time()
+        first_pass = not file_stats
+        seen = set()
+        indexed = 0
+        for file_path in walk_code_files(root, ignore_patterns, gitignore):
+            if generation != self.generation:
+                return  # Folder changed while indexing
+            seen.add(file_path)
+            try:
+                stat = os.stat(file_path)
+            except OSError:
+                continue
+            file_stat = (stat.st_mtime_ns, stat.st_size)
+            if file_stats.get(file_path) == file_stat:
+                continue
+            file_stats[file_path] = file_stat
+            if stat.st_size > INDEX_MAX_FILE_BYTES:
+                self.index.remove_file(file_path)
+                continue
+            try:
+                with open(file_path, 'r', encoding='utf-8', errors='replace') as f:
+                    content = f.read()
+            except OSError:
+                continue
+            self.index.add_file(file_path, content, generation, root)
+            indexed += 1
+        
+        removed = [file_path for file_path in file_stats if file_path not in seen]
+        for file_path in removed:
+            del file_stats[file_path]
+            self.index.remove_file(file_path)
+        if indexed or removed:
+            self.on_indexed(root, indexed, len(removed), time.time() - start_time, first_pass)
+
+# Files above the large-file threshold (Settings, in MB) are memory-mapped instead of read into the
+# editor, which shows a window of this many lines at a time
+LARGE_FILE_THRESHOLD_MB = 5
+LARGE_FILE_WINDOW_LINES = 1000
+
+def index_line_offsets(data):
+    # Byte offset where each line of data starts, followed by the length of the data
+    offsets = array.array('Q', [0])
+    find = data.find
+    position = find(b'\n')
+    while position != -1:
+        offsets.append(position + 1)
+        position = find(b'\n', position + 1)
+    if offsets[-1] != len(data):
+        offsets.append(len(data))  # last line without a newline
+    return offsets
+
+def split_lines_keepends(text):
+    # Lines of text with their '\n' (only '\n' ends a line, matching index_line_offsets)
+    parts = text.split('\n')
+    lines = [part + '\n' for part in parts[:-1]]
+    if parts[-1]:
+        lines.append(parts[-1])
+    return lines
+
+class LargeFileBuffer:
+    # A file too large to load into the editor widget, read through mmap.
+    # Opening it builds an index of line offsets (on a background thread), after which any range of
+    # lines is decoded straight from the mapping. Edits are kept as a line-level piece table - pieces
+    # are ('file', first, last) ranges of the mapped lines or ('text', lines) edited lines - so
+    # changing a few lines never copies the rest, and saving streams the pieces back to disk.
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.open_mapping()
+    
+    def open_mapping(self):
+        self.file = open(self.file_path, 'rb')
+        size = os.fstat(self.file.fileno()).st_size
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+        self.offsets = index_line_offsets(self.map)
+        self.pieces = [('file', 0, len(self.offsets) - 1)]
+        self.modified = False
+    
+    def close(self):
+        if isinstance(self.map, mmap.mmap):
+            self.map.close()
+        self.file.close()
+    
+    def size(self):
+        return self.offsets[-1]
+    
+    def piece_length(self, piece):
+        return piece[2] - piece[1] if piece[0] == 'file' else len(piece[1])
+    
+    def line_count(self):
+        return sum(self.piece_length(piece) for piece in self.pieces)
+    
+    def get_text(self, start, end):
+        # Text of lines [start, end), decoded only for that range
+        parts = []
+        position = 0
+        for piece in self.pieces:
+            length = self.piece_length(piece)
+            first, last = max(start, position), min(end, position + length)
+            if first < last:
+                if piece[0] == 'file':
+                    data = self.map[self.offsets[piece[1] + first - position]:self.offsets[piece[1] + last - position]]
+                    parts.append(data.decode('utf-8', errors='replace'))
+                else:
+                    parts.append("".join(piece[1][first - position:last - position]))
+            position += length
+            if position >= end:
+                break
+        return "".join(parts)
+    
+    def split_at(self, line):
+        # Index of the piece starting at line, splitting the piece that contains it if needed
+        position = 0
+        for index, piece in enumerate(self.pieces):
+            length = self.piece_length(piece)
+            if position == line:
+                return index
+            if position < line < position + length:
+                offset = line - position
+                if piece[0] == 'file':
+                    halves = [('file', piece[1], piece[1] + offset), ('file', piece[1] + offset, piece[2])]
+                else:
+                    halves = [('text', piece[1][:offset]), ('text', piece[1][offset:])]
+                self.pieces[index:index + 1] = halves
+                return index + 1
+            position += length
+        return len(self.pieces)
+    
+    def replace_lines(self, start, end, text):
+        # Replace lines [start, end) with text; returns the number of lines it became
+        lines = split_lines_keepends(text)
+        first = self.split_at(start)
+        last = self.split_at(end)
+        self.pieces[first:last] = [('text', lines)] if lines else []
+        self.modified = True
+        return len(lines)
+    
+    def save(self):
+        # Write the pieces to a temporary file next to the original, replace the original with it and
+        # map the new file. Unchanged ranges are written straight from the mapping
+        temp_path = self.file_path + '.saving'
+        with open(temp_path, 'wb') as out:
+            for piece in self.pieces:
+                if piece[0] == 'file':
+                    view = memoryview(self.map)[self.offsets[piece[1]]:self.offsets[piece[2]]]
+                    out.write(view)
+                    view.release()
+                else:
+                    out.write("".join(piece[1]).encode('utf-8'))
+        os.chmod(temp_path, os.stat(self.file_path).st_mode & 0o7777)
+        self.close()  # the mapping must be closed before the file can be replaced on Windows
+        os.replace(temp_path, self.file_path)
+        self.open_mapping()
+
+# Syntax highlighting: foreground color of each token tag
+SYNTAX_TAG_COLORS = {
+    'keyword': '#0033b3',
+    'builtin': '#7a3e9d',
+    'definition': '#00627a',
+    'decorator': '#9e880d',
+    'string': '#067d17',
+    'comment': '#8c8c8c',
+    'number': '#1750eb',
+    'tag': '#0033b3',
+    'attribute': '#871094'
+}
+
+# Lines tagged per frame, lines lexed past the bottom of the view, and the delay before a pass
+# after an edit or scroll (one frame, so a burst of keystrokes causes one pass)
+SYNTAX_BATCH_LINES = 300
+SYNTAX_LOOKAHEAD_LINES = 50
+SYNTAX_PASS_DELAY_MS = STREAM_FRAME_MS
+
+# Marks a line whose end state isn't known (changed, or never lexed)
+SYNTAX_UNLEXED = "unlexed"
+
+C_LIKE_KEYWORDS = """break case catch class const continue default do else enum extends finally for goto if
+import new return static super switch this throw try void while""".split()
+SYNTAX_KEYWORDS = {
+    'python': keyword.kwlist,
+    'javascript': C_LIKE_KEYWORDS + """async await delete export from function in instanceof let of typeof var
+yield true false null undefined interface type implements private protected public readonly declare
+namespace abstract as""".split(),
+    'c': C_LIKE_KEYWORDS + """auto char double extern float inline int long register short signed sizeof
+struct typedef union unsigned volatile bool true false nullptr template typename namespace using public
+private protected virtual override delete operator friend constexpr noexcept""".split(),
+    'java': C_LIKE_KEYWORDS + """abstract assert boolean byte char double final float implements instanceof
+int interface long native package private protected public short strictfp synchronized throws transient
+volatile true false null var record""".split()
+}
+
+def word_pattern(words):
+    return r"\b(?:" + "|".join(sorted(set(words), key=len, reverse=True)) + r")\b"
+
+STRING_PATTERN = r"'(?:[^'\\]|\\.)*'?|\"(?:[^\"\\]|\\.)*\"?"
+NUMBER_PATTERN = r"\b(?:0[xX][\da-fA-F_]+|0[bBoO][0-7_]+|\d[\d_]*(?:\.[\d_]*)?(?:[eE][+-]?\d+)?)[jJlLuUfF]*\b"
+
+# Per language: (tag, regex) rules tried in order at each position, multi-line constructs as
+# opening delimiter -> (tag, closing delimiter), and a prefix allowed before an opening delimiter
+SYNTAX_RULES = {
+    'python': ([
+        ('comment', r"#.*"),
+        ('string', r"(?:[rRbBfFuU]{1,2})?(?:" + STRING_PATTERN + ")"),
+        ('decorator', r"(?<![\w)\]])@[\w.]+"),
+        ('definition', r"(?<=\bdef )\w+|(?<=\bclass )\w+"),
+        ('keyword', word_pattern(keyword.kwlist)),
+        ('builtin', word_pattern(name for name in dir(builtins) if not name.startswith('_'))),
+        ('number', NUMBER_PATTERN)
+    ], {'"""': ('string', '"""'), "'''": ('string', "'''")}, r"(?:[rRbBfFuU]{1,2})?"),
+    'javascript': ([
+        ('comment', r"//.*"),
+        ('string', STRING_PATTERN),
+        ('decorator', r"@\w+"),
+        ('definition', r"(?<=\bfunction )\w+|(?<=\bclass )\w+"),
+        ('keyword', word_pattern(SYNTAX_KEYWORDS['javascript'])),
+        ('number', NUMBER_PATTERN)
+    ], {'/*': ('comment', '*/'), '`': ('string', '`')}, ""),
+    'c': ([
+        ('comment', r"//.*"),
+        ('decorator', r"^\s*#\s*\w+"),
+        ('string', STRING_PATTERN),
+        ('definition', r"(?<=\bclass )\w+|(?<=\bstruct )\w+"),
+        ('keyword', word_pattern(SYNTAX_KEYWORDS['c'])),
+        ('number', NUMBER_PATTERN)
+    ], {'/*': ('comment', '*/')}, ""),
+    'java': ([
+        ('comment', r"//.*"),
+        ('string', STRING_PATTERN),
+        ('decorator', r"@\w+"),
+        ('definition', r"(?<=\bclass )\w+|(?<=\binterface )\w+"),
+        ('keyword', word_pattern(SYNTAX_KEYWORDS['java'])),
+        ('number', NUMBER_PATTERN)
+    ], {'/*': ('comment', '*/')}, ""),
+    'json': ([
+        ('attribute', r"\"(?:[^\"\\]|\\.)*\"(?=\s*:)"),
+        ('string', r"\"(?:[^\"\\]|\\.)*\"?"),
+        ('keyword', r"\b(?:true|false|null)\b"),
+        ('number', r"-?\b\d+(?:\.\d+)?(?:[eE][+-]?\d+)?\b")
+    ], {}, ""),
+    'markup': ([
+        ('tag', r"</?[\w:.-]+|/?>"),
+        ('attribute', r"[\w:.-]+(?==)"),
+        ('string', r"\"[^\"]*\"|'[^']*'")
+    ], {'<!--': ('comment', '-->')}, ""),
+    'css': ([
+        ('string', STRING_PATTERN),
+        ('decorator', r"@[\w-]+"),
+        ('number', r"#[\da-fA-F]{3,8}\b|-?\b\d*\.?\d+(?:px|em|rem|%|vh|vw|s|ms|deg|fr)?\b"),
+        ('attribute', r"[\w-]+(?=\s*:[^:])")
+    ], {'/*': ('comment', '*/')}, ""),
+    'markdown': ([
+        ('keyword', r"^#{1,6}\s.*"),
+        ('string', r"`[^`]+`")
+    ], {'```': ('string', '```')}, "")
+}
+
+# Languages of the file types shown in the file tree (.txt files are not highlighted)
+SYNTAX_LANGUAGES = {
+    '.py': 'python', '.js': 'javascript', '.ts': 'javascript', '.c': 'c', '.h': 'c', '.cpp': 'c',
+    '.ino': 'c', '.java': 'java', '.json': 'json', '.html': 'markup', '.xml': 'markup', '.css': 'css',
+    '.md': 'markdown'
+}
+
+class SyntaxLexer:
+    # Tokenizes a file one line at a time, so any line can be re-lexed on its own.
+    # The state carried from one line to the next is the multi-line construct still open at the end
+    # of the line (a triple-quoted string, a block comment...) as (tag, closing delimiter), or None.
+    def __init__(self, rules, multiline, open_prefix=""):
+        self.multiline = multiline
+        groups = {}  # tag -> alternatives, in rule order
+        for tag, pattern in rules:
+            groups.setdefault(tag, []).append(pattern)
+        parts = []
+        if multiline:
+            delimiters = "|".join(re.escape(delimiter) for delimiter in sorted(multiline, key=len, reverse=True))
+            parts.append(f"(?P<open>{open_prefix}(?:{delimiters}))")
+        parts.extend(f"(?P<{tag}>{'|'.join(patterns)})" for tag, patterns in groups.items())
+        self.pattern = re.compile("|".join(parts))
+    
+    def lex_line(self, line, state=None):
+        # Returns ([(start column, end column, tag)], state at the end of the line)
+        tokens = []
+        position = 0
+        if state is not None:
+            tag, closing = state
+            end = line.find(closing)
+            if end == -1:
+                return [(0, len(line), tag)] if line else [], state
+            position = end + len(closing)
+            tokens.append((0, position, tag))
+        while True:
+            match = self.pattern.search(line, position)
+            if match is None:
+                return tokens, None
+            if match.lastgroup == 'open':
+                opening = next(delimiter for delimiter in self.multiline if match.group().endswith(delimiter))
+                tag, closing = self.multiline[opening]
+                end = line.find(closing, match.end())
+                if end == -1:
+                    tokens.append((match.start(), len(line), tag))
+                    return tokens, (tag, closing)
+                position = end + len(closing)
+                tokens.append((match.start(), position, tag))
+            else:
+                tokens.append((match.start(), match.end(), match.lastgroup))
+                position = max(match.end(), position + 1)
+
+SYNTAX_LEXER_CACHE = {}
+
+def get_syntax_lexer(file_path):
+    # Lexer for a file's extension, or None if the file type isn't highlighted (compiled on first use)
+    language = SYNTAX_LANGUAGES.get(os.path.splitext(file_path or '')[1].lower())
+    if language is None:
+        return None
+    if language not in SYNTAX_LEXER_CACHE:
+        SYNTAX_LEXER_CACHE[language] = SyntaxLexer(*SYNTAX_RULES[language])
+    return SYNTAX_LEXER_CACHE[language]
+
+class SyntaxHighlighter:
+    # Incremental syntax highlighting for a Tk Text widget.
+    # The widget's Tcl command is wrapped, so every insert and delete (typing, pasting, streamed AI
+    # edits, files being loaded) reports the line it touched. The end state of each line is kept;
+    # changed lines are marked unlexed, and a pass lexes from the first unlexed line down to the
+    # bottom of the view on a worker thread. The tags are applied a batch of lines per frame,
+    # visible lines first. Lines below the view are only lexed once they are scrolled into view, so
+    # the work per keystroke doesn't grow with the size of the file.
+    def __init__(self, widget, post, enabled=True):
+        # post(result) hands a lexed range back to the UI thread, which calls on_tokens(result)
+        self.widget = widget
+        self.post = post
+        self.enabled = enabled
+        self.lexer = None
+        self.states = []  # end state of each line, or SYNTAX_UNLEXED
+        self.generation = 0  # incremented by every change, so results for older text are dropped
+        self.job_running = False
+        self.pending = deque()  # (line, tokens) lexed but not tagged yet
+        self.pass_scheduled = False
+        self.apply_scheduled = False
+        self.jobs = queue.Queue()
+        for tag, color in SYNTAX_TAG_COLORS.items():
+            widget.tag_configure(f"syntax_{tag}", foreground=color)
+        widget.tag_raise('sel')  # selected text keeps the selection colors
+        
+        # Route the widget's Tcl command through dispatch()
+        self.original_command = widget._w + "_unhighlighted"
+        widget.tk.call("rename", widget._w, self.original_command)
+        widget.tk.createcommand(widget._w, self.dispatch)
+        widget.bind('<Configure>', lambda e: self.schedule_pass(), add='+')
+        threading.Thread(target=self.run_worker, daemon=True).start()
+    
+    def call(self, *args):
+        return self.widget.tk.call((self.original_command,) + args)
+    
+    def line_of(self, index):
+        return int(str(self.call('index', index)).split('.')[0]) - 1
+    
+    def line_count(self):
+        return self.line_of('end-1c') + 1
+    
+    def dispatch(self, operation, *args):
+        # Every command sent to the widget: edits mark the lines they touch, scrolling schedules a pass
+        try:
+            if operation in ('insert', 'delete', 'replace') and self.lexer is not None:
+                before = self.line_count()
+                line = min(self.line_of(args[0]), before - 1)
+                result = self.call(operation, *args)
+                self.on_change(line, self.line_count() - before)
+                return result
+            if operation in ('yview', 'see') and args and self.lexer is not None:
+                self.schedule_pass()
+            return self.call(operation, *args)
+        except tk.TclError:
+            return ""
+    
+    def set_file(self, file_path):
+        # Pick the lexer for a newly opened file and highlight it from scratch
+        self.lexer = get_syntax_lexer(file_path) if self.enabled else None
+        self.pending.clear()
+        self.generation += 1
+        for tag in SYNTAX_TAG_COLORS:
+            self.call('tag', 'remove', f"syntax_{tag}", '1.0', 'end')
+        self.states = [SYNTAX_UNLEXED] * self.line_count()
+        self.schedule_pass()
+    
+    def set_enabled(self, enabled, file_path):
+        # Turn highlighting on or off for the open file
+        self.enabled = enabled
+        self.set_file(file_path)
+    
+    def on_change(self, line, delta):
+        # The text changed from line on and the line count by delta: shift the kept states to match,
+        # mark the changed line unlexed and forget lexed lines that haven't been tagged yet
+        for pending_line, tokens in self.pending:
+            if pending_line < len(self.states):
+                self.states[pending_line] = SYNTAX_UNLEXED
+        self.pending.clear()
+        if delta > 0:
+            self.states[line + 1:line + 1] = [SYNTAX_UNLEXED] * delta
+        elif delta < 0:
+            del self.states[line + 1:line + 1 - delta]
+        if line < len(self.states):
+            self.states[line] = SYNTAX_UNLEXED
+        self.generation += 1
+        self.schedule_pass()
+    
+    def schedule_pass(self):
+        if not self.pass_scheduled and self.lexer is not None:
+            self.pass_scheduled = True
+            self.widget.after(SYNTAX_PASS_DELAY_MS, self.run_pass)
+    
+    def run_pass(self):
+        # Send the lines from the first unlexed one to just below the view to the worker
+        self.pass_scheduled = False
+        if self.lexer is None or self.job_running or self.pending:
+            return  # a pass runs again when the current results have been applied
+        line_count = self.line_count()
+        if len(self.states) != line_count:
+            self.states = [SYNTAX_UNLEXED] * line_count
+        top = self.line_of('@0,0')
+        bottom = min(line_count, self.line_of(f"@0,{self.widget.winfo_height()}") + 1 + SYNTAX_LOOKAHEAD_LINES)
+        try:
+            first = self.states.index(SYNTAX_UNLEXED, 0, bottom)
+        except ValueError:
+            return  # everything up to the bottom of the view is highlighted
+        start_state = self.states[first - 1] if first else None
+        old_end_state = self.states[bottom - 1]
+        self.states[first:bottom] = [SYNTAX_UNLEXED] * (bottom - first)
+        text = str(self.call('get', f"{first + 1}.0", f"{bottom}.end"))
+        self.job_running = True
+        self.jobs.put((self.generation, self.lexer, first, text, start_state, old_end_state, top))
+    
+    def run_worker(self):
+        # Lex jobs on a background thread and post the tokens and end state of each line
+        while True:
+            generation, lexer, first, text, state, old_end_state, top = self.jobs.get()
+            results = []
+            for line in text.split('\n'):
+                tokens, state = lexer.lex_line(line, state)
+                results.append((tokens, state))
+            self.post((generation, first, results, old_end_state, top))
+    
+    def on_tokens(self, result):
+        # A lexed range is back: keep its states and queue its tags, visible lines first
+        generation, first, results, old_end_state, top = result
+        self.job_running = False
+        if generation != self.generation or self.lexer is None:
+            self.schedule_pass()  # the text changed meanwhile - lex it again
+            return
+        end = first + len(results)
+        self.states[first:end] = [state for tokens, state in results]
+        
+        # A different state at the end (say, a string that is now left open) changes the lines below
+        if end < len(self.states) and results[-1][1] != old_end_state:
+            self.states[end:] = [SYNTAX_UNLEXED] * (len(self.states) - end)
+        
+        lines = [(first + offset, tokens) for offset, (tokens, state) in enumerate(results)]
+        split = max(0, top - first)
+        self.pending.extend(lines[split:])
+        self.pending.extend(lines[:split])
+        self.schedule_apply()
+    
+    def schedule_apply(self):
+        if not self.apply_scheduled:
+            self.apply_scheduled = True
+            self.widget.after(STREAM_FRAME_MS, self.apply_batch)
+    
+    def apply_batch(self):
+        # Replace the tags of up to SYNTAX_BATCH_LINES lines, then continue next frame
+        self.apply_scheduled = False
+        batch = [self.pending.popleft() for _ in range(min(SYNTAX_BATCH_LINES, len(self.pending)))]
+        if not batch:
+            return
+        
+        # Clear the old tags once per run of consecutive lines
+        runs = []
+        for line, tokens in batch:
+            if runs and runs[-1][1] == line - 1:
+                runs[-1][1] = line
+            else:
+                runs.append([line, line])
+        for tag in SYNTAX_TAG_COLORS:
+            for first, last in runs:
+                self.call('tag', 'remove', f"syntax_{tag}", f"{first + 1}.0", f"{last + 1}.end")
+        
+        # One tag add per tag for the whole batch
+        ranges = {tag: [] for tag in SYNTAX_TAG_COLORS}
+        for line, tokens in batch:
+            for start, end, tag in tokens:
+                ranges[tag].extend((f"{line + 1}.{start}", f"{line + 1}.{end}"))
+        for tag, indices in ranges.items():
+            if indices:
+                self.call('tag', 'add', f"syntax_{tag}", *indices)
+        
+        if self.pending:
+            self.schedule_apply()
+        else:
+            self.schedule_pass()
+
+def encode_delta(base, target):
+    # Describe target as line operations against base: copy a range of base lines or insert new lines
+    base_lines = base.splitlines(keepends=True)
+    target_lines = target.splitlines(keepends=True)
+    ops = []
+    matcher = difflib.SequenceMatcher(None, base_lines, target_lines)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            ops.append([i1, i2])
+        elif j2 > j1:
+            ops.append("".join(target_lines[j1:j2]))
+    return zlib.compress(json.dumps(ops, separators=(',', ':')).encode('utf-8'))
+
+def decode_delta(base, delta):
+    # Rebuild the target text from base and an encoded delta
+    base_lines = base.splitlines(keepends=True)
+    parts = []
+    for op in json.loads(zlib.decompress(delta).decode('utf-8')):
+        if isinstance(op, str):
+            parts.append(op)
+        else:
+            parts.extend(base_lines[op[0]:op[1]])
+    return "".join(parts)
+
+class FileVersionStore:
+    # Content-addressed, delta-compressed store for file history.
+    # Every version refers to a blob by the SHA-1 of its content, so identical snapshots
+    # (e.g. "Before AI edit" right after a save) are stored once. The newest version of a
+    # file is kept as a zlib-compressed full copy and each older version is re-encoded as a
+    # reverse delta against the version that replaced it. Deltas always point at newer blobs,
+    # so chains never loop, and dropping the oldest versions never requires rebasing.
+    # Every KEYFRAME_INTERVAL versions a full copy is kept to bound the length of delta chains.
+    KEYFRAME_INTERVAL = 50
+    
+    def __init__(self, max_versions=20):
+        self.max_versions = max_versions
+        self.versions = {}  # file_path -> list of (content_hash, timestamp, description)
+        self.blobs = {}  # content_hash -> (kind, base_hash, data) where kind is 'full' or 'delta'
+        self.refcounts = {}  # content_hash -> number of versions and deltas referring to the blob
+    
+    # --- Storage primitives (overridden by persistent stores) ---
+    
+    def get_blob(self, content_hash):
+        return self.blobs.get(content_hash)
+    
+    def put_blob(self, content_hash, kind, base_hash, data):
+        self.blobs[content_hash] = (kind, base_hash, data)
+    
+    def delete_blob(self, content_hash):
+        self.blobs.pop(content_hash, None)
+        self.refcounts.pop(content_hash, None)
+    
+    def change_refs(self, content_hash, change):
+        count = self.refcounts.get(content_hash, 0) + change
+        self.refcounts[content_hash] = count
+        return count
+    
+    def list_versions(self, file_path):
+        # Version metadata only: [(content_hash, timestamp, description)]
+        return list(self.versions.get(file_path, []))
+    
+    def get_version(self, file_path, version_index):
+        return self.versions[file_path][version_index]
+    
+    def version_count(self, file_path):
+        return len(self.versions.get(file_path, []))
+    
+    def append_version(self, file_path, content_hash, timestamp, description):
+        self.versions.setdefault(file_path, []).append((content_hash, timestamp, description))
+    
+    def trim_versions(self, file_path, keep):
+        # Drop all but the newest `keep` versions and return the hashes they referred to
+        versions = self.versions.get(file_path, [])
+        removed = versions[:-keep] if len(versions) > keep else []
+        if removed:
+            self.versions[file_path] = versions[-keep:]
+        return [content_hash for content_hash, timestamp, description in removed]
+    
+    def stored_bytes(self):
+        return sum(len(data) for kind, base_hash, data in self.blobs.values())
+    
+    # --- Public interface ---
+    
+    def __contains__(self, file_path):
+        return self.version_count(file_path) > 0
+    
+    def add_version(self, file_path, content, timestamp, description):
+        # Record a version; returns False if it is identical to the file's latest version
+        content_hash = hashlib.sha1(content.encode('utf-8')).hexdigest()
+        count = self.version_count(file_path)
+        previous_hash = self.get_version(file_path, count - 1)[0] if count else None
+        if content_hash == previous_hash:
+            return False
+        
+        created = self.get_blob(content_hash) is None
+        if created:
+            self.put_blob(content_hash, 'full', None, zlib.compress(content.encode('utf-8')))
+        self.change_refs(content_hash, 1)
+        self.append_version(file_path, content_hash, timestamp, description)
+        
+        # Re-encode the previous version as a delta against this one
+        if created and previous_hash and count % self.KEYFRAME_INTERVAL:
+            self.delta_encode(previous_hash, content_hash, content)
+        
+        # Keep only the newest versions, releasing blobs nothing refers to any more
+        if self.max_versions:
+            for removed_hash in self.trim_versions(file_path, self.max_versions):
+                self.release(removed_hash)
+        return True
+    
+    def delta_encode(self, content_hash, base_hash, base_content):
+        blob = self.get_blob(content_hash)
+        if not blob or blob[0] != 'full':
+            return
+        content = zlib.decompress(blob[2]).decode('utf-8')
+        delta = encode_delta(base_content, content)
+        if len(delta) < len(blob[2]):
+            self.put_blob(content_hash, 'delta', base_hash, delta)
+            self.change_refs(base_hash, 1)
+    
+    def release(self, content_hash):
+        # Drop one reference to a blob, deleting it (and releasing its base) when unused
+        while content_hash and self.change_refs(content_hash, -1) <= 0:
+            blob = self.get_blob(content_hash)
+            self.delete_blob(content_hash)
+            content_hash = blob[1] if blob and blob[0] == 'delta' else None
+    
+    def get_blob_content(self, content_hash):
+        # Rebuild a blob by following its delta chain to the nearest full copy
+        chain = []
+        blob = self.get_blob(content_hash)
+        while blob and blob[0] == 'delta':
+            chain.append(blob[2])
+            blob = self.get_blob(blob[1])
+        if blob is None:
+            raise KeyError(f"Missing history blob {content_hash}")
+        content = zlib.decompress(blob[2]).decode('utf-8')
+        for delta in reversed(chain):
+            content = decode_delta(content, delta)
+        return content
+    
+    def get_history(self, file_path):
+        # [(timestamp, description)] for every stored version, oldest first
+        return [(timestamp, description) for content_hash, timestamp, description in self.list_versions(file_path)]
+    
+    def get_content(self, file_path, version_index):
+        return self.get_blob_content(self.get_version(file_path, version_index)[0])
+    
+    def close(self):
+        pass
+
+class SQLiteVersionStore(FileVersionStore):
+    # Persistent file history for one project folder, kept in a SQLite database.
+    # Uses the same deduplicated, delta-compressed blobs as FileVersionStore. Version metadata
+    # is indexed by file, so listing a file's history never reads content, and a single
+    # version is rebuilt only when it is reverted to. Nothing is loaded when the database opens.
+    def __init__(self, db_path, max_versions=None):
+        super().__init__(max_versions=max_versions)
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.db_path = db_path
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        with self.db:
+            self.db.execute("""CREATE TABLE IF NOT EXISTS blobs (
+                hash TEXT PRIMARY KEY, kind TEXT NOT NULL, base TEXT, data BLOB NOT NULL, refs INTEGER NOT NULL DEFAULT 0)""")
+            self.db.execute("""CREATE TABLE IF NOT EXISTS versions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, file_path TEXT NOT NULL, hash TEXT NOT NULL,
+                timestamp TEXT NOT NULL, description TEXT NOT NULL)""")
+            self.db.execute("CREATE INDEX IF NOT EXISTS versions_by_file ON versions (file_path, id)")
+    
+    @staticmethod
+    def path_for_folder(folder):
+        # One database per project folder, kept outside the project itself
+        folder_key = hashlib.sha1(os.path.abspath(folder).encode('utf-8')).hexdigest()[:16]
+        return os.path.join(APP_DATA_DIR, "history", f"{os.path.basename(os.path.abspath(folder))}-{folder_key}.sqlite3")
+    
+    def get_blob(self, content_hash):
+        return self.db.execute("SELECT kind, base, data FROM blobs WHERE hash = ?", (content_hash,)).fetchone()
+    
+    def put_blob(self, content_hash, kind, base_hash, data):
+        self.db.execute("INSERT OR IGNORE INTO blobs (hash, kind, base, data) VALUES (?, ?, ?, ?)",
+                        (content_hash, kind, base_hash, data))
+        self.db.execute("UPDATE blobs SET kind = ?, base = ?, data = ? WHERE hash = ?",
+                        (kind, base_hash, data, content_hash))
+    
+    def delete_blob(self, content_hash):
+        self.db.execute("DELETE FROM blobs WHERE hash = ?", (content_hash,))
+    
+    def change_refs(self, content_hash, change):
+        self.db.execute("UPDATE blobs SET refs = refs + ? WHERE hash = ?", (change, content_hash))
+        row = self.db.execute("SELECT refs FROM blobs WHERE hash = ?", (content_hash,)).fetchone()
+        return row[0] if row else 0
+    
+    def list_versions(self, file_path):
+        with self.lock:
+            return self.db.execute("SELECT hash, timestamp, description FROM versions WHERE file_path = ? ORDER BY id",
+                                   (file_path,)).fetchall()
+    
+    def get_version(self, file_path, version_index):
+        with self.lock:
+            if version_index < 0:
+                version_index += self.version_count(file_path)
+            row = self.db.execute("SELECT hash, timestamp, description FROM versions WHERE file_path = ? ORDER BY id LIMIT 1 OFFSET ?",
+                                  (file_path, version_index)).fetchone()
+        if row is None:
+            raise IndexError(version_index)
+        return row
+    
+    def version_count(self, file_path):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM versions WHERE file_path = ?", (file_path,)).fetchone()[0]
+    
+    def append_version(self, file_path, content_hash, timestamp, description):
+        self.db.execute("INSERT INTO versions (file_path, hash, timestamp, description) VALUES (?, ?, ?, ?)",
+                        (file_path, content_hash, timestamp, description))
+    
+    def trim_versions(self, file_path, keep):
+        rows = self.db.execute("SELECT id, hash FROM versions WHERE file_path = ? ORDER BY id DESC LIMIT -1 OFFSET ?",
+                               (file_path, keep)).fetchall()
+        self.db.executemany("DELETE FROM versions WHERE id = ?", [(row[0],) for row in rows])
+        return [row[1] for row in rows]
+    
+    def stored_bytes(self):
+        with self.lock:
+            return self.db.execute("SELECT COALESCE(SUM(LENGTH(data)), 0) FROM blobs").fetchone()[0]
+    
+    def add_version(self, file_path, content, timestamp, description):
+        # Each version is written in a single transaction
+        with self.lock, self.db:
+            return super().add_version(file_path, content, timestamp, description)
+    
+    def get_content(self, file_path, version_index):
+        with self.lock:
+            return super().get_content(file_path, version_index)
+    
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+class ResponseCache:
+    # Disk-backed cache of AI responses for identical requests, kept in a SQLite database.
+    # Entries are keyed by a hash of the model, messages and sampling parameters. When the
+    # cache grows past max_entries or max_bytes the least recently used entries are evicted.
+    def __init__(self, db_path, max_entries=500, max_bytes=50 * 1024 * 1024):
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        with self.db:
+            self.db.execute("""CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY, response TEXT NOT NULL, tokens INTEGER NOT NULL,
+                size INTEGER NOT NULL, created REAL NOT NULL, last_access REAL NOT NULL)""")
+            self.db.execute("CREATE INDEX IF NOT EXISTS responses_by_access ON responses (last_access)")
+    
+    @staticmethod
+    def make_key(api_params):
+        # Hash everything that affects the response except how it is delivered
+        request = {k: v for k, v in api_params.items() if k not in ('stream', 'stream_options')}
+        return hashlib.sha256(json.dumps(request, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+    
+    def get(self, key):
+        # Returns (response, tokens the original request used) or None
+        with self.lock:
+            row = self.db.execute("SELECT response, tokens FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            with self.db:
+                self.db.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+            return row
+    
+    def put(self, key, response, tokens):
+        with self.lock, self.db:
+            now = time.time()
+            size = len(response.encode('utf-8'))
+            self.db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                            (key, response, tokens or 0, size, now, now))
+            self.evict()
+    
+    def evict(self):
+        # Drop least recently used entries until both limits are met
+        count, total = self.db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        if count <= self.max_entries and total <= self.max_bytes:
+            return
+        for key, size in self.db.execute("SELECT key, size FROM responses ORDER BY last_access").fetchall():
+            if count <= self.max_entries and total <= self.max_bytes:
+                break
+            self.db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            count -= 1
+            total -= size
+    
+    def stats(self):
+        with self.lock:
+            count, total = self.db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        return {"entries": count, "bytes": total, "hits": self.hits, "misses": self.misses}
+    
+    def clear(self):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM responses")
+
+# Longest diff kept in conversation memory for one edit turn
+CONVERSATION_DIFF_MAX_LINES = 200
+
+def estimate_tokens(text):
+    # Rough token count for budgeting (about 4 characters per token for English and code)
+    return len(text) // 4 + 1
+
+def summarize_diff(before, after, max_lines=CONVERSATION_DIFF_MAX_LINES):
+    # Unified diff of an edit without file headers, cut off after max_lines
+    lines = list(difflib.unified_diff(before.splitlines(), after.splitlines(), lineterm="", n=1))[2:]
+    if len(lines) > max_lines:
+        lines = lines[:max_lines] + [f"... ({len(lines) - max_lines} more diff lines)"]
+    return "\n".join(lines)
+
+class ConversationMemory:
+    # Conversation history trimmed to an estimated token budget rather than a message count.
+    # Edit turns keep the request and a diff of what it changed instead of the file snapshot
+    # that was sent with it: every edit request carries the current file content, so older
+    # snapshots are superseded and resending them would grow the prompt with every turn.
+    def __init__(self, token_budget=8000):
+        self.token_budget = token_budget
+        self.turns = []  # [(user message, assistant message, estimated tokens)]
+    
+    def __len__(self):
+        return len(self.turns)
+    
+    def clear(self):
+        self.turns.clear()
+    
+    def add_chat_turn(self, message, response):
+        return self.add_turn(message, response)
+    
+    def add_edit_turn(self, file_path, prompt, before, after):
+        name = os.path.basename(file_path)
+        user_message = f"Edit request for {name} (file content omitted - the current version is sent with each request)\n\nUser request: {prompt}"
+        diff = summarize_diff(before, after)
+        assistant_message = f"Applied these changes to {name}:\n{diff}" if diff else f"Made no changes to {name}."
+        return self.add_turn(user_message, assistant_message)
+    
+    def add_turn(self, user_message, assistant_message):
+        # Record a turn and trim; returns the number of old turns dropped
+        tokens = estimate_tokens(user_message) + estimate_tokens(assistant_message)
+        self.turns.append((user_message, assistant_message, tokens))
+        return self.trim()
+    
+    def trim(self):
+        # Drop the oldest turns until the rest fit the token budget
+        dropped = 0
+        total = self.token_count()
+        while self.turns and total > self.token_budget:
+            total -= self.turns.pop(0)[2]
+            dropped += 1
+        return dropped
+    
+    def token_count(self):
+        return sum(tokens for user_message, assistant_message, tokens in self.turns)
+    
+    def messages(self):
+        # Chat messages for the remembered turns, oldest first
+        messages = []
+        for user_message, assistant_message, tokens in self.turns:
+            messages.append({"role": "user", "content": user_message})
+            messages.append({"role": "assistant", "content": assistant_message})
+        return messages
+
+# Default prices in USD per 1K tokens (as of 2024): model prefix -> input, cached input and output.
+# Cached input is prompt tokens the API served from its prompt cache. Edit with "Edit Pricing"
+# in the token usage details; the edited table is saved as model_pricing in config.json
+DEFAULT_MODEL_PRICING = {
+    'gpt-4': {'input': 0.03, 'cached_input': 0.015, 'output': 0.06},
+    'gpt-4.1': {'input': 0.01, 'cached_input': 0.005, 'output': 0.03},
+    'gpt-4.1-mini': {'input': 0.00015, 'cached_input': 0.000075, 'output': 0.0006},
+    'gpt-4.1-nano': {'input': 0.0001, 'cached_input': 0.00005, 'output': 0.0004},
+    'gpt-5': {'input': 0.005, 'cached_input': 0.0025, 'output': 0.015},
+    'o3-pro': {'input': 0.015, 'cached_input': 0.0075, 'output': 0.06},
+    'o3-mini': {'input': 0.0002, 'cached_input': 0.0001, 'output': 0.0008},
+    'o3-mini-high': {'input': 0.0003, 'cached_input': 0.00015, 'output': 0.0012},
+    'gpt-3.5-turbo': {'input': 0.0005, 'cached_input': 0.00025, 'output': 0.0015}
+}
+# Price used for models not in the table
+FALLBACK_MODEL_PRICE = DEFAULT_MODEL_PRICING['gpt-4']
+
+def usage_cost(pricing, model, prompt_tokens, completion_tokens, cached_tokens=0):
+    # Cost in USD of one request's token split; cached prompt tokens are part of prompt_tokens
+    price = lookup_model_setting(pricing, model, FALLBACK_MODEL_PRICE)
+    cached_tokens = min(cached_tokens, prompt_tokens)
+    return ((prompt_tokens - cached_tokens) * price['input']
+            + cached_tokens * price.get('cached_input', price['input'])
+            + completion_tokens * price['output']) / 1000
+
+def validate_pricing(pricing):
+    # Check an edited pricing table; raises ValueError describing the first problem
+    if not isinstance(pricing, dict):
+        raise ValueError("Pricing must be an object of model prefix -> prices")
+    for model, price in pricing.items():
+        if not isinstance(price, dict):
+            raise ValueError(f"{model}: prices must be an object")
+        for field in ('input', 'output'):
+            if field not in price:
+                raise ValueError(f"{model}: missing '{field}'")
+        for field, value in price.items():
+            if field not in ('input', 'cached_input', 'output'):
+                raise ValueError(f"{model}: unknown field '{field}'")
+            if not isinstance(value, (int, float)) or value < 0:
+                raise ValueError(f"{model}: '{field}' must be a number of at least 0")
+
+class UsageLedger:
+    # Append-only record of the tokens every API request used, kept in a SQLite database so spend
+    # can be tracked across sessions. Rows are never updated; costs are worked out from the token
+    # split when the ledger is summarized, so editing the pricing table re-prices past usage too.
+    GROUPS = ('day', 'project', 'model', 'mode')
+    
+    def __init__(self, db_path):
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        with self.db:
+            self.db.execute("""CREATE TABLE IF NOT EXISTS usage (
+                timestamp REAL NOT NULL, day TEXT NOT NULL, project TEXT NOT NULL, model TEXT NOT NULL,
+                mode TEXT NOT NULL, prompt_tokens INTEGER NOT NULL, completion_tokens INTEGER NOT NULL,
+                cached_tokens INTEGER NOT NULL)""")
+            for column in self.GROUPS:
+                self.db.execute(f"CREATE INDEX IF NOT EXISTS usage_by_{column} ON usage ({column}, model)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS usage_by_time ON usage (timestamp)")
+    
+    def record(self, model, mode, project, prompt_tokens, completion_tokens, cached_tokens=0):
+        now = time.time()
+        with self.lock, self.db:
+            self.db.execute("INSERT INTO usage VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                            (now, datetime.date.fromtimestamp(now).isoformat(), project or "", model, mode,
+                             prompt_tokens, completion_tokens, cached_tokens))
+    
+    def summarize(self, group_by, pricing, since=None, project=None):
+        # Usage grouped by day, project, model or mode, most expensive first. Each row is a dict with
+        # the group value, request count, token split and cost; since (a timestamp) and project filter the rows
+        if group_by not in self.GROUPS:
+            raise ValueError(f"Unknown usage grouping: {group_by}")
+        conditions, args = [], []
+        if since is not None:
+            conditions.append("timestamp >= ?")
+            args.append(since)
+        if project is not None:
+            conditions.append("project = ?")
+            args.append(project)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        with self.lock:
+            rows = self.db.execute(
+                f"""SELECT {group_by}, model, COUNT(*), SUM(prompt_tokens), SUM(completion_tokens), SUM(cached_tokens)
+                    FROM usage {where} GROUP BY {group_by}, model""", args).fetchall()
+        
+        # Costs are per model, so sum them per group after pricing each model's share
+        groups = {}
+        for key, model, requests, prompt_tokens, completion_tokens, cached_tokens in rows:
+            group = groups.setdefault(key, {"key": key, "requests": 0, "prompt_tokens": 0,
+                                            "completion_tokens": 0, "cached_tokens": 0, "cost": 0.0})
+            group["requests"] += requests
+            group["prompt_tokens"] += prompt_tokens
+            group["completion_tokens"] += completion_tokens
+            group["cached_tokens"] += cached_tokens
+            group["cost"] += usage_cost(pricing, model, prompt_tokens, completion_tokens, cached_tokens)
+        return sorted(groups.values(), key=lambda group: group["cost"], reverse=True)
+
+# Model prefix -> (context window, max output tokens, reasoning model)
+MODEL_LIMITS = {
+    'gpt-5': (400000, 128000, True),
+    'gpt-4.1': (1047576, 32768, False),
+    'gpt-4': (8192, 8192, False),
+    'o3': (200000, 100000, True),
+    'gpt-3.5-turbo': (16385, 4096, False)
+}
+DEFAULT_MODEL_LIMITS = (128000, 16384, False)
+
+# Model prefix -> tokenizer family, used to pick a token counter
+MODEL_TOKENIZER_FAMILIES = {
+    'gpt-5': 'o200k_base',
+    'gpt-4.1': 'o200k_base',
+    'o3': 'o200k_base',
+    'gpt-4': 'cl100k_base',
+    'gpt-3.5-turbo': 'cl100k_base'
+}
+
+# Output sizing: headroom on top of the expected output, extra room for reasoning models'
+# hidden reasoning tokens, and the smallest limit ever requested
+OUTPUT_TOKEN_MARGIN = 1.25
+REASONING_TOKEN_ALLOWANCE = 8192
+MIN_OUTPUT_TOKENS = 512
+
+# Prompts above this many tokens are logged as large
+LARGE_PROMPT_TOKENS = 4000
+
+def lookup_model_setting(table, model, default=None):
+    # Value for the longest key in table that model starts with
+    matches = [prefix for prefix in table if model.startswith(prefix)]
+    return table[max(matches, key=len)] if matches else default
+
+# Roughly one BPE token per short word piece, number group, line indent or symbol
+HEURISTIC_TOKEN_PATTERN = re.compile(r"[A-Za-z]{1,8}|\d{1,3}|\n[ \t]*|[^\sA-Za-z\d]")
+
+def heuristic_token_count(text):
+    return len(HEURISTIC_TOKEN_PATTERN.findall(text))
+
+class TokenEstimator:
+    # Local token counts for sizing requests before they are sent.
+    # Each tokenizer family has a counting function: tiktoken when it is installed, otherwise a
+    # regex heuristic, and register_counter() can plug in others. Counts are scaled by a
+    # per-family correction factor that follows the prompt token counts the API reports.
+    MESSAGE_OVERHEAD = 4  # role and separator tokens per chat message
+    CALIBRATION_RATE = 0.3
+    
+    def __init__(self, calibration=None):
+        self.counters = {}  # tokenizer family -> count function
+        self.calibration = dict(calibration or {})  # tokenizer family -> correction factor
+    
+    def register_counter(self, family, count_function):
+        self.counters[family] = count_function
+    
+    def family_for(self, model):
+        return lookup_model_setting(MODEL_TOKENIZER_FAMILIES, model, 'o200k_base')
+    
+    def get_counter(self, family):
+        if family not in self.counters:
+            count_function = heuristic_token_count
+            try:
+                import tiktoken  # Optional: exact token counts instead of the built-in estimate
+                encoding = tiktoken.get_encoding(family)
+                count_function = lambda text: len(encoding.encode(text, disallowed_special=()))
+            except Exception:
+                pass  # Not installed, unknown encoding or no cached tokenizer data - use the heuristic
+            self.counters[family] = count_function
+        return self.counters[family]
+    
+    def count_text(self, text, model):
+        family = self.family_for(model)
+        return int(self.get_counter(family)(text) * self.calibration.get(family, 1.0))
+    
+    def count_messages(self, messages, model):
+        family = self.family_for(model)
+        count_function = self.get_counter(family)
+        raw = sum(count_function(message["content"]) + self.MESSAGE_OVERHEAD for message in messages) + 3
+        return int(raw * self.calibration.get(family, 1.0))
+    
+    def calibrate(self, model, estimated_tokens, actual_tokens):
+        # Move the family's correction factor towards the observed actual/estimated ratio
+        if estimated_tokens <= 0 or actual_tokens <= 0:
+            return
+        family = self.family_for(model)
+        factor = self.calibration.get(family, 1.0)
+        observed = factor * actual_tokens / estimated_tokens
+        factor += (observed - factor) * self.CALIBRATION_RATE
+        self.calibration[family] = round(min(2.0, max(0.5, factor)), 4)
+
+# Shared HTTP connection pool for API requests
+HTTP_MAX_CONNECTIONS = 20
+HTTP_KEEPALIVE_CONNECTIONS = 10
+HTTP_KEEPALIVE_EXPIRY = 120.0  # seconds an idle connection is kept open for the next request
+
+# HTTP/2 needs the optional h2 package (pip install httpx[http2])
+HTTP2_AVAILABLE = importlib.util.find_spec('h2') is not None
+
+class ConnectionStats:
+    # Counts API requests and how many of them needed a new connection, from httpx event hooks and
+    # httpcore trace events; requests that didn't open a connection reused a pooled one
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.connections = 0
+        self.http_versions = {}
+    
+    def on_request(self, request):
+        with self.lock:
+            self.requests += 1
+        request.extensions["trace"] = self.trace
+    
+    def on_response(self, response):
+        version = response.http_version
+        with self.lock:
+            self.http_versions[version] = self.http_versions.get(version, 0) + 1
+    
+    def trace(self, event_name, info):
+        if event_name == "connection.connect_tcp.complete":
+            with self.lock:
+                self.connections += 1
+    
+    # Async versions for httpx.AsyncClient, which awaits its hooks
+    async def on_request_async(self, request):
+        self.on_request(request)
+        request.extensions["trace"] = self.trace_async
+    
+    async def on_response_async(self, response):
+        self.on_response(response)
+    
+    async def trace_async(self, event_name, info):
+        self.trace(event_name, info)
+    
+    def summary(self):
+        with self.lock:
+            reused = max(0, self.requests - self.connections)
+            rate = reused / self.requests * 100 if self.requests else 0
+            versions = ", ".join(f"{version}: {count}" for version, count in sorted(self.http_versions.items()))
+            return (f"{self.requests} requests, {self.connections} new connections, "
+                    f"{reused} reused ({rate:.0f}%){f' - {versions}' if versions else ''}")
+
+def http_pool_limits():
+    return httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS,
+                        max_keepalive_connections=HTTP_KEEPALIVE_CONNECTIONS,
+                        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY)
+
+def make_openai_client(api_key, stats, rate_limiter):
+    # Blocking client on a pooled keep-alive HTTP client, shared by every request and model
+    # (retries are done by EditEngine.create_completion, so the SDK's own are turned off)
+    import_openai()
+    http_client = httpx.Client(limits=http_pool_limits(), http2=HTTP2_AVAILABLE, follow_redirects=True,
+                               event_hooks={"request": [stats.on_request],
+                                            "response": [stats.on_response, rate_limiter.on_response]})
+    return openai.OpenAI(api_key=api_key, http_client=http_client, max_retries=0)
+
+class AsyncChunkStream:
+    # Chunks of a completion streamed on the event loop thread, read from a worker like a blocking stream
+    DONE = object()
+    
+    def __init__(self):
+        self.chunks = queue.Queue()
+        self.future = None
+        self.started = threading.Event()  # set once the response has started (or failed to)
+        self.error = None  # error that stopped the response from starting
+    
+    def wait_started(self):
+        # Block until the response starts; raises the API error if it couldn't
+        self.started.wait()
+        if self.error is not None:
+            raise self.error
+    
+    def __iter__(self):
+        while True:
+            item = self.chunks.get()
+            if item is self.DONE:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    
+    def close(self):
+        # Cancel the request on the event loop; the HTTP stream is closed immediately
+        if self.future is not None:
+            self.future.cancel()
+
+class AsyncModelClient:
+    # Runs API requests with AsyncOpenAI on one long-lived event loop thread.
+    # Every request shares one pooled HTTP client (keep-alive, HTTP/2 when h2 is installed), so
+    # connections stay warm across requests and model changes, and waiting requests hold no thread
+    # of their own. Calls return concurrent futures (or a stream of chunks) to the calling thread.
+    def __init__(self, api_key, stats, rate_limiter):
+        import_openai()
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        http_client = httpx.AsyncClient(limits=http_pool_limits(), http2=HTTP2_AVAILABLE, follow_redirects=True,
+                                        event_hooks={"request": [stats.on_request_async],
+                                                     "response": [stats.on_response_async, rate_limiter.on_response_async]})
+        self.client = openai.AsyncOpenAI(api_key=api_key, http_client=http_client, max_retries=0)
+    
+    def create(self, api_params):
+        # Future for a non-streamed completion
+        return asyncio.run_coroutine_threadsafe(self.client.chat.completions.create(**api_params), self.loop)
+    
+    def stream(self, api_params):
+        # Start a streamed completion; returns an AsyncChunkStream
+        stream = AsyncChunkStream()
+        stream.future = asyncio.run_coroutine_threadsafe(self.read_stream(api_params, stream), self.loop)
+        return stream
+    
+    async def read_stream(self, api_params, stream):
+        try:
+            response = await self.client.chat.completions.create(**api_params)
+            stream.started.set()
+            try:
+                async for chunk in response:
+                    stream.chunks.put(chunk)
+            finally:
+                await response.close()
+        except Exception as e:
+            if stream.started.is_set():
+                stream.chunks.put(e)
+            else:
+                stream.error = e
+        finally:
+            stream.started.set()
+            stream.chunks.put(AsyncChunkStream.DONE)
+    
+    def close(self):
+        # Close the pooled connections and stop the event loop
+        future = asyncio.run_coroutine_threadsafe(self.client.close(), self.loop)
+        try:
+            future.result(timeout=5)
+        except Exception:
+            pass
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+# Retries for rate limits (429), server errors and dropped connections, with jittered exponential backoff
+RETRY_MAX_ATTEMPTS = 5
+RETRY_BACKOFF_BASE = 1.0  # seconds before the first retry, doubled for each one after
+RETRY_BACKOFF_MAX = 60.0
+RETRY_STATUS_CODES = (408, 409, 429, 500, 502, 503, 504)
+
+def parse_reset_duration(value):
+    # Seconds in an x-ratelimit-reset-* header value such as "6m0s", "1.5s" or "120ms"
+    units = {'ms': 0.001, 's': 1.0, 'm': 60.0, 'h': 3600.0}
+    return sum(float(number) * units[unit] for number, unit in re.findall(r'(\d+(?:\.\d+)?)(ms|s|m|h)', value or ''))
+
+def retry_delay(error, attempt):
+    # Seconds to wait before retrying a failed API call, or None if it shouldn't be retried.
+    # Retry-After (or retry-after-ms) from the server is honoured; otherwise the wait doubles
+    # per attempt with jitter so that parallel workers don't retry in lockstep.
+    if openai is None:
+        return None  # No API client has been created, so this isn't an API error
+    if isinstance(error, openai.APIConnectionError):
+        headers = {}
+    elif isinstance(error, openai.APIStatusError) and error.status_code in RETRY_STATUS_CODES:
+        if getattr(error, 'code', None) == 'insufficient_quota':
+            return None  # Out of credit - retrying won't help
+        headers = error.response.headers
+    else:
+        return None
+    backoff = min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * 2 ** attempt)
+    delay = backoff * (0.5 + random.random() / 2)
+    try:
+        if headers.get('retry-after-ms'):
+            return max(delay, float(headers['retry-after-ms']) / 1000)
+        if headers.get('retry-after'):
+            return max(delay, float(headers['retry-after']))
+    except ValueError:
+        pass  # An HTTP date rather than seconds - keep the backoff
+    # Without Retry-After, wait for the exhausted limit to reset
+    for kind in ('requests', 'tokens'):
+        if headers.get(f'x-ratelimit-remaining-{kind}') == '0':
+            delay = max(delay, parse_reset_duration(headers.get(f'x-ratelimit-reset-{kind}')))
+    return delay
+
+class TokenBucket:
+    # Allowance that refills continuously up to capacity once a minute
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.level = float(per_minute)
+        self.updated = time.monotonic()
+    
+    def refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.capacity / 60.0)
+        self.updated = now
+    
+    def wait_time(self, amount):
+        # Seconds until amount is available (requests bigger than the whole bucket wait for a full one)
+        amount = min(amount, self.capacity)
+        return 0.0 if self.level >= amount else (amount - self.level) * 60.0 / self.capacity
+
+class RateLimiter:
+    # Client-side throttling per model with request and token buckets (requests/min, tokens/min).
+    # Buckets are sized from configured limits or the x-ratelimit-limit-* response headers, kept in step
+    # with the x-ratelimit-remaining-* counts the API reports, and paused after a 429, so parallel and
+    # batch requests run close to the quota without a storm of rate limit errors.
+    def __init__(self, configured_limits=None):
+        self.lock = threading.Lock()
+        self.configured_limits = configured_limits or {}  # model prefix -> {"rpm": n, "tpm": n}
+        self.buckets = {}  # model -> {"requests": TokenBucket or None, "tokens": TokenBucket or None}
+        self.paused_until = {}  # model -> time.monotonic() when requests may resume
+        self.throttled = 0
+        self.throttled_seconds = 0.0
+        self.retries = 0
+    
+    def get_buckets(self, model):
+        # Buckets for a model, created from the configured limits (call with the lock held)
+        buckets = self.buckets.get(model)
+        if buckets is None:
+            configured = lookup_model_setting(self.configured_limits, model, {})
+            buckets = {"requests": TokenBucket(configured["rpm"]) if configured.get("rpm") else None,
+                       "tokens": TokenBucket(configured["tpm"]) if configured.get("tpm") else None}
+            self.buckets[model] = buckets
+        return buckets
+    
+    def reserve(self, model, tokens):
+        # Take one request and its tokens if they are available; otherwise return the seconds to wait
+        with self.lock:
+            now = time.monotonic()
+            buckets = self.get_buckets(model)
+            charges = [(buckets["requests"], 1), (buckets["tokens"], tokens)]
+            wait = self.paused_until.get(model, 0) - now
+            for bucket, amount in charges:
+                if bucket:
+                    bucket.refill(now)
+                    wait = max(wait, bucket.wait_time(amount))
+            if wait > 0:
+                return wait
+            for bucket, amount in charges:
+                if bucket:
+                    bucket.level -= min(amount, bucket.capacity)
+            return 0.0
+    
+    def acquire(self, model, tokens, cancel_event):
+        # Wait until a request of this many tokens fits in the model's limits; returns the seconds waited
+        start = time.monotonic()
+        while not cancel_event.is_set():
+            wait = self.reserve(model, tokens)
+            if wait <= 0:
+                break
+            cancel_event.wait(min(wait, 1.0))
+        waited = time.monotonic() - start
+        if waited > 0.05:
+            with self.lock:
+                self.throttled += 1
+                self.throttled_seconds += waited
+            return waited
+        return 0.0
+    
+    def pause(self, model, seconds):
+        # Hold every request for the model (e.g. after a 429)
+        with self.lock:
+            self.paused_until[model] = max(self.paused_until.get(model, 0), time.monotonic() + seconds)
+    
+    def record_retry(self):
+        with self.lock:
+            self.retries += 1
+    
+    def update_from_headers(self, model, headers):
+        # Size the buckets from the reported limits and drain them to the reported remaining counts
+        with self.lock:
+            now = time.monotonic()
+            buckets = self.get_buckets(model)
+            configured = lookup_model_setting(self.configured_limits, model, {})
+            for kind, configured_key in (("requests", "rpm"), ("tokens", "tpm")):
+                try:
+                    limit = int(headers.get(f"x-ratelimit-limit-{kind}", 0))
+                    remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+                    remaining = int(remaining) if remaining is not None else None
+                except ValueError:
+                    continue
+                if not limit:
+                    continue
+                limit = min(limit, configured.get(configured_key) or limit)
+                bucket = buckets[kind]
+                if bucket is None:
+                    bucket = buckets[kind] = TokenBucket(limit)
+                bucket.refill(now)
+                bucket.capacity = limit
+                if remaining is not None:
+                    bucket.level = min(bucket.level, remaining)
+    
+    def on_response(self, response):
+        # httpx response hook: read the rate limit headers of every API response
+        if "x-ratelimit-limit-requests" not in response.headers and "x-ratelimit-limit-tokens" not in response.headers:
+            return
+        try:
+            model = json.loads(response.request.content or b"{}").get("model")
+        except ValueError:
+            return
+        if model:
+            self.update_from_headers(model, response.headers)
+    
+    async def on_response_async(self, response):
+        self.on_response(response)
+    
+    def summary(self):
+        with self.lock:
+            limits = []
+            for model, buckets in sorted(self.buckets.items()):
+                parts = [f"{bucket.level:,.0f}/{bucket.capacity:,} {unit}"
+                         for unit, bucket in (("RPM", buckets["requests"]), ("TPM", buckets["tokens"])) if bucket]
+                if parts:
+                    limits.append(f"{model}: {', '.join(parts)}")
+            return (f"{self.throttled} requests throttled for {self.throttled_seconds:.1f}s, {self.retries} retries"
+                    f"{' - available ' + '; '.join(limits) if limits else ' - no rate limits known yet'}")
+
+# Requests on the scheduler: interactive ones (edits, chat) start before background ones (batch edits)
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+
+# Settings a request runs with, copied on the UI thread when it is submitted
+RequestSettings = namedtuple('RequestSettings', ['model', 'temperature', 'max_tokens', 'auto_max_tokens',
+                                                 'stream', 'cache_policy', 'edit_protocol', 'parallel_workers',
+                                                 'project_folder'])
+
+class RequestCancelled(Exception):
+    # Raised in a worker when the user cancels the request it is running
+    pass
+
+class ScheduledRequest:
+    # One AI request on the RequestScheduler: what to run, its settings snapshot and its cancel flag
+    def __init__(self, kind, key, priority, settings, function, args):
+        self.kind = kind
+        self.key = key
+        self.priority = priority
+        self.settings = settings
+        self.function = function
+        self.args = args
+        self.cancel_event = threading.Event()
+        self.cancel_callbacks = []
+        self.duplicates = 0  # identical submissions coalesced into this one
+        self.submitted_at = time.time()
+        self.started_at = None  # set when a worker picks the request up
+    
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+    
+    @property
+    def queue_wait(self):
+        # Seconds the request waited for a worker
+        return (self.started_at or time.time()) - self.submitted_at
+    
+    def cancel(self):
+        self.cancel_event.set()
+        for callback in list(self.cancel_callbacks):
+            callback()
+    
+    def add_cancel_callback(self, callback):
+        # Call callback (e.g. to abort a network call) when the request is cancelled
+        self.cancel_callbacks.append(callback)
+        if self.cancel_event.is_set():
+            callback()
+    
+    def check_cancelled(self):
+        # Stop the worker at a safe point if the request was cancelled
+        if self.cancel_event.is_set():
+            raise RequestCancelled(f"{self.kind} request cancelled")
+
+def make_request_key(kind, settings, *inputs):
+    # Identity of a request for coalescing: same kind, settings and inputs
+    payload = json.dumps([kind, settings, inputs], default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+class RequestScheduler:
+    # Runs AI requests on a fixed pool of worker threads.
+    # Queued requests start by priority, then in the order they were submitted. One worker is kept
+    # free of background work so an edit or chat never waits behind a batch, and a request identical
+    # to one that is still queued or running is coalesced into it instead of being sent again.
+    def __init__(self, workers):
+        self.lock = threading.Condition()
+        self.queue = []  # heap of (priority, sequence, request)
+        self.sequence = 0
+        self.running = []
+        self.in_flight = {}  # key -> queued or running request
+        self.workers = 0
+        self.threads = 0
+        self.resize(workers)
+    
+    def resize(self, workers):
+        # Change the pool size; surplus threads exit once they are idle
+        with self.lock:
+            self.workers = max(2, workers)
+            while self.threads < self.workers:
+                self.threads += 1
+                threading.Thread(target=self.run, daemon=True).start()
+            self.lock.notify_all()
+    
+    def submit(self, kind, key, settings, function, *args, priority=PRIORITY_INTERACTIVE):
+        # Queue function(request, *args); returns (request, coalesced)
+        with self.lock:
+            existing = self.in_flight.get(key) if key else None
+            if existing is not None and not existing.cancelled:
+                existing.duplicates += 1
+                return existing, True
+            request = ScheduledRequest(kind, key, priority, settings, function, args)
+            if key:
+                self.in_flight[key] = request
+            heapq.heappush(self.queue, (priority, self.sequence, request))
+            self.sequence += 1
+            self.lock.notify_all()
+            return request, False
+    
+    def cancel(self, kind=None):
+        # Cancel queued and running requests of one kind (or all); returns how many were cancelled
+        with self.lock:
+            requests = [entry[2] for entry in self.queue] + self.running
+        cancelled = 0
+        for request in requests:
+            if (kind is None or request.kind == kind) and not request.cancelled:
+                request.cancel()
+                cancelled += 1
+        return cancelled
+    
+    def is_in_flight(self, key):
+        # Whether a request with this key is queued or running (a new submission would be coalesced)
+        with self.lock:
+            request = self.in_flight.get(key)
+            return request is not None and not request.cancelled
+    
+    def pending(self, kind=None):
+        # Queued and running requests of one kind (or all) that have not been cancelled
+        with self.lock:
+            requests = [entry[2] for entry in self.queue] + self.running
+        return sum(1 for request in requests if (kind is None or request.kind == kind) and not request.cancelled)
+    
+    def next_request(self):
+        # Wait for a request this worker may start; None when the pool has shrunk
+        with self.lock:
+            while True:
+                if self.threads > self.workers:
+                    self.threads -= 1
+                    return None
+                if self.queue:
+                    request = self.queue[0][2]
+                    background = sum(1 for running in self.running if running.priority != PRIORITY_INTERACTIVE)
+                    # Cancelled requests start at once so they can report back
+                    if request.priority == PRIORITY_INTERACTIVE or request.cancelled or background < self.workers - 1:
+                        heapq.heappop(self.queue)
+                        self.running.append(request)
+                        request.started_at = time.time()
+                        return request
+                self.lock.wait()
+    
+    def run(self):
+        while True:
+            request = self.next_request()
+            if request is None:
+                return
+            try:
+                request.function(request, *request.args)
+            except Exception:
+                pass  # Request functions report their own errors through the message queue
+            finally:
+                with self.lock:
+                    self.running.remove(request)
+                    if request.key and self.in_flight.get(request.key) is request:
+                        del self.in_flight[request.key]
+                    self.lock.notify_all()
+
+# Request metrics: latency percentiles shown per model
+METRICS_PERCENTILES = (50, 95, 99)
+
+def percentile(sorted_values, percent):
+    # Nearest-rank percentile of an already sorted list
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(percent / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+class RequestMetrics:
+    # Per-request latency and token telemetry, kept as typed columns rather than one dict per request.
+    # Numbers go into compact arrays and the mode and model strings are stored as indexes into a
+    # list of distinct values. Records are appended from worker threads and read on the UI thread.
+    NUMERIC_COLUMNS = (
+        ('timestamp', 'd'), ('queue_wait', 'd'), ('ttft', 'd'), ('latency', 'd'),
+        ('prompt_tokens', 'q'), ('completion_tokens', 'q'), ('cached_tokens', 'q'),
+        ('payload_chars', 'q'), ('cache_hit', 'b')
+    )
+    TEXT_COLUMNS = ('mode', 'model')
+    COLUMNS = ('timestamp', 'mode', 'model', 'queue_wait', 'ttft', 'latency', 'prompt_tokens',
+               'completion_tokens', 'cached_tokens', 'payload_chars', 'cache_hit')
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.columns = {name: array.array(code) for name, code in self.NUMERIC_COLUMNS}
+        for name in self.TEXT_COLUMNS:
+            self.columns[name] = array.array('H')
+        self.values = {name: [] for name in self.TEXT_COLUMNS}  # column -> distinct strings
+        self.codes = {name: {} for name in self.TEXT_COLUMNS}  # column -> string -> index
+    
+    def __len__(self):
+        return len(self.columns['timestamp'])
+    
+    def record(self, **record):
+        # Append one request; a missing TTFT (non-streamed reply) is stored as NaN
+        with self.lock:
+            for name, code in self.NUMERIC_COLUMNS:
+                value = record.get(name)
+                if code == 'd':
+                    value = float('nan') if value is None else float(value)
+                else:
+                    value = int(value or 0)
+                self.columns[name].append(value)
+            for name in self.TEXT_COLUMNS:
+                value = record[name]
+                index = self.codes[name].get(value)
+                if index is None:
+                    index = self.codes[name][value] = len(self.values[name])
+                    self.values[name].append(value)
+                self.columns[name].append(index)
+    
+    def rows(self):
+        # Every request as a dict, oldest first
+        with self.lock:
+            count = len(self)
+            columns = {name: column[:count] for name, column in self.columns.items()}
+            values = {name: list(strings) for name, strings in self.values.items()}
+        for i in range(count):
+            row = {}
+            for name in self.COLUMNS:
+                value = columns[name][i]
+                if name in values:
+                    value = values[name][value]
+                elif isinstance(value, float) and math.isnan(value):
+                    value = None
+                row[name] = value
+            row['timestamp'] = datetime.datetime.fromtimestamp(row['timestamp']).isoformat(timespec='milliseconds')
+            row['cache_hit'] = bool(row['cache_hit'])
+            yield row
+    
+    def export_jsonl(self, path):
+        # Write one JSON object per request; returns the number written
+        count = 0
+        with open(path, 'w', encoding='utf-8') as f:
+            for row in self.rows():
+                f.write(json.dumps(row) + "\n")
+                count += 1
+        return count
+    
+    def export_csv(self, path):
+        # Write one CSV row per request; returns the number written
+        count = 0
+        with open(path, 'w', encoding='utf-8', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=self.COLUMNS)
+            writer.writeheader()
+            for row in self.rows():
+                writer.writerow(row)
+                count += 1
+        return count
+    
+    def summary_by_model(self):
+        # model -> request count, latency and TTFT percentiles (seconds) and output tokens per second.
+        # Response cache hits are left out, since they never reach the API
+        with self.lock:
+            count = len(self)
+            models = list(self.values['model'])
+            model_codes = self.columns['model'][:count]
+            cache_hits = self.columns['cache_hit'][:count]
+            latencies = self.columns['latency'][:count]
+            ttfts = self.columns['ttft'][:count]
+            completion_tokens = self.columns['completion_tokens'][:count]
+        
+        grouped = {}
+        for i in range(count):
+            if cache_hits[i]:
+                continue
+            group = grouped.setdefault(models[model_codes[i]], {'latency': [], 'ttft': [], 'tokens': 0, 'seconds': 0.0})
+            group['latency'].append(latencies[i])
+            if not math.isnan(ttfts[i]):
+                group['ttft'].append(ttfts[i])
+            if completion_tokens[i]:
+                # Generation time excludes the wait for the first token when it is known
+                group['tokens'] += completion_tokens[i]
+                group['seconds'] += latencies[i] - (0.0 if math.isnan(ttfts[i]) else ttfts[i])
+        
+        summary = {}
+        for model_name, group in grouped.items():
+            latency = sorted(group['latency'])
+            ttft = sorted(group['ttft'])
+            summary[model_name] = {
+                'requests': len(latency),
+                'latency': [percentile(latency, p) for p in METRICS_PERCENTILES],
+                'ttft': [percentile(ttft, p) for p in METRICS_PERCENTILES],
+                'tokens_per_second': group['tokens'] / group['seconds'] if group['seconds'] > 0 else None
+            }
+        return summary
+
+# Friendlier messages for common API errors
+def describe_api_error(error):
+    error_msg = str(error)
+    if "max_tokens" in error_msg and "gpt-5" in error_msg.lower():
+        return "GPT-5 model error: This model uses 'max_completion_tokens' instead of 'max_tokens'. Please try again."
+    if "unsupported parameter" in error_msg:
+        return f"Model parameter error: {error_msg}. This may be a model-specific issue."
+    if "temperature" in error_msg.lower():
+        return f"Temperature error: {error_msg}. Try adjusting the temperature in Settings."
+    return error_msg
+
+class EditEngine:
+    # The AI request pipeline, with no UI: builds edit and chat requests, sends them through the
+    # pooled API client with rate limiting, retries and the response cache, strips code fences and
+    # applies the edit protocols, and records metrics and the usage ledger. The editor window and
+    # the command line both run requests through it; progress is reported through callbacks.
+    def __init__(self, api_key, api_backend='threads', rate_limits=None, token_calibration=None,
+                 model_pricing=None, log=None, on_usage=None):
+        # log(message, level) receives the debug log; on_usage(tokens, model) is called for the tokens
+        # of each edit or chat reply (edit_file leaves usage to its caller). Both may be called from any thread
+        self.log = log or (lambda message, level="INFO": None)
+        self.on_usage = on_usage or (lambda tokens, model_name: None)
+        self.model_pricing = model_pricing if model_pricing is not None else dict(DEFAULT_MODEL_PRICING)
+        
+        # OpenAI client - one pooled client, rebuilt only when the key or backend changes. It is created
+        # by ensure_client() on the first request (or earlier, to warm up), so building an engine
+        # doesn't import the OpenAI SDK
+        self.client = None
+        self.async_client = None
+        self.client_lock = threading.Lock()
+        self.connection_stats = ConnectionStats()
+        self.rate_limiter = RateLimiter(rate_limits or {})
+        self.setup_api_client(api_key, api_backend)
+        
+        # Local token estimates for pre-flight request sizing
+        self.token_estimator = TokenEstimator(token_calibration or {})
+        
+        # Cache for responses to identical requests
+        self.response_cache = None
+        try:
+            self.response_cache = ResponseCache(os.path.join(APP_DATA_DIR, "response_cache.sqlite3"))
+        except (sqlite3.Error, OSError):
+            pass  # Requests simply aren't cached
+        
+        # Token usage of every request across sessions, for spend per day, project and model
+        self.usage_ledger = None
+        try:
+            self.usage_ledger = UsageLedger(os.path.join(APP_DATA_DIR, "usage_ledger.sqlite3"))
+        except (sqlite3.Error, OSError):
+            pass  # Only the usage of this process is tracked
+        
+        # Per-request latency and token telemetry, and the cost of the requests made so far
+        self.request_metrics = RequestMetrics()
+        self.session_cost = 0.0  # priced from each request's input/output split
+        self.session_cost_lock = threading.Lock()
+    
+    def setup_api_client(self, api_key, api_backend):
+        # Use a new key and backend; the previous client is closed and the next request creates a new one
+        with self.client_lock:
+            self.api_key = api_key
+            self.api_backend = api_backend
+            old_clients = (self.client, self.async_client)
+            self.client = None
+            self.async_client = None
+        
+        # Close the old pool once requests that are still using it have finished with it
+        for client in old_clients:
+            if client is not None:
+                timer = threading.Timer(60.0, client.close)
+                timer.daemon = True  # never keeps the process alive on exit
+                timer.start()
+    
+    def ensure_client(self):
+        # Create the API client for the current key and backend unless it exists (any thread)
+        with self.client_lock:
+            if self.api_key and self.client is None and self.async_client is None:
+                if self.api_backend == 'async':
+                    self.async_client = AsyncModelClient(self.api_key, self.connection_stats, self.rate_limiter)
+                else:
+                    self.client = make_openai_client(self.api_key, self.connection_stats, self.rate_limiter)
+    
+    def record_usage(self, api_params, request, usage):
+        # Price a completed API call from its input/output split, add it to the session cost and
+        # append it to the usage ledger (called from worker threads)
+        if usage is None:
+            return
+        model_name = api_params["model"]
+        prompt_tokens = getattr(usage, 'prompt_tokens', 0) or 0
+        completion_tokens = getattr(usage, 'completion_tokens', 0) or 0
+        cached_tokens = getattr(getattr(usage, 'prompt_tokens_details', None), 'cached_tokens', 0) or 0
+        with self.session_cost_lock:
+            self.session_cost += usage_cost(self.model_pricing, model_name, prompt_tokens, completion_tokens, cached_tokens)
+        if self.usage_ledger is not None:
+            try:
+                self.usage_ledger.record(model_name, request.kind, request.settings.project_folder,
+                                         prompt_tokens, completion_tokens, cached_tokens)
+            except sqlite3.Error as e:
+                self.log(f"⚠️ Could not write to the usage ledger: {str(e)}", "WARNING")
+    
+    def calculate_estimated_cost(self):
+        # Cost of the requests made so far, each priced from its own input/output split
+        with self.session_cost_lock:
+            return self.session_cost
+    
+    def estimate_request(self, messages, settings, expected_output, protocol='full'):
+        # Pre-flight estimate: prompt tokens, output tokens to reserve, projected cost and context headroom.
+        # Auto sizing only raises the output limit above the configured max tokens (a short file can still
+        # get a long reply); only search/replace replies, which never repeat the file, may get less
+        model_name = settings.model
+        prompt_tokens = self.token_estimator.count_messages(messages, model_name)
+        context_window, max_output, reasoning = lookup_model_setting(MODEL_LIMITS, model_name, DEFAULT_MODEL_LIMITS)
+        if settings.auto_max_tokens:
+            output_tokens = int(expected_output * OUTPUT_TOKEN_MARGIN) + (REASONING_TOKEN_ALLOWANCE if reasoning else 0)
+            if protocol != 'search_replace':
+                output_tokens = max(output_tokens, settings.max_tokens)
+            output_tokens = min(max(MIN_OUTPUT_TOKENS, output_tokens), max_output,
+                                max(MIN_OUTPUT_TOKENS, context_window - prompt_tokens))
+        else:
+            output_tokens = settings.max_tokens
+        return {
+            "prompt_tokens": prompt_tokens,
+            "expected_output": expected_output,
+            "output_tokens": output_tokens,
+            "cost": usage_cost(self.model_pricing, model_name, prompt_tokens, expected_output),
+            "context_window": context_window,
+            "headroom": context_window - prompt_tokens - expected_output
+        }
+    
+    def expected_output_tokens(self, protocol, content, model_name):
+        # Expected reply length: the whole file for full edits, a fraction of it for search/replace
+        if protocol == 'chat':
+            return 1500
+        content_tokens = self.token_estimator.count_text(content, model_name)
+        if protocol == 'search_replace':
+            return min(max(1024, content_tokens // 8), 4096)
+        return int(content_tokens * 1.1) + 256
+    
+    def combine_estimates(self, estimates):
+        # Totals for requests sent together (parallel edits); headroom is that of the fullest request
+        return {
+            "prompt_tokens": sum(e['prompt_tokens'] for e in estimates),
+            "expected_output": sum(e['expected_output'] for e in estimates),
+            "output_tokens": max(e['output_tokens'] for e in estimates),
+            "cost": sum(e['cost'] for e in estimates),
+            "context_window": estimates[0]['context_window'],
+            "headroom": min(e['headroom'] for e in estimates),
+            "sections": len(estimates)
+        }
+    
+    def format_estimate(self, estimate):
+        free = max(0.0, estimate['headroom'] / estimate['context_window'] * 100)
+        return (f"~{estimate['prompt_tokens']:,} prompt + ~{estimate['expected_output']:,} output tokens, "
+                f"est. ${estimate['cost']:.4f}, {free:.0f}% context free")
+    
+    def log_prompt_estimate(self, estimate):
+        # Log size warnings from the token estimate rather than character counts
+        if estimate['prompt_tokens'] > LARGE_PROMPT_TOKENS:
+            self.log(f"⚠️ Large request: ~{estimate['prompt_tokens']:,} prompt tokens - this will use significant tokens", "WARNING")
+        elif estimate['prompt_tokens'] > LARGE_PROMPT_TOKENS // 2:
+            self.log(f"📊 Medium request: ~{estimate['prompt_tokens']:,} prompt tokens - moderate token usage expected", "INFO")
+    
+    def record_prompt_usage(self, model_name, estimate, usage):
+        # Compare the estimate with the reported prompt tokens and calibrate the estimator
+        prompt_tokens = getattr(usage, 'prompt_tokens', None) if usage else None
+        if not prompt_tokens:
+            return
+        self.token_estimator.calibrate(model_name, estimate['prompt_tokens'], prompt_tokens)
+        family = self.token_estimator.family_for(model_name)
+        self.log(f"Prompt tokens: ~{estimate['prompt_tokens']:,} estimated, {prompt_tokens:,} actual "
+                 f"(calibration {self.token_estimator.calibration[family]:.3f} for {family})", "INFO")
+    
+    def log_api_request(self, model, temperature, max_tokens, message_count, prompt_length):
+        # Log API request details
+        self.log(f"API Request - Model: {model}, Temp: {temperature}, Max Tokens: {max_tokens}", "API")
+        self.log(f"Request Details - Messages: {message_count}, Prompt Length: {prompt_length} chars", "REQUEST")
+    
+    def log_api_response(self, response_time, token_usage, model_used, ttft=None, cached=False):
+        # Log API response details
+        ttft_info = f", TTFT: {ttft:.2f}s" if ttft is not None else ""
+        if cached:
+            self.log(f"API Response (cache hit) - Time: {response_time * 1000:.1f}ms, Tokens: 0 (cached), Model: {model_used}", "RESPONSE")
+        else:
+            self.log(f"API Response - Time: {response_time:.2f}s{ttft_info}, Tokens: {token_usage}, Model: {model_used}", "RESPONSE")
+    
+    def plan_edit(self, prompt, content, file_path, settings):
+        # Pick the edit protocol and build the request for it
+        # Returns (protocol, user message, text the AI will rewrite, plan) where plan is (chunks, targets)
+        # for chunked edits and the per-section requests for parallel edits
+        protocol = settings.edit_protocol
+        line_count = content.count('\n')
+        if protocol == 'parallel' or (protocol == 'auto' and line_count >= CHUNK_EDIT_MIN_LINES and is_whole_file_prompt(prompt)):
+            sections = build_section_edit_messages(content, file_path, prompt)
+            if len(sections) > 1:
+                return 'parallel', f"Current file content:\n{content}\n\nUser request: {prompt}", content, sections
+            protocol = 'auto'
+        if protocol in ('auto', 'chunked') and (protocol == 'chunked' or line_count >= CHUNK_EDIT_MIN_LINES):
+            chunks = split_code_chunks(content, file_path)
+            targets = select_target_chunks(content, chunks, prompt)
+            if targets and targets[0] != 0 and chunks[0][1] - chunks[0][0] < CHUNK_HEADER_MAX_LINES:
+                targets.insert(0, 0)
+            target_lines = sum(chunks[index][1] - chunks[index][0] + 1 for index in targets)
+            # Chunking only pays off when the prompt is about a small part of the file
+            if targets and len(chunks) > 1 and target_lines <= len(content.splitlines()) // 2:
+                lines = content.splitlines(keepends=True)
+                edit_text = "".join("".join(lines[chunks[index][0] - 1:chunks[index][1]]) for index in targets)
+                return 'chunked', build_chunk_edit_message(content, chunks, targets, prompt), edit_text, (chunks, targets)
+            protocol = 'auto'
+        if protocol == 'auto':
+            protocol = 'search_replace' if len(content) > SEARCH_REPLACE_MIN_CHARS else 'full'
+        return protocol, f"Current file content:\n{content}\n\nUser request: {prompt}", content, None
+    
+    def build_edit_messages(self, user_message, file_path, protocol, history=()):
+        # Messages for an edit request: system prompt for the protocol, conversation history, then the request
+        if protocol == 'parallel':
+            system_message = f"""You are an expert code editor. You will receive an outline of a large file, one section of it, and a user request that applies across the whole file. The other sections are being edited separately.
+
+File: {file_path}
+
+Apply the request to this section only and provide ONLY the complete edited section. Do not include explanations, markdown formatting, or any other text - just the code that should replace the section.
+
+Rules:
+- Do not add code that belongs before or after this section (for example imports at the top of the file) unless it is part of this section
+- Keep the indentation of the section as it is in the file
+- If nothing in this section needs to change, return it unchanged"""
+        elif protocol == 'chunked':
+            system_message = f"""You are an expert code editor. You will receive an outline of a large file, the full text of the sections of it that are relevant to the user's request, and the request itself.
+
+File: {file_path}
+
+Return every section you change in exactly this format:
+
+<<<<<<< SECTION n
+(the complete new text of section n)
+>>>>>>> END
+
+Rules:
+- Only the sections shown in full can be changed; use the outline to understand the rest of the file
+- Return the complete text of each changed section, not just the changed lines
+- Leave out sections that need no changes
+- Keep the indentation of each section as it is in the file
+- Do not include explanations or any other text outside the blocks
+
+IMPORTANT: Always work with the CURRENT content that is provided. Make incremental changes based on the existing code."""
+        elif protocol == 'search_replace':
+            system_message = f"""You are an expert code editor. You will receive a file path and current content, along with a user prompt describing what changes to make.
+
+File: {file_path}
+
+Describe your changes as one or more SEARCH/REPLACE blocks in exactly this format:
+
+<<<<<<< SEARCH
+(lines copied exactly from the current content)
+=======
+(the lines that should replace them)
+>>>>>>> REPLACE
+
+Rules:
+- Each SEARCH section must match the current content exactly, including indentation and comments
+- Include just enough surrounding lines to make each SEARCH section unique in the file
+- Keep blocks small and use several blocks for changes in different places
+- To delete code, leave the REPLACE section empty
+- Do not include explanations or any other text outside the blocks
+
+IMPORTANT: Always work with the CURRENT content that is provided. Do not start from scratch unless explicitly requested. Make incremental changes based on the existing code."""
+        else:
+            # Code editing mode - edit the code
+            system_message = f"""You are an expert code editor. You will receive a file path and current content, along with a user prompt describing what changes to make.
+
+File: {file_path}
+
+Please provide ONLY the edited code content. Do not include explanations, markdown formatting, or any other text - just the pure code that should replace the current content.
+
+If the user wants to add new functionality, modify existing code, fix bugs, or make any other changes, implement them directly in the code you return.
+
+IMPORTANT: Always work with the CURRENT content that is provided. Do not start from scratch unless explicitly requested. Make incremental changes based on the existing code."""
+        
+        # Build messages array with conversation history
+        messages = [{"role": "system", "content": system_message}]
+        
+        # Add conversation history if this isn't the first prompt (sections of a parallel edit are independent)
+        if protocol != 'parallel':
+            messages.extend(history)
+        
+        # Add current file content and user prompt
+        messages.append({
+            "role": "user",
+            "content": user_message
+        })
+        return messages
+    
+    def edit(self, request, prompt, current_content, file_path, planned=None, history=(),
+             on_code=None, on_first_token=None, on_progress=None):
+        # Edit a file's content with the protocol plan_edit() picks (or the given plan), falling back to
+        # a simpler protocol when a patch can't be applied; returns the edited content
+        # on_code and on_first_token are passed to request_ai_edit, on_progress(done, total) gets
+        # the progress of parallel edits
+        
+        # The edit protocol - chunks and search/replace blocks keep requests small for large files
+        if planned is None:
+            planned = self.plan_edit(prompt, current_content, file_path, request.settings)
+        protocol, user_message, edit_text, chunk_plan = planned
+        
+        if protocol == 'parallel':
+            edited_content = self.run_parallel_edit(request, file_path, chunk_plan, on_progress)
+        
+        if protocol == 'chunked':
+            chunks, targets = chunk_plan
+            names = ", ".join(chunks[index][2][:40] for index in targets)
+            self.log(f"Chunked edit: sending {len(targets)} of {len(chunks)} chunks "
+                     f"({len(edit_text)} of {len(current_content)} chars): {names}", "INFO")
+            ai_response, edited_content = self.request_ai_edit(request, user_message, edit_text, file_path, protocol,
+                                                               history, on_code, on_first_token)
+            try:
+                edited_content, replaced = apply_chunk_edits(current_content, chunks, targets, ai_response)
+                self.log(f"Spliced {replaced} edited chunks back into the file", "INFO")
+            except PatchApplyError as e:
+                protocol = 'search_replace' if len(current_content) > SEARCH_REPLACE_MIN_CHARS else 'full'
+                self.log(f"⚠️ Chunked edit failed: {e} - falling back to {protocol}", "WARNING")
+                user_message = f"Current file content:\n{current_content}\n\nUser request: {prompt}"
+        
+        if protocol == 'search_replace':
+            ai_response, edited_content = self.request_ai_edit(request, user_message, current_content, file_path, protocol,
+                                                               history, on_code, on_first_token)
+            try:
+                blocks = parse_search_replace_blocks(ai_response)
+                edited_content, match_counts = apply_search_replace_blocks(current_content, blocks)
+                anchors = ", ".join(f"{count} {kind}" for kind, count in match_counts.items() if count)
+                self.log(f"Applied {len(blocks)} search/replace blocks ({anchors})", "INFO")
+            except PatchApplyError as e:
+                self.log(f"⚠️ Search/replace patch failed: {e} - falling back to full regeneration", "WARNING")
+                protocol = 'full'
+        
+        if protocol == 'full':
+            ai_response, edited_content = self.request_ai_edit(request, user_message, current_content, file_path, protocol,
+                                                               history, on_code, on_first_token)
+        
+        return edited_content
+    
+    def request_ai_edit(self, request, user_message, current_content, file_path, protocol, history,
+                        on_code=None, on_first_token=None):
+        # Make one edit request using the given protocol ('full' or 'search_replace')
+        # Returns the raw AI response and, for full edits, the code with any fence removed
+        # on_code(text) gets the code of a full edit as it streams in; on_first_token(ttft, streams_code)
+        # is called when the reply starts
+        start_time = datetime.datetime.now()
+        messages = self.build_edit_messages(user_message, file_path, protocol, history)
+        
+        # Log API request details
+        settings = request.settings
+        model_name = settings.model
+        prompt_length = len(user_message)
+        self.log(f"Edit protocol: {protocol}", "REQUEST")
+        
+        # Size the request from local token estimates
+        estimate = self.estimate_request(messages, settings,
+                                         self.expected_output_tokens(protocol, current_content, model_name), protocol)
+        self.log_prompt_estimate(estimate)
+        
+        self.log_api_request(
+            model=model_name,
+            temperature=settings.temperature,
+            max_tokens=estimate['output_tokens'],
+            message_count=len(messages),
+            prompt_length=prompt_length
+        )
+        
+        # Build API parameters based on model and user settings
+        api_params = self.build_api_params(messages, settings, estimate['output_tokens'])
+        
+        # Log the actual API call
+        self.log(f"Making API call with parameters: {describe_api_params(api_params)}", "API")
+        
+        # Strip the markdown code fence wrapper (if any) as the response is read
+        fence_stripper = CodeFenceStripper()
+        
+        if protocol == 'full':
+            # Pass the edited code on as tokens arrive
+            def on_delta(delta):
+                code_text = fence_stripper.feed(delta)
+                if code_text and on_code:
+                    on_code(code_text)
+        else:
+            # Search/replace blocks are applied once the response is complete
+            def on_delta(delta):
+                pass
+        
+        def on_reply_start(ttft):
+            if on_first_token:
+                on_first_token(ttft, protocol == 'full')
+        
+        ai_response, usage, ttft, cached = self.call_model(api_params, request, start_time, on_delta, on_reply_start)
+        if protocol == 'full':
+            code_text = fence_stripper.finish()
+            if code_text and on_code:
+                on_code(code_text)
+        
+        ai_response = ai_response.strip()
+        
+        # Calculate response time
+        end_time = datetime.datetime.now()
+        response_time = (end_time - start_time).total_seconds()
+        
+        # Log API response details
+        token_usage = usage.total_tokens if usage else "Unknown"
+        self.log_api_response(response_time, token_usage, model_name, ttft, cached)
+        self.record_prompt_usage(model_name, estimate, usage)
+        
+        # Track token usage if available
+        if usage and hasattr(usage, 'total_tokens'):
+            self.on_usage(usage.total_tokens, model_name)
+        
+        # Log response summary
+        self.log(f"AI Response Length: {len(ai_response)} characters", "RESPONSE")
+        
+        if protocol != 'full':
+            return ai_response, None
+        
+        # Code editing mode - replace code content
+        if fence_stripper.fenced:
+            self.log("Removed markdown code blocks from response", "INFO")
+        return ai_response, fence_stripper.text
+    
+    def run_parallel_edit(self, request, file_path, sections, on_progress=None):
+        # Edit the sections of one file concurrently on a bounded worker pool and put them back together in order
+        # (a pool of its own - sections waiting on scheduler workers held by their parent request could deadlock)
+        start_time = time.time()
+        workers = max(1, min(request.settings.parallel_workers, len(sections)))
+        self.log(f"Parallel edit: {len(sections)} sections of {os.path.basename(file_path)} on {workers} workers", "INFO")
+        if on_progress:
+            on_progress(0, len(sections))
+        
+        results = [None] * len(sections)
+        failures = 0
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(self.request_section_edit, request, file_path, number, len(sections), section): number
+                       for number, section in enumerate(sections)}
+            for done, future in enumerate(as_completed(futures), 1):
+                number = futures[future]
+                start, end = sections[number][:2]
+                try:
+                    results[number] = future.result()
+                except RequestCancelled:
+                    failures += 1
+                except Exception as e:
+                    failures += 1
+                    self.log(f"⚠️ Section {number + 1}/{len(sections)} (lines {start}-{end}) failed: {str(e)} - left unchanged", "WARNING")
+                if on_progress:
+                    on_progress(done, len(sections))
+        
+        request.check_cancelled()
+        if failures == len(sections):
+            raise Exception(f"All {len(sections)} sections of the parallel edit failed - see the log")
+        
+        # Reassemble in order, keeping failed sections as they were
+        parts = []
+        total_tokens = 0
+        model_name = request.settings.model
+        for section, result in zip(sections, results):
+            if result is None:
+                parts.append(section[3])
+                continue
+            text, usage, estimate = result
+            parts.append(text)
+            self.record_prompt_usage(model_name, estimate, usage)
+            if usage and hasattr(usage, 'total_tokens'):
+                total_tokens += usage.total_tokens
+                self.on_usage(usage.total_tokens, model_name)
+        
+        self.log(f"Parallel edit finished: {len(sections) - failures}/{len(sections)} sections in "
+                 f"{time.time() - start_time:.2f}s, {total_tokens:,} tokens", "RESPONSE")
+        return "".join(parts)
+    
+    def request_section_edit(self, request, file_path, number, count, section):
+        # Edit one section of a parallel edit; runs on a pool worker
+        # Returns (edited section text, usage, estimate)
+        start, end, user_message, text = section
+        start_time = datetime.datetime.now()
+        model_name = request.settings.model
+        messages = self.build_edit_messages(user_message, file_path, 'parallel')
+        estimate = self.estimate_request(messages, request.settings, self.expected_output_tokens('full', text, model_name))
+        api_params = self.build_api_params(messages, request.settings, estimate['output_tokens'])
+        
+        fence_stripper = CodeFenceStripper()
+        ai_response, usage, ttft, cached = self.call_model(api_params, request, start_time, fence_stripper.feed)
+        fence_stripper.finish()
+        edited = fence_stripper.text
+        if not edited.strip() and text.strip():
+            raise PatchApplyError("empty response")
+        
+        # Keep the section's trailing newlines so sections join up as before
+        edited = edited.rstrip('\n') + '\n' * (len(text) - len(text.rstrip('\n')))
+        
+        response_time = (datetime.datetime.now() - start_time).total_seconds()
+        tokens = f"{usage.total_tokens:,} tokens" if usage else ("cached" if cached else "tokens unknown")
+        self.log(f"Section {number + 1}/{count} (lines {start}-{end}): {response_time:.2f}s"
+                 f"{f', TTFT {ttft:.2f}s' if ttft is not None else ''}, {tokens}", "RESPONSE")
+        return edited, usage, estimate
+    
+    def edit_file(self, request, prompt, file_path):
+        # Edit one file on disk as a standalone request (no conversation history, nothing is written)
+        # Returns a dict with the status ('ready' or 'unchanged'), original and edited content, the diff,
+        # tokens, seconds and the protocol that produced the edit
+        request.check_cancelled()
+        start_time = datetime.datetime.now()
+        settings = request.settings
+        model_name = settings.model
+        with open(file_path, 'r', encoding='utf-8') as f:
+            content = f.read()
+        
+        protocol, user_message, edit_text, plan = self.plan_edit(prompt, content, file_path, settings)
+        if protocol == 'parallel':
+            # Files already run in parallel - edit each one with a single request
+            protocol = 'search_replace' if len(content) > SEARCH_REPLACE_MIN_CHARS else 'full'
+        total_tokens = 0
+        while True:
+            messages = self.build_edit_messages(user_message, file_path, protocol)
+            estimate = self.estimate_request(messages, settings, self.expected_output_tokens(protocol, edit_text, model_name),
+                                             protocol)
+            api_params = self.build_api_params(messages, settings, estimate['output_tokens'])
+            ai_response, usage, ttft, cached = self.call_model(api_params, request, start_time, lambda delta: None)
+            self.record_prompt_usage(model_name, estimate, usage)
+            if usage and hasattr(usage, 'total_tokens'):
+                total_tokens += usage.total_tokens
+            try:
+                edited = self.apply_edit_response(protocol, content, ai_response, plan)
+                break
+            except PatchApplyError as e:
+                if protocol == 'full':
+                    raise
+                self.log(f"⚠️ Edit of {os.path.basename(file_path)}: {protocol} patch failed ({e}) - retrying as full edit", "WARNING")
+                protocol = 'full'
+                user_message = f"Current file content:\n{content}\n\nUser request: {prompt}"
+                edit_text = content
+        
+        seconds = (datetime.datetime.now() - start_time).total_seconds()
+        diff = list(difflib.unified_diff(content.splitlines(), edited.splitlines(),
+                                         os.path.basename(file_path), os.path.basename(file_path), lineterm=""))
+        return {"status": "ready" if diff else "unchanged", "original": content, "edited": edited,
+                "diff": diff, "tokens": total_tokens, "seconds": seconds, "protocol": protocol}
+    
+    def apply_edit_response(self, protocol, content, ai_response, plan=None):
+        # Turn an AI edit response into the new file content; raises PatchApplyError if it can't be applied
+        if protocol == 'chunked':
+            chunks, targets = plan
+            return apply_chunk_edits(content, chunks, targets, ai_response)[0]
+        if protocol == 'search_replace':
+            return apply_search_replace_blocks(content, parse_search_replace_blocks(ai_response))[0]
+        fence_stripper = CodeFenceStripper()
+        fence_stripper.feed(ai_response)
+        fence_stripper.finish()
+        edited = fence_stripper.text
+        if not edited.strip() and content.strip():
+            raise PatchApplyError("empty response")
+        if content.endswith('\n') and not edited.endswith('\n'):
+            edited += '\n'
+        return edited
+    
+    def build_chat_messages(self, message, file_context, project_context="", history=()):
+        # Messages for a chat request: system prompt (with any file and project context), conversation history, then the message
+        # Build system message for chat
+        if file_context:
+            system_message = f"""You are an expert programming assistant and code reviewer. You will receive user messages asking questions or seeking advice.
+
+Current File Context:
+{file_context}
+
+Please provide helpful, informative responses about programming concepts, code, or any questions the user asks. You can:
+- Explain how the current code works
+- Suggest improvements to the code
+- Answer programming questions
+- Provide code examples
+- Give best practice advice
+- Help debug issues
+
+You can reference and discuss the attached file content. Be conversational, helpful, and provide practical guidance."""
+        else:
+            system_message = """You are an expert programming assistant and code reviewer. You will receive user messages asking questions or seeking advice.
+
+Please provide helpful, informative responses about programming concepts, code, or any questions the user asks. You can:
+- Answer programming questions
+- Provide code examples
+- Give best practice advice
+- Help debug issues
+- Explain programming concepts
+
+Be conversational, helpful, and provide practical guidance."""
+        
+        # Attach snippets retrieved from the project index
+        if project_context:
+            system_message += f"""
+
+Relevant Project Snippets (found by keyword search over the project folder, may be incomplete):
+{project_context}"""
+        
+        # Build messages array with conversation history
+        messages = [{"role": "system", "content": system_message}]
+        
+        # Add conversation history if this isn't the first message
+        messages.extend(history)
+        
+        # Add current user message
+        messages.append({"role": "user", "content": message})
+        return messages
+    
+    def chat(self, request, message, messages, on_delta, on_first_token=None):
+        # Send a chat request built by build_chat_messages(), passing the reply to on_delta as it
+        # streams in; returns the whole reply
+        start_time = datetime.datetime.now()
+        
+        # Log API request details
+        settings = request.settings
+        model_name = settings.model
+        prompt_length = len(messages[0]["content"]) + len(message)
+        
+        # Size the request from local token estimates
+        estimate = self.estimate_request(messages, settings, self.expected_output_tokens('chat', message, model_name))
+        self.log_prompt_estimate(estimate)
+        
+        self.log_api_request(
+            model=model_name,
+            temperature=settings.temperature,
+            max_tokens=estimate['output_tokens'],
+            message_count=len(messages),
+            prompt_length=prompt_length
+        )
+        
+        # Build API parameters based on model and user settings
+        api_params = self.build_api_params(messages, settings, estimate['output_tokens'])
+        
+        # Log the actual API call
+        self.log(f"Making chat API call with parameters: {describe_api_params(api_params)}", "API")
+        
+        ai_response, usage, ttft, cached = self.call_model(api_params, request, start_time, on_delta, on_first_token)
+        
+        # Calculate response time
+        end_time = datetime.datetime.now()
+        response_time = (end_time - start_time).total_seconds()
+        
+        # Get the response
+        ai_response = ai_response.strip()
+        
+        # Log API response details
+        token_usage = usage.total_tokens if usage else "Unknown"
+        self.log_api_response(response_time, token_usage, model_name, ttft, cached)
+        self.record_prompt_usage(model_name, estimate, usage)
+        
+        # Track token usage if available
+        if usage and hasattr(usage, 'total_tokens'):
+            self.on_usage(usage.total_tokens, model_name)
+        
+        # Log response summary
+        self.log(f"Chat Response Length: {len(ai_response)} characters", "RESPONSE")
+        
+        return ai_response
+    
+    def build_api_params(self, messages, settings, output_tokens):
+        # Chat completion parameters for the model and user settings
+        api_params = {
+            "model": settings.model,
+            "messages": messages,
+            "temperature": settings.temperature
+        }
+        
+        # GPT-5 uses max_completion_tokens, others use max_tokens
+        if settings.model.startswith('gpt-5'):
+            api_params["max_completion_tokens"] = output_tokens
+        else:
+            api_params["max_tokens"] = output_tokens
+        return api_params
+    
+    def get_response_cache_key(self, api_params, cache_policy):
+        # Cache key for a request, or None if the cache policy doesn't allow caching it
+        if self.response_cache is None or cache_policy == 'off':
+            return None
+        if cache_policy == 'deterministic' and api_params.get('temperature') != 0:
+            return None
+        return ResponseCache.make_key(api_params)
+    
+    def call_model(self, api_params, request, start_time, on_delta, on_first_token=None):
+        # Get a completion, passing the text to on_delta as it arrives (streamed or all at once)
+        # Identical requests are answered from the response cache when the cache policy allows it
+        # Returns the response text, the usage block, the time to first token and whether it was a cache hit
+        # Raises RequestCancelled if the request is cancelled before the response is complete
+        request.check_cancelled()
+        cache_key = self.get_response_cache_key(api_params, request.settings.cache_policy)
+        if cache_key:
+            cached = self.response_cache.get(cache_key)
+            if cached is not None:
+                ai_response, saved_tokens = cached
+                ttft = (datetime.datetime.now() - start_time).total_seconds()
+                self.log(f"Response cache HIT - saved {saved_tokens} tokens (hits: {self.response_cache.hits}, misses: {self.response_cache.misses})", "INFO")
+                if on_first_token:
+                    on_first_token(ttft)
+                on_delta(ai_response)
+                self.record_request_metrics(api_params, request, start_time, None, ttft, True)
+                return ai_response, None, ttft, True
+            self.log(f"Response cache miss (hits: {self.response_cache.hits}, misses: {self.response_cache.misses})", "INFO")
+        
+        if request.settings.stream:
+            ai_response, usage, ttft = self.stream_completion(api_params, request, start_time, on_delta, on_first_token)
+        else:
+            # Make the API call - a blocking call can't be interrupted, so a cancelled request drops the reply
+            response = self.create_completion(api_params, request)
+            request.check_cancelled()
+            ai_response = response.choices[0].message.content or ""
+            usage = getattr(response, 'usage', None)
+            ttft = None
+            if ai_response:
+                if on_first_token:
+                    on_first_token((datetime.datetime.now() - start_time).total_seconds())
+                on_delta(ai_response)
+        
+        if cache_key and ai_response:
+            self.response_cache.put(cache_key, ai_response, usage.total_tokens if usage else 0)
+        self.record_request_metrics(api_params, request, start_time, usage, ttft, False)
+        self.record_usage(api_params, request, usage)
+        return ai_response, usage, ttft, False
+    
+    def record_request_metrics(self, api_params, request, start_time, usage, ttft, cached):
+        # Add a completed model call to the request metrics (called from worker threads)
+        details = getattr(usage, 'prompt_tokens_details', None)
+        self.request_metrics.record(
+            timestamp=time.time(),
+            mode=request.kind,
+            model=api_params["model"],
+            queue_wait=request.queue_wait,
+            ttft=ttft,
+            latency=(datetime.datetime.now() - start_time).total_seconds(),
+            prompt_tokens=getattr(usage, 'prompt_tokens', 0),
+            completion_tokens=getattr(usage, 'completion_tokens', 0),
+            cached_tokens=getattr(details, 'cached_tokens', 0),
+            payload_chars=sum(len(message["content"]) for message in api_params["messages"]),
+            cache_hit=cached
+        )
+    
+    def stream_completion(self, api_params, request, start_time, on_delta, on_first_token=None):
+        # Make a streaming API call, passing each content delta to on_delta as it arrives
+        # Returns the full response text, the usage block and the time to first token
+        # Cancelling the request closes the connection, which stops generation on the server
+        stream_params = dict(api_params)
+        stream_params["stream"] = True
+        stream_params["stream_options"] = {"include_usage": True}
+        
+        stream = self.create_completion(stream_params, request)
+        
+        parts = []
+        usage = None
+        ttft = None
+        for chunk in stream:
+            if request.cancelled:
+                stream.close()
+                request.check_cancelled()
+            
+            # The final chunk carries token usage and no choices
+            if getattr(chunk, 'usage', None):
+                usage = chunk.usage
+            if not chunk.choices:
+                continue
+            
+            delta = chunk.choices[0].delta.content
+            if not delta:
+                continue
+            
+            if ttft is None:
+                ttft = (datetime.datetime.now() - start_time).total_seconds()
+                self.log(f"Time to first token: {ttft:.2f}s", "RESPONSE")
+                if on_first_token:
+                    on_first_token(ttft)
+            
+            parts.append(delta)
+            on_delta(delta)
+        
+        request.check_cancelled()  # A cancelled async stream just ends
+        return "".join(parts), usage, ttft
+    
+    def create_completion(self, api_params, request):
+        # One chat completion call, throttled to the model's rate limits and retried with backoff on
+        # rate limits, server errors and dropped connections; streamed calls return an iterable of chunks
+        # once the response has started (errors part way through a stream are not retried)
+        model_name = api_params["model"]
+        tokens = (self.token_estimator.count_messages(api_params["messages"], model_name)
+                  + api_params.get("max_completion_tokens", api_params.get("max_tokens", 0)))
+        attempt = 0
+        while True:
+            waited = self.rate_limiter.acquire(model_name, tokens, request.cancel_event)
+            request.check_cancelled()
+            if waited:
+                self.log(f"⏳ Waited {waited:.1f}s to stay within the {model_name} rate limits", "INFO")
+            try:
+                return self.send_completion(api_params, request)
+            except Exception as e:
+                delay = retry_delay(e, attempt)
+                if delay is None or attempt >= RETRY_MAX_ATTEMPTS or request.cancelled:
+                    raise
+                attempt += 1
+                status = getattr(e, 'status_code', None)
+                if status == 429:
+                    self.rate_limiter.pause(model_name, delay)  # Other requests for the model wait too
+                self.rate_limiter.record_retry()
+                self.log(f"⚠️ API {'error ' + str(status) if status else 'connection error'}: {str(e)[:120]} - "
+                         f"retrying in {delay:.1f}s (attempt {attempt}/{RETRY_MAX_ATTEMPTS})", "WARNING")
+                request.cancel_event.wait(delay)
+                request.check_cancelled()
+    
+    def send_completion(self, api_params, request):
+        # Send one chat completion request with the configured backend
+        self.ensure_client()
+        if self.async_client is None:
+            return self.client.chat.completions.create(**api_params)
+        if api_params.get("stream"):
+            stream = self.async_client.stream(api_params)
+            request.add_cancel_callback(stream.close)
+            stream.wait_started()
+            return stream
+        future = self.async_client.create(api_params)
+        request.add_cancel_callback(future.cancel)
+        try:
+            return future.result()
+        except CancelledError:
+            request.check_cancelled()
+            raise
+
 class CodeEditor:
-    def __init__(self, root):
+    def __init__(self, root, profiler=None):
         self.root = root
+        self.profiler = profiler or StartupProfiler()
         self.root.title("OpenAI Based Code Editor by CevAPI")
         self.root.geometry("1200x800")
         
+        # Messages from worker threads to the UI; producers wake the Tk loop, see UIMessageChannel
+        self.message_queue = UIMessageChannel(self.root, self.process_ui_messages)
+        
+        # Debug log records waiting to be written to the Debug Console. Any thread appends
+        # (deque appends are atomic, so producers never take a lock or touch Tk) and the UI
+        # thread writes them in batches when the message channel dispatches, see flush_debug_log
+        self.debug_log_queue = deque()
+        
         # Configuration
         self.config_file = "config.json"
         self.load_config()
+        self.profiler.mark("load config")
         
-        # OpenAI client
-        self.client = None
-        if self.api_key:
-            self.client = openai.OpenAI(api_key=self.api_key)
+        # AI request pipeline: API client, response cache, metrics and usage ledger. Token counts
+        # reported by workers are added to the session totals on the UI thread
+        self.engine = EditEngine(self.api_key, self.api_backend, self.rate_limits, self.token_calibration,
+                                 self.model_pricing, self.add_debug_log,
+                                 lambda tokens, model_name: self.message_queue.put(('token_usage', (tokens, model_name))))
+        self.profiler.mark("create engine")
         
         # Current working directory
         self.current_folder = None
         self.current_file = None
         
-        # Message queue for async operations
-        self.message_queue = queue.Queue()
+        # Lazily loaded file tree state
+        self.tree_generation = 0  # incremented on every refresh so stale scan results are dropped
+        self.tree_unloaded = {}  # folder item id -> placeholder child id, for folders not yet listed
+        self.tree_loading = {}  # the same, for folders queued for listing whose entries haven't arrived yet
+        self.tree_items = {}  # path -> (item id, is_dir) for every node in the tree
+        self.tree_reopen = set()  # folders to expand again after a refresh
+        self.tree_scan_queue = queue.Queue()
+        self.tree_scan_worker = None
+        self.gitignore_matcher = None
+        
+        # Background watcher for changes made outside the editor
+        self.current_file_stat = None  # (mtime_ns, size) of the open file when last read or written
+        self.tree_watcher = DirectoryWatcher(
+            lambda *changes: self.message_queue.put(('tree_changes', changes)),
+            lambda path, stat: self.message_queue.put(('file_changed_on_disk', (path, stat))))
+        
+        # Large-file mode: the open file is a LargeFileBuffer and the editor holds a window of its lines
+        self.large_file = None
+        self.large_file_window = (0, 0)  # [first, last) buffer lines shown in the editor
+        self.large_file_loading = None  # large file being mapped and indexed in the background
+        
+        # State of AI responses that are currently streaming into the editor or chat
+        self.streaming_edit_file = None
+        self.streaming_edit_backup = None
+        self.edit_stream_buffer = StreamBuffer()
+        self.chat_stream_buffer = StreamBuffer()
+        self.chat_streaming = False
+        self.chat_preparing = False  # project snippets for a message are being found
+        self.chat_stream_has_text = False
+        self.stream_frame_scheduled = False
         
         # AI conversation history for maintaining context
-        self.conversation_history = []
+        self.conversation_history = ConversationMemory()
         
         # File history for tracking changes and reverting
-        self.file_history = {}  # file_path -> list of (content, timestamp, description)
+        self.file_history = FileVersionStore(max_versions=20)  # deduplicated, delta-compressed versions per file
+        self.history_folder = None  # project folder of a persistent history store
         self.current_history_index = {}  # file_path -> current position in history
         
+        # Retrieval index over the project folder for chat context
+        self.project_index = ProjectIndex()
+        self.project_indexer = ProjectIndexer(self.project_index, self.on_project_indexed)
+        
+        # Batch edit job started from the file tree (one at a time)
+        self.batch_job = None
+        self.batch_collecting = False
+        
+        # Worker pool for AI requests: one worker per parallel request plus one kept for interactive requests
+        self.request_scheduler = RequestScheduler(self.parallel_edit_workers + 1)
+        
         # Token usage tracking
         self.total_tokens_used = 0
         self.total_requests = 0
         self.session_start_time = datetime.datetime.now()
+        self.profiler.mark("editor state")
         
         self.setup_ui()
-        self.check_queue()
+        self.profiler.mark("build UI")
         
         # Add welcome message to debug console
         self.add_debug_log("=== AI Code Editor Debug Console ===", "SYSTEM")
         self.add_debug_log("Application started successfully", "SYSTEM")
         self.add_debug_log("Debug logging enabled - monitor API calls, requests, and system events", "INFO")
         self.add_debug_log("Token usage tracking enabled - monitor costs in real-time", "INFO")
+        if self.engine.response_cache is None:
+            self.add_debug_log("Response cache unavailable - could not open the cache database", "WARNING")
+        
+        # Report the first frame, then import the OpenAI SDK and create the client in the background
+        self.root.after_idle(self.on_first_idle)
+    
+    def on_first_idle(self):
+        # The window is on screen - end the startup profile and schedule the API client warm-up
+        self.profiler.mark("first frame")
+        self.profiler.total("window ready")
+        self.root.after(CLIENT_WARM_UP_DELAY_MS,
+                        lambda: threading.Thread(target=self.warm_up_engine, daemon=True).start())
+    
+    def warm_up_engine(self):
+        # Import the OpenAI SDK, create the API client and load the tokenizer ahead of the first
+        # request (runs on a background thread)
+        try:
+            self.profiler.measure("import openai (background)", import_openai)
+            self.profiler.measure("API client (background)", self.engine.ensure_client)
+            family = self.engine.token_estimator.family_for(self.model)
+            self.profiler.measure("tokenizer (background)", self.engine.token_estimator.get_counter, family)
+        except Exception as e:
+            self.add_debug_log(f"API client warm-up failed: {str(e)}", "WARNING")
     
     def load_config(self):
         # Load configuration from file
@@ -62,21 +3681,72 @@ class CodeEditor:
                     self.temperature = config.get('temperature', 1.0)
                     self.max_tokens = config.get('max_tokens', 4000)
                     self.max_completion_tokens = config.get('max_completion_tokens', 4000)
-                    self.conversation_memory_limit = config.get('conversation_memory_limit', 10)
+                    self.conversation_token_budget = config.get('conversation_token_budget', 8000)
+                    self.stream_responses = config.get('stream_responses', True)
+                    self.edit_protocol = config.get('edit_protocol', 'auto')
+                    self.tree_ignore_patterns = config.get('tree_ignore_patterns', list(DEFAULT_TREE_IGNORE_PATTERNS))
+                    self.use_gitignore = config.get('use_gitignore', True)
+                    self.tree_watch_interval = config.get('tree_watch_interval', 2.0)
+                    self.persistent_history = config.get('persistent_history', False)
+                    self.response_cache_policy = config.get('response_cache_policy', 'all')
+                    self.auto_max_tokens = config.get('auto_max_tokens', True)
+                    self.token_calibration = config.get('token_calibration', {})
+                    self.project_context_tokens = config.get('project_context_tokens', 3000)
+                    self.parallel_edit_workers = config.get('parallel_edit_workers', 4)
+                    self.api_backend = config.get('api_backend', 'threads')
+                    self.rate_limits = config.get('rate_limits', {})
+                    self.debug_log_max_lines = config.get('debug_log_max_lines', DEBUG_LOG_MAX_LINES)
+                    self.large_file_threshold_mb = config.get('large_file_threshold_mb', LARGE_FILE_THRESHOLD_MB)
+                    self.syntax_highlighting = config.get('syntax_highlighting', True)
+                    self.model_pricing = dict(DEFAULT_MODEL_PRICING, **config.get('model_pricing', {}))
             except:
                 self.api_key = ''
                 self.model = 'gpt-4'
                 self.temperature = 1.0
                 self.max_tokens = 4000
                 self.max_completion_tokens = 4000
-                self.conversation_memory_limit = 10
+                self.conversation_token_budget = 8000
+                self.stream_responses = True
+                self.edit_protocol = 'auto'
+                self.tree_ignore_patterns = list(DEFAULT_TREE_IGNORE_PATTERNS)
+                self.use_gitignore = True
+                self.tree_watch_interval = 2.0
+                self.persistent_history = False
+                self.response_cache_policy = 'all'
+                self.auto_max_tokens = True
+                self.token_calibration = {}
+                self.project_context_tokens = 3000
+                self.parallel_edit_workers = 4
+                self.api_backend = 'threads'
+                self.rate_limits = {}
+                self.debug_log_max_lines = DEBUG_LOG_MAX_LINES
+                self.large_file_threshold_mb = LARGE_FILE_THRESHOLD_MB
+                self.syntax_highlighting = True
+                self.model_pricing = dict(DEFAULT_MODEL_PRICING)
         else:
             self.api_key = ''
             self.model = 'gpt-4'
             self.temperature = 1.0
             self.max_tokens = 4000
             self.max_completion_tokens = 4000
-            self.conversation_memory_limit = 10
+            self.conversation_token_budget = 8000
+            self.stream_responses = True
+            self.edit_protocol = 'auto'
+            self.tree_ignore_patterns = list(DEFAULT_TREE_IGNORE_PATTERNS)
+            self.use_gitignore = True
+            self.tree_watch_interval = 2.0
+            self.persistent_history = False
+            self.response_cache_policy = 'all'
+            self.auto_max_tokens = True
+            self.token_calibration = {}
+            self.project_context_tokens = 3000
+            self.parallel_edit_workers = 4
+            self.api_backend = 'threads'
+            self.rate_limits = {}
+            self.debug_log_max_lines = DEBUG_LOG_MAX_LINES
+            self.large_file_threshold_mb = LARGE_FILE_THRESHOLD_MB
+            self.syntax_highlighting = True
+            self.model_pricing = dict(DEFAULT_MODEL_PRICING)
     
     def save_config(self):
         # Save configuration to file
@@ -87,7 +3757,24 @@ class CodeEditor:
             'temperature': self.temperature,
             'max_tokens': self.max_tokens,
             'max_completion_tokens': self.max_completion_tokens,
-            'conversation_memory_limit': self.conversation_memory_limit
+            'conversation_token_budget': self.conversation_token_budget,
+            'stream_responses': self.stream_responses,
+            'edit_protocol': self.edit_protocol,
+            'tree_ignore_patterns': self.tree_ignore_patterns,
+            'use_gitignore': self.use_gitignore,
+            'tree_watch_interval': self.tree_watch_interval,
+            'persistent_history': self.persistent_history,
+            'response_cache_policy': self.response_cache_policy,
+            'auto_max_tokens': self.auto_max_tokens,
+            'token_calibration': self.engine.token_estimator.calibration,
+            'project_context_tokens': self.project_context_tokens,
+            'parallel_edit_workers': self.parallel_edit_workers,
+            'api_backend': self.api_backend,
+            'rate_limits': self.rate_limits,
+            'debug_log_max_lines': self.debug_log_max_lines,
+            'large_file_threshold_mb': self.large_file_threshold_mb,
+            'syntax_highlighting': self.syntax_highlighting,
+            'model_pricing': self.engine.model_pricing
         }
         with open(self.config_file, 'w') as f:
             json.dump(config, f, indent=2)
@@ -99,7 +3786,7 @@ class CodeEditor:
         # Show the settings panel for model parameters
         settings_window = tk.Toplevel(self.root)
         settings_window.title("AI Model Settings")
-        settings_window.geometry("500x400")
+        settings_window.geometry("520x1000")
         settings_window.transient(self.root)
         settings_window.grab_set()
         
@@ -142,19 +3829,145 @@ class CodeEditor:
         comp_tokens_entry = ttk.Entry(comp_tokens_frame, textvariable=comp_tokens_var, width=10)
         comp_tokens_entry.pack(side=tk.LEFT, padx=(10, 0))
         
-        # Conversation memory limit setting
+        # Automatic output token sizing
+        auto_tokens_frame = ttk.Frame(main_frame)
+        auto_tokens_frame.pack(fill=tk.X, pady=5)
+        ttk.Label(auto_tokens_frame, text="Auto Max Tokens:", width=20).pack(side=tk.LEFT)
+        auto_tokens_var = tk.BooleanVar(value=self.auto_max_tokens)
+        ttk.Checkbutton(auto_tokens_frame, variable=auto_tokens_var).pack(side=tk.LEFT, padx=(10, 0))
+        
+        # Conversation memory token budget setting
         memory_frame = ttk.Frame(main_frame)
         memory_frame.pack(fill=tk.X, pady=5)
-        ttk.Label(memory_frame, text="Conversation Memory:", width=20).pack(side=tk.LEFT)
-        memory_var = tk.IntVar(value=self.conversation_memory_limit)
+        ttk.Label(memory_frame, text="Memory Token Budget:", width=20).pack(side=tk.LEFT)
+        memory_var = tk.IntVar(value=self.conversation_token_budget)
         memory_entry = ttk.Entry(memory_frame, textvariable=memory_var, width=10)
         memory_entry.pack(side=tk.LEFT, padx=(10, 0))
         
+        # Project context budget
+        project_frame = ttk.Frame(main_frame)
+        project_frame.pack(fill=tk.X, pady=5)
+        ttk.Label(project_frame, text="Project Context Tokens:", width=20).pack(side=tk.LEFT)
+        project_var = tk.IntVar(value=self.project_context_tokens)
+        project_entry = ttk.Entry(project_frame, textvariable=project_var, width=10)
+        project_entry.pack(side=tk.LEFT, padx=(10, 0))
+        
+        # Streaming setting
+        stream_frame = ttk.Frame(main_frame)
+        stream_frame.pack(fill=tk.X, pady=5)
+        ttk.Label(stream_frame, text="Stream Responses:", width=20).pack(side=tk.LEFT)
+        stream_var = tk.BooleanVar(value=self.stream_responses)
+        ttk.Checkbutton(stream_frame, variable=stream_var).pack(side=tk.LEFT, padx=(10, 0))
+        
+        # Edit protocol setting
+        protocol_frame = ttk.Frame(main_frame)
+        protocol_frame.pack(fill=tk.X, pady=5)
+        ttk.Label(protocol_frame, text="Edit Protocol:", width=20).pack(side=tk.LEFT)
+        protocol_var = tk.StringVar(value=self.edit_protocol)
+        protocol_combo = ttk.Combobox(protocol_frame, textvariable=protocol_var, state="readonly",
+                                      values=['auto', 'full', 'search_replace', 'chunked', 'parallel'], width=15)
+        protocol_combo.pack(side=tk.LEFT, padx=(10, 0))
+        
+        # Parallel edit workers
+        workers_frame = ttk.Frame(main_frame)
+        workers_frame.pack(fill=tk.X, pady=5)
+        ttk.Label(workers_frame, text="Parallel Workers:", width=20).pack(side=tk.LEFT)
+        workers_var = tk.IntVar(value=self.parallel_edit_workers)
+        workers_entry = ttk.Entry(workers_frame, textvariable=workers_var, width=10)
+        workers_entry.pack(side=tk.LEFT, padx=(10, 0))
+        
+        # File tree ignore patterns
+        ignore_frame = ttk.Frame(main_frame)
+        ignore_frame.pack(fill=tk.X, pady=5)
+        ttk.Label(ignore_frame, text="Ignore Patterns:", width=20).pack(side=tk.LEFT)
+        ignore_var = tk.StringVar(value=", ".join(self.tree_ignore_patterns))
+        ignore_entry = ttk.Entry(ignore_frame, textvariable=ignore_var)
+        ignore_entry.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=(10, 0))
+        
+        # Use .gitignore setting
+        gitignore_frame = ttk.Frame(main_frame)
+        gitignore_frame.pack(fill=tk.X, pady=5)
+        ttk.Label(gitignore_frame, text="Respect .gitignore:", width=20).pack(side=tk.LEFT)
+        gitignore_var = tk.BooleanVar(value=self.use_gitignore)
+        ttk.Checkbutton(gitignore_frame, variable=gitignore_var).pack(side=tk.LEFT, padx=(10, 0))
+        
+        # File watcher interval
+        watch_frame = ttk.Frame(main_frame)
+        watch_frame.pack(fill=tk.X, pady=5)
+        ttk.Label(watch_frame, text="Watch Interval (s):", width=20).pack(side=tk.LEFT)
+        watch_var = tk.DoubleVar(value=self.tree_watch_interval)
+        watch_entry = ttk.Entry(watch_frame, textvariable=watch_var, width=10)
+        watch_entry.pack(side=tk.LEFT, padx=(10, 0))
+        
+        # Persistent history setting
+        persist_frame = ttk.Frame(main_frame)
+        persist_frame.pack(fill=tk.X, pady=5)
+        ttk.Label(persist_frame, text="Persistent History:", width=20).pack(side=tk.LEFT)
+        persist_var = tk.BooleanVar(value=self.persistent_history)
+        ttk.Checkbutton(persist_frame, variable=persist_var).pack(side=tk.LEFT, padx=(10, 0))
+        
+        # API backend
+        backend_frame = ttk.Frame(main_frame)
+        backend_frame.pack(fill=tk.X, pady=5)
+        ttk.Label(backend_frame, text="API Backend:", width=20).pack(side=tk.LEFT)
+        backend_var = tk.StringVar(value=self.api_backend)
+        backend_combo = ttk.Combobox(backend_frame, textvariable=backend_var, state="readonly",
+                                     values=['threads', 'async'], width=15)
+        backend_combo.pack(side=tk.LEFT, padx=(10, 0))
+        
+        # Response cache policy
+        cache_frame = ttk.Frame(main_frame)
+        cache_frame.pack(fill=tk.X, pady=5)
+        ttk.Label(cache_frame, text="Response Cache:", width=20).pack(side=tk.LEFT)
+        cache_var = tk.StringVar(value=self.response_cache_policy)
+        cache_combo = ttk.Combobox(cache_frame, textvariable=cache_var, state="readonly",
+                                   values=['all', 'deterministic', 'off'], width=15)
+        cache_combo.pack(side=tk.LEFT, padx=(10, 0))
+        
+        # Debug Console size
+        debug_lines_frame = ttk.Frame(main_frame)
+        debug_lines_frame.pack(fill=tk.X, pady=5)
+        ttk.Label(debug_lines_frame, text="Debug Log Lines:", width=20).pack(side=tk.LEFT)
+        debug_lines_var = tk.IntVar(value=self.debug_log_max_lines)
+        debug_lines_entry = ttk.Entry(debug_lines_frame, textvariable=debug_lines_var, width=10)
+        debug_lines_entry.pack(side=tk.LEFT, padx=(10, 0))
+        
+        # Large-file mode threshold
+        large_file_frame = ttk.Frame(main_frame)
+        large_file_frame.pack(fill=tk.X, pady=5)
+        ttk.Label(large_file_frame, text="Large File MB:", width=20).pack(side=tk.LEFT)
+        large_file_var = tk.DoubleVar(value=self.large_file_threshold_mb)
+        large_file_entry = ttk.Entry(large_file_frame, textvariable=large_file_var, width=10)
+        large_file_entry.pack(side=tk.LEFT, padx=(10, 0))
+        
+        # Syntax highlighting
+        syntax_frame = ttk.Frame(main_frame)
+        syntax_frame.pack(fill=tk.X, pady=5)
+        ttk.Label(syntax_frame, text="Syntax Highlighting:", width=20).pack(side=tk.LEFT)
+        syntax_var = tk.BooleanVar(value=self.syntax_highlighting)
+        ttk.Checkbutton(syntax_frame, variable=syntax_var).pack(side=tk.LEFT, padx=(10, 0))
+        
         # Help text
         help_text = """Temperature: Controls randomness (0.0 = focused, 2.0 = creative)
 Max Tokens: Maximum tokens for most models
 Max Completion Tokens: For GPT-5 models only
-Conversation Memory: Number of messages to keep for context (higher = more tokens)"""
+Auto Max Tokens: Raise the output limit above the values above when a long reply is expected
+Memory Token Budget: Estimated tokens of earlier turns to resend for context (0 = no memory)
+Project Context Tokens: Budget for project snippets attached to chat messages
+Stream Responses: Show AI output as it is generated instead of waiting for the full reply
+Edit Protocol: full = AI returns the whole file, search_replace = AI returns only the changed
+  sections, chunked = only the functions/classes the prompt is about are sent and returned,
+  parallel = the file is split into sections that are edited concurrently,
+  auto = chunked/parallel for very large files, search_replace for large files
+Parallel Workers: How many sections of a parallel edit (or files of a batch edit) are sent at once
+API Backend: threads = blocking calls, async = one event loop shared by all requests
+Ignore Patterns: Comma-separated names or globs hidden from the file tree
+Watch Interval: How often to check the folder for outside changes (0 = off)
+Persistent History: Keep file history on disk per project folder between sessions
+Response Cache: Reuse answers to identical requests (deterministic = only at temperature 0)
+Debug Log Lines: How many lines the Debug Console keeps (older lines are dropped)
+Large File MB: Larger files are memory-mapped and shown 1000 lines at a time
+Syntax Highlighting: Color code files, re-coloring only changed lines and the lines in view"""
         help_label = ttk.Label(main_frame, text=help_text, font=('Arial', 9), foreground='gray', justify=tk.LEFT)
         help_label.pack(pady=20)
         
@@ -166,11 +3979,45 @@ Conversation Memory: Number of messages to keep for context (higher = more token
             self.temperature = temp_var.get()
             self.max_tokens = tokens_var.get()
             self.max_completion_tokens = comp_tokens_var.get()
-            self.conversation_memory_limit = memory_var.get()
+            self.auto_max_tokens = auto_tokens_var.get()
+            self.conversation_token_budget = memory_var.get()
+            self.conversation_history.token_budget = self.conversation_token_budget
+            self.conversation_history.trim()
+            self.project_context_tokens = max(0, project_var.get())
+            self.stream_responses = stream_var.get()
+            self.edit_protocol = protocol_var.get()
+            self.parallel_edit_workers = max(1, workers_var.get())
+            self.request_scheduler.resize(self.parallel_edit_workers + 1)
+            tree_settings = (self.tree_ignore_patterns, self.use_gitignore)
+            self.tree_ignore_patterns = [p.strip() for p in ignore_var.get().split(',') if p.strip()]
+            self.use_gitignore = gitignore_var.get()
+            self.tree_watch_interval = max(0.0, watch_var.get())
+            self.tree_watcher.start(self.tree_watch_interval)
+            history_changed = persist_var.get() != self.persistent_history
+            self.persistent_history = persist_var.get()
+            self.response_cache_policy = cache_var.get()
+            backend_changed = backend_var.get() != self.api_backend
+            self.api_backend = backend_var.get()
+            self.debug_log_max_lines = max(100, debug_lines_var.get())
+            self.large_file_threshold_mb = max(0.1, large_file_var.get())
+            self.syntax_highlighting = syntax_var.get()
+            self.syntax_highlighter.set_enabled(self.syntax_highlighting, self.current_file)
             self.save_config()
             
+            # Requests already running keep the client they started with
+            if backend_changed:
+                self.engine.setup_api_client(self.api_key, self.api_backend)
+            
+            # Switch the file history backend if persistence was turned on or off
+            if history_changed:
+                self.setup_file_history()
+            
             # Log the new settings
-            self.add_debug_log(f"Settings updated - Temp: {self.temperature}, Max Tokens: {self.max_tokens}, Memory Limit: {self.conversation_memory_limit}", "SYSTEM")
+            self.add_debug_log(f"Settings updated - Temp: {self.temperature}, Max Tokens: {self.max_tokens}, Auto Max Tokens: {self.auto_max_tokens}, Memory Budget: {self.conversation_token_budget} tokens, Streaming: {self.stream_responses}, Edit Protocol: {self.edit_protocol}", "SYSTEM")
+            
+            # Reload the file tree if the filters changed
+            if tree_settings != (self.tree_ignore_patterns, self.use_gitignore):
+                self.refresh_file_tree()
             
             settings_window.destroy()
             messagebox.showinfo("Success", "Settings saved successfully!")
@@ -206,6 +4053,10 @@ Conversation Memory: Number of messages to keep for context (higher = more token
 
 📁 FILE MANAGEMENT:
 • Select a folder using "Select Folder" button
+• Folders are listed when you expand them, so large projects open instantly
+• Hide folders or files with Ignore Patterns in Settings (.gitignore is respected)
+• Files added, removed or renamed outside the editor show up automatically
+• You are asked to reload the open file if another program changes it
 • Click on files in the left panel to open them
 • Use Save button to save changes
 • Use History button to view file versions and revert changes
@@ -215,6 +4066,9 @@ Conversation Memory: Number of messages to keep for context (higher = more token
 • Press Enter or click "Edit Code" to submit
 • AI will modify your code based on your request
 • Prompt input automatically clears after successful editing
+• Edits stream into the editor as they are generated (toggle in Settings)
+• Click "Cancel" to stop an edit in progress - the editor is restored
+• Pressing Enter again while the same edit is running doesn't send a second request
 • Use Shift+Enter for multi-line prompts
 
 💬 AI CHAT:
@@ -222,14 +4076,21 @@ Conversation Memory: Number of messages to keep for context (higher = more token
 • Type your message and press Enter to send
 • Check "📎 Include file context" to reference current file
 • Chat remembers conversation history for context
+• Click "Cancel" to stop a reply while it is streaming
 • Use Shift+Enter for multi-line messages
+• Check "Include relevant project snippets" to attach the most relevant code from the whole project folder
 
 ⚙️ SETTINGS & CONFIGURATION:
 • Click "⚙️ Settings" to configure AI parameters:
   - Temperature: Controls randomness (0.0=focused, 2.0=creative)
   - Max Tokens: Token limits for responses
   - Max Completion Tokens: For GPT-5 models
-  - Conversation Memory: Number of messages to keep for context
+  - Auto Max Tokens: Raise the output limit when a long reply is expected
+  - Memory Token Budget: Estimated tokens of earlier turns resent for context
+  - Stream Responses: Show AI output as it is generated
+  - Response Cache: Reuse answers to identical requests (all, deterministic only, or off)
+  - Edit Protocol: Whole-file edits, search/replace blocks, or chunked edits of just the relevant functions
+  - Syntax Highlighting: Color code files, re-coloring only changed and visible lines
 • Model changes apply immediately (no save needed)
 • API key changes apply on focus out
 • Click "Save Config" to persist settings to JSON
@@ -239,21 +4100,39 @@ Conversation Memory: Number of messages to keep for context (higher = more token
 • Monitor all API calls, requests, and system events
 • View response times, token usage, and errors
 • Export logs or copy to clipboard for analysis
+• "Cache Stats" shows response cache hits and misses; "Clear Cache" empties it
+• "Connection Stats" shows how many API requests reused a pooled connection, plus rate limit waits and retries
 • Color-coded logs for different event types
+• Untick a level under "Show:" to hide it; export and copy still include every level
+• Only the last 5000 lines are kept (Debug Log Lines in Settings); very long messages are shortened
 
 💰 TOKEN USAGE TRACKING:
 • Real-time token usage in status bar
 • Click "💰 Token Usage" button for detailed statistics
 • Right-click status bar for quick access menu
-• Cost estimates based on current model
+• Cost estimates priced separately for input, cached input and output tokens
+• "Edit Pricing" changes the per-model prices; "Usage Report" shows spend across sessions by day, project, model or mode
 • Session duration and tokens per minute
+• Latency percentiles (p50/p95/p99), time to first token and output speed per model
+• "Export Metrics" saves every request's timings and tokens as JSONL or CSV
 • Reset statistics for new projects
 
 📚 FILE HISTORY:
 • Every edit, save, and AI change is tracked
 • Access via "History" button in editor toolbar
 • Revert to any previous version or original
+• Batch edits keep a "Before batch edit" version of every file you accept
+• Large files (Settings > Large File MB) show 1000 lines at a time and have no history
 • Automatic version management (keeps last 20)
+• Identical snapshots are stored once and older versions are kept as compressed diffs
+• Enable "Persistent History" in Settings to keep history between sessions
+
+📦 BATCH EDITS:
+• Ctrl/Shift-click several files or folders in the tree, then use "Batch Edit Selected" (or right-click)
+• One prompt is run over every file, several at a time (Settings > Parallel Workers)
+• Review each file's diff, then accept or reject it - nothing is written until you accept
+• The summary shows files finished, failures, tokens and files per minute
+• Without the GUI: python code_editor.py edit "prompt" PATHS... (--write, --json, --help for more)
 
 ⌨️ KEYBOARD SHORTCUTS:
 • Enter: Send message/edit code
@@ -265,19 +4144,26 @@ Conversation Memory: Number of messages to keep for context (higher = more token
 • For creative tasks: Use higher temperature (1.0-2.0) for brainstorming
 • File context in chat: Only include when needed to save tokens
 • Conversation history: AI remembers previous interactions for context
+• Earlier edits are remembered as diffs, so old copies of the file are never resent
 • Model selection: Different models have different capabilities and costs
 
 🔧 TROUBLESHOOTING:
 • If API calls fail: Check your API key and model settings
+• Rate limits (429) and server errors are retried automatically with backoff - see the Debug Console
 • If file context isn't working: Ensure file is selected and checkbox is checked
 • If history isn't showing: Make sure you've made some changes to the file
 • For token issues: Use the debug console to monitor usage
+• Slow to start: run "python code_editor.py --profile-startup" to see the time spent in each startup phase
 
 📊 COST OPTIMIZATION:
 • Uncheck "Include file context" for general questions
 • Large files (>10k chars) use significant tokens when included
+• Each request shows its estimated tokens, cost and context headroom in the status bar before it is sent
+• Search/replace edits (Edit Protocol) keep output tokens low on large files
+• Chunked edits send only the functions/classes a prompt mentions, keeping input tokens low too
+• Whole-file prompts on very large files ("add type hints everywhere") are split into sections edited in parallel
 • Use appropriate token limits for your needs
-• Adjust conversation memory limit in Settings (lower = fewer tokens)
+• Adjust the memory token budget in Settings (lower = fewer tokens)
 • Monitor usage in debug console
 • Clear conversation history when starting new topics
 • Consider file size when choosing to include context
@@ -350,6 +4236,11 @@ Conversation Memory: Number of messages to keep for context (higher = more token
         self.file_tree = ttk.Treeview(left_panel, show="tree")
         self.file_tree.pack(fill=tk.BOTH, expand=True)
         self.file_tree.bind('<<TreeviewSelect>>', self.on_file_select)
+        self.file_tree.bind('<<TreeviewOpen>>', self.on_tree_open)
+        self.file_tree.bind('<Button-3>', self.show_tree_context_menu)
+        
+        ttk.Button(left_panel, text="Batch Edit Selected",
+                  command=self.show_batch_edit).pack(fill=tk.X, pady=(5, 0))
         
         # Right panel - Tabbed interface for Editor and Chat
         right_panel = ttk.Frame(content_frame)
@@ -378,11 +4269,34 @@ Conversation Memory: Number of messages to keep for context (higher = more token
         self.file_path_label = ttk.Label(editor_toolbar, text="No file selected")
         self.file_path_label.pack(side=tk.RIGHT)
         
+        # Large-file navigation (only shown while a large file is open)
+        self.large_file_bar = ttk.Frame(editor_frame)
+        ttk.Button(self.large_file_bar, text="◀ Previous",
+                   command=lambda: self.move_large_file_window(-1)).pack(side=tk.LEFT)
+        ttk.Button(self.large_file_bar, text="Next ▶",
+                   command=lambda: self.move_large_file_window(1)).pack(side=tk.LEFT, padx=(5, 0))
+        ttk.Label(self.large_file_bar, text="Go to line:").pack(side=tk.LEFT, padx=(15, 0))
+        self.large_file_goto_var = tk.StringVar()
+        goto_entry = ttk.Entry(self.large_file_bar, textvariable=self.large_file_goto_var, width=10)
+        goto_entry.pack(side=tk.LEFT, padx=(5, 0))
+        goto_entry.bind('<Return>', lambda e: self.goto_large_file_line())
+        self.large_file_label = ttk.Label(self.large_file_bar, text="", foreground='gray')
+        self.large_file_label.pack(side=tk.RIGHT)
+        
         # Code editor
         self.code_editor = scrolledtext.ScrolledText(editor_frame, wrap=tk.NONE, 
                                                    font=('Consolas', 10))
         self.code_editor.pack(fill=tk.BOTH, expand=True, padx=5, pady=(0, 5))
         
+        # Scrolling past either end of a large file's window moves the window
+        for sequence in ('<MouseWheel>', '<Button-4>', '<Button-5>'):
+            self.code_editor.bind(sequence, self.on_editor_scroll, add='+')
+        
+        # Highlights the lines that change and the lines in view, lexing on a worker thread
+        self.syntax_highlighter = SyntaxHighlighter(
+            self.code_editor, lambda result: self.message_queue.put(('syntax_tokens', result)),
+            self.syntax_highlighting)
+        
         # Tab 2: AI Chat
         self.chat_tab = ttk.Frame(self.notebook)
         self.notebook.add(self.chat_tab, text="AI Chat")
@@ -391,6 +4305,67 @@ Conversation Memory: Number of messages to keep for context (higher = more token
         self.debug_tab = ttk.Frame(self.notebook)
         self.notebook.add(self.debug_tab, text="🐛 Debug Console")
         
+        # The chat and debug tabs are built the first time they are shown (see build_chat_tab and
+        # build_debug_tab); their options exist from the start
+        self.include_file_context = tk.BooleanVar(value=False)
+        self.include_project_context = tk.BooleanVar(value=False)
+        self.debug_level_vars = {level: tk.BooleanVar(value=True) for level in DEBUG_LOG_LEVEL_COLORS}
+        self.notebook.bind('<<NotebookTabChanged>>', self.on_tab_changed)
+        
+        # Prompt area (for code editing)
+        prompt_frame = ttk.LabelFrame(self.editor_tab, text="AI Prompt")
+        prompt_frame.pack(fill=tk.X, pady=(0, 10))
+        
+        self.prompt_text = scrolledtext.ScrolledText(prompt_frame, height=4, wrap=tk.WORD)
+        self.prompt_text.pack(fill=tk.X, padx=5, pady=5)
+        
+        prompt_buttons_frame = ttk.Frame(prompt_frame)
+        prompt_buttons_frame.pack(fill=tk.X, padx=5, pady=(0, 5))
+        
+        ttk.Button(prompt_buttons_frame, text="Edit Code", 
+                  command=self.edit_code).pack(side=tk.LEFT)
+        ttk.Button(prompt_buttons_frame, text="Cancel",
+                  command=lambda: self.cancel_requests('edit')).pack(side=tk.LEFT, padx=(5, 0))
+        ttk.Button(prompt_buttons_frame, text="Clear", 
+                  command=lambda: self.prompt_text.delete(1.0, tk.END)).pack(side=tk.LEFT, padx=(5, 0))
+        
+        # Status bar
+        status_frame = ttk.Frame(main_frame)
+        status_frame.pack(side=tk.BOTTOM, fill=tk.X, pady=(5, 0))
+        
+        # Status label
+        self.status_var = tk.StringVar(value="Ready")
+        status_bar = ttk.Label(status_frame, textvariable=self.status_var, 
+                              relief=tk.SUNKEN, anchor=tk.W)
+        status_bar.pack(side=tk.LEFT, fill=tk.X, expand=True)
+        
+        # Bind right-click to status bar for context menu
+        status_bar.bind('<Button-3>', self.show_status_context_menu)
+        
+        # Token usage button
+        token_button = ttk.Button(status_frame, text="💰 Token Usage", 
+                                 command=self.show_token_usage_details, width=15)
+        token_button.pack(side=tk.RIGHT, padx=(5, 0))
+        
+        # Bind events
+        self.prompt_text.bind('<Return>', self.on_edit_enter)
+        self.prompt_text.bind('<Shift-Return>', self.on_edit_shift_enter)
+        self.code_editor.bind('<Control-s>', lambda e: self.save_file())
+    
+    def on_tab_changed(self, event=None):
+        # Build a tab the first time it is selected
+        selected = self.notebook.select()
+        if selected == str(self.chat_tab):
+            self.build_chat_tab()
+        elif selected == str(self.debug_tab):
+            self.build_debug_tab()
+    
+    def build_chat_tab(self):
+        # Build the AI Chat tab unless it exists (on first use, so startup doesn't pay for it)
+        if not hasattr(self, 'chat_history'):
+            self.profiler.measure("build AI Chat tab", self.create_chat_tab)
+    
+    def create_chat_tab(self):
         # Chat area
         chat_frame = ttk.LabelFrame(self.chat_tab, text="AI Chat")
         chat_frame.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
@@ -405,11 +4380,15 @@ Conversation Memory: Number of messages to keep for context (higher = more token
         chat_input_frame.pack(fill=tk.X, padx=5, pady=(0, 5))
         
         # Attachment checkbox
-        self.include_file_context = tk.BooleanVar(value=False)
         attachment_check = ttk.Checkbutton(chat_input_frame, text="📎 Include file context", 
                                          variable=self.include_file_context)
         attachment_check.pack(side=tk.TOP, anchor=tk.W, pady=(0, 5))
         
+        # Project retrieval checkbox
+        project_check = ttk.Checkbutton(chat_input_frame, text="🔎 Include relevant project snippets",
+                                        variable=self.include_project_context)
+        project_check.pack(side=tk.TOP, anchor=tk.W, pady=(0, 5))
+        
         # File context indicator
         self.file_context_label = ttk.Label(chat_input_frame, text="", font=('Arial', 8), foreground='gray')
         self.file_context_label.pack(side=tk.TOP, anchor=tk.W, pady=(0, 5))
@@ -423,11 +4402,25 @@ Conversation Memory: Number of messages to keep for context (higher = more token
         
         ttk.Button(chat_buttons_frame, text="Send", 
                   command=self.send_chat).pack(side=tk.LEFT)
+        ttk.Button(chat_buttons_frame, text="Cancel",
+                  command=lambda: self.cancel_requests('chat')).pack(side=tk.LEFT, padx=(5, 0))
         ttk.Button(chat_buttons_frame, text="Clear Chat", 
                   command=self.clear_chat_history).pack(side=tk.LEFT, padx=(5, 0))
         ttk.Button(chat_buttons_frame, text="Clear History", 
                   command=self.clear_conversation_history).pack(side=tk.LEFT, padx=(5, 0))
         
+        self.chat_input.bind('<Return>', self.on_chat_enter)
+        self.chat_input.bind('<Shift-Return>', self.on_chat_shift_enter)
+        if self.current_file:
+            self.file_context_label.config(text=f"📁 {os.path.basename(self.current_file)} available for context")
+    
+    def build_debug_tab(self):
+        # Build the Debug Console tab unless it exists, then write the records queued until now
+        if not hasattr(self, 'debug_log'):
+            self.profiler.measure("build Debug Console tab", self.create_debug_tab)
+            self.flush_debug_log()
+    
+    def create_debug_tab(self):
         # Debug Console area
         debug_frame = ttk.LabelFrame(self.debug_tab, text="Debug Console")
         debug_frame.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
@@ -440,53 +4433,30 @@ Conversation Memory: Number of messages to keep for context (higher = more token
                   command=self.clear_debug_log).pack(side=tk.LEFT)
         ttk.Button(debug_controls, text="Export Log", 
                   command=self.export_debug_log).pack(side=tk.LEFT, padx=(5, 0))
-        ttk.Button(debug_controls, text="Copy to Clipboard", 
+        ttk.Button(debug_controls, text="Copy to Clipboard",
                   command=self.copy_debug_log).pack(side=tk.LEFT, padx=(5, 0))
+        ttk.Button(debug_controls, text="Cache Stats",
+                  command=self.log_cache_stats).pack(side=tk.LEFT, padx=(5, 0))
+        ttk.Button(debug_controls, text="Clear Cache",
+                  command=self.clear_response_cache).pack(side=tk.LEFT, padx=(5, 0))
+        ttk.Button(debug_controls, text="Connection Stats",
+                  command=self.log_connection_stats).pack(side=tk.LEFT, padx=(5, 0))
+        
+        # Level filters - hiding a level elides its tag, so nothing is re-rendered
+        debug_filters = ttk.Frame(debug_frame)
+        debug_filters.pack(fill=tk.X, padx=5, pady=(0, 5))
+        ttk.Label(debug_filters, text="Show:").pack(side=tk.LEFT)
+        for level, level_var in self.debug_level_vars.items():
+            ttk.Checkbutton(debug_filters, text=level.title(), variable=level_var,
+                            command=lambda level=level: self.filter_debug_log(level)).pack(side=tk.LEFT, padx=(5, 0))
         
         # Debug log display
         self.debug_log = scrolledtext.ScrolledText(debug_frame, wrap=tk.WORD, 
                                                  font=('Consolas', 9), state=tk.DISABLED)
         self.debug_log.pack(fill=tk.BOTH, expand=True, padx=5, pady=(0, 5))
-        
-        # Prompt area (for code editing)
-        prompt_frame = ttk.LabelFrame(self.editor_tab, text="AI Prompt")
-        prompt_frame.pack(fill=tk.X, pady=(0, 10))
-        
-        self.prompt_text = scrolledtext.ScrolledText(prompt_frame, height=4, wrap=tk.WORD)
-        self.prompt_text.pack(fill=tk.X, padx=5, pady=5)
-        
-        prompt_buttons_frame = ttk.Frame(prompt_frame)
-        prompt_buttons_frame.pack(fill=tk.X, padx=5, pady=(0, 5))
-        
-        ttk.Button(prompt_buttons_frame, text="Edit Code", 
-                  command=self.edit_code).pack(side=tk.LEFT)
-        ttk.Button(prompt_buttons_frame, text="Clear", 
-                  command=lambda: self.prompt_text.delete(1.0, tk.END)).pack(side=tk.LEFT, padx=(5, 0))
-        
-        # Status bar
-        status_frame = ttk.Frame(main_frame)
-        status_frame.pack(side=tk.BOTTOM, fill=tk.X, pady=(5, 0))
-        
-        # Status label
-        self.status_var = tk.StringVar(value="Ready")
-        status_bar = ttk.Label(status_frame, textvariable=self.status_var, 
-                              relief=tk.SUNKEN, anchor=tk.W)
-        status_bar.pack(side=tk.LEFT, fill=tk.X, expand=True)
-        
-        # Bind right-click to status bar for context menu
-        status_bar.bind('<Button-3>', self.show_status_context_menu)
-        
-        # Token usage button
-        token_button = ttk.Button(status_frame, text="💰 Token Usage", 
-                                 command=self.show_token_usage_details, width=15)
-        token_button.pack(side=tk.RIGHT, padx=(5, 0))
-        
-        # Bind events
-        self.prompt_text.bind('<Return>', self.on_edit_enter)
-        self.prompt_text.bind('<Shift-Return>', self.on_edit_shift_enter)
-        self.chat_input.bind('<Return>', self.on_chat_enter)
-        self.chat_input.bind('<Shift-Return>', self.on_chat_shift_enter)
-        self.code_editor.bind('<Control-s>', lambda e: self.save_file())
+        for level, color in DEBUG_LOG_LEVEL_COLORS.items():
+            self.debug_log.tag_config(f"level_{level.lower()}", foreground=color,
+                                      elide=not self.debug_level_vars[level].get())
     
     def update_token_usage(self, tokens_used, model_name):
         # Update token usage statistics
@@ -499,35 +4469,10 @@ Conversation Memory: Number of messages to keep for context (higher = more token
         # Update status bar with token info
         self.update_token_status()
     
-    def calculate_estimated_cost(self):
-        # Calculate estimated cost based on current model and token usage
-        # Approximate costs per 1K tokens (as of 2024)
-        model_costs = {
-            'gpt-4': 0.03,      # $0.03 per 1K input, $0.06 per 1K output
-            'gpt-4.1': 0.01,    # $0.01 per 1K input, $0.03 per 1K output
-            'gpt-4.1-mini': 0.00015,  # $0.00015 per 1K input, $0.0006 per 1K output
-            'gpt-4.1-nano': 0.0001,   # $0.0001 per 1K input, $0.0004 per 1K output
-            'gpt-5': 0.005,     # $0.005 per 1K input, $0.015 per 1K output
-            'o3-pro': 0.015,    # $0.015 per 1K input, $0.06 per 1K output
-            'o3-mini': 0.0002,  # $0.0002 per 1K input, $0.0008 per 1K output
-            'o3-mini-high': 0.0003,  # $0.0003 per 1K input, $0.0012 per 1K output
-            'gpt-3.5-turbo': 0.0005  # $0.0005 per 1K input, $0.0015 per 1K output
-        }
-        
-        current_model = self.model_var.get() if hasattr(self, 'model_var') else self.model
-        
-        # Get cost for current model (default to gpt-4 if unknown)
-        cost_per_1k = model_costs.get(current_model, 0.03)
-        
-        # Calculate estimated cost (assuming 50/50 input/output split)
-        estimated_cost = (self.total_tokens_used / 1000) * cost_per_1k
-        
-        return estimated_cost, cost_per_1k
-    
     def update_token_status(self):
         # Update the status bar with token usage information
         if self.total_tokens_used > 0:
-            estimated_cost, cost_per_1k = self.calculate_estimated_cost()
+            estimated_cost = self.engine.calculate_estimated_cost()
             
             # Format the status with token info
             status_text = f"Tokens: {self.total_tokens_used:,} | Requests: {self.total_requests} | Est. Cost: ${estimated_cost:.4f}"
@@ -539,17 +4484,22 @@ Conversation Memory: Number of messages to keep for context (higher = more token
         # Reset token usage statistics for new session
         self.total_tokens_used = 0
         self.total_requests = 0
+        with self.engine.session_cost_lock:
+            self.engine.session_cost = 0.0
         self.session_start_time = datetime.datetime.now()
+        self.engine.request_metrics = RequestMetrics()
         self.add_debug_log("Token usage reset", "SYSTEM")
         self.update_token_status()
     
     def show_token_usage_details(self):
         # Show detailed token usage information
-        if self.total_tokens_used == 0:
+        if self.total_tokens_used == 0 and not len(self.engine.request_metrics) and self.engine.usage_ledger is None:
             messagebox.showinfo("Token Usage", "No tokens used yet in this session.")
             return
         
-        estimated_cost, cost_per_1k = self.calculate_estimated_cost()
+        estimated_cost = self.engine.calculate_estimated_cost()
+        current_model = self.model_var.get() if hasattr(self, 'model_var') else self.model
+        price = lookup_model_setting(self.engine.model_pricing, current_model, FALLBACK_MODEL_PRICE)
         session_duration = datetime.datetime.now() - self.session_start_time
         
         # Calculate tokens per minute
@@ -565,12 +4515,18 @@ Conversation Memory: Number of messages to keep for context (higher = more token
 • Tokens per Minute: {tokens_per_minute:.1f}
 
 💰 Cost Information:
-• Current Model: {self.model_var.get() if hasattr(self, 'model_var') else self.model}
-• Cost per 1K Tokens: ${cost_per_1k:.4f}
-• Estimated Total Cost: ${estimated_cost:.4f}
+• Current Model: {current_model}
+• Per 1K Tokens: ${price['input']:.5f} input, ${price.get('cached_input', price['input']):.5f} cached input, ${price['output']:.5f} output
+• Estimated Session Cost: ${estimated_cost:.4f}
+
+📒 Usage Ledger (all sessions):
+{self.format_ledger_summary()}
+
+⏱️ Latency by Model:
+{self.format_metrics_summary()}
 
 💡 Tips:
-• Lower conversation memory = fewer tokens
+• Lower memory token budget = fewer tokens
 • Uncheck file context for general questions
 • Monitor usage in Debug Console
 • Reset stats for new projects"""
@@ -578,7 +4534,7 @@ Conversation Memory: Number of messages to keep for context (higher = more token
         # Create details window
         details_window = tk.Toplevel(self.root)
         details_window.title("Token Usage Details")
-        details_window.geometry("500x400")
+        details_window.geometry("600x600")
         details_window.transient(self.root)
         details_window.grab_set()
         
@@ -602,50 +4558,267 @@ Conversation Memory: Number of messages to keep for context (higher = more token
         
         ttk.Button(button_frame, text="Reset Stats", 
                   command=self.reset_token_usage).pack(side=tk.LEFT, padx=(0, 10))
+        ttk.Button(button_frame, text="Export Metrics",
+                  command=self.export_request_metrics).pack(side=tk.LEFT, padx=(0, 10))
+        ttk.Button(button_frame, text="Usage Report",
+                  command=self.show_usage_report).pack(side=tk.LEFT, padx=(0, 10))
+        ttk.Button(button_frame, text="Edit Pricing",
+                  command=self.show_pricing_editor).pack(side=tk.LEFT, padx=(0, 10))
         ttk.Button(button_frame, text="Close", 
                   command=details_window.destroy).pack(side=tk.LEFT)
     
+    def format_ledger_summary(self):
+        # Spend today, in the open project and in total, for the token usage details
+        if self.engine.usage_ledger is None:
+            return "• Unavailable - could not open the usage ledger database"
+        
+        today = datetime.datetime.combine(datetime.date.today(), datetime.time()).timestamp()
+        periods = [("Today", {"since": today}), ("All time", {})]
+        if self.current_folder:
+            periods.insert(1, (f"This project ({os.path.basename(self.current_folder)})", {"project": self.current_folder}))
+        
+        lines = []
+        for label, filters in periods:
+            rows = self.engine.usage_ledger.summarize('model', self.engine.model_pricing, **filters)
+            requests = sum(row["requests"] for row in rows)
+            tokens = sum(row["prompt_tokens"] + row["completion_tokens"] for row in rows)
+            cost = sum(row["cost"] for row in rows)
+            lines.append(f"• {label}: ${cost:.4f} - {requests:,} requests, {tokens:,} tokens")
+        return "\n".join(lines)
+    
+    def show_usage_report(self):
+        # Spend from the usage ledger grouped by day, project, model or mode
+        if self.engine.usage_ledger is None:
+            messagebox.showerror("Usage Report", "The usage ledger database could not be opened.")
+            return
+        
+        report_window = tk.Toplevel(self.root)
+        report_window.title("Usage Report")
+        report_window.geometry("720x420")
+        report_window.transient(self.root)
+        report_window.grab_set()
+        
+        main_frame = ttk.Frame(report_window)
+        main_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
+        
+        # Grouping
+        controls = ttk.Frame(main_frame)
+        controls.pack(fill=tk.X, pady=(0, 10))
+        ttk.Label(controls, text="Group by:").pack(side=tk.LEFT)
+        group_var = tk.StringVar(value='day')
+        group_combo = ttk.Combobox(controls, textvariable=group_var, state="readonly",
+                                   values=list(UsageLedger.GROUPS), width=12)
+        group_combo.pack(side=tk.LEFT, padx=(5, 0))
+        total_var = tk.StringVar()
+        ttk.Label(controls, textvariable=total_var).pack(side=tk.RIGHT)
+        
+        # One row per group, most expensive first
+        columns = ("requests", "input", "cached", "output", "cost")
+        report_tree = ttk.Treeview(main_frame, columns=columns, show="tree headings")
+        report_tree.heading("#0", text="Group")
+        report_tree.column("#0", width=260)
+        for column, title in zip(columns, ("Requests", "Input Tokens", "Cached", "Output Tokens", "Cost")):
+            report_tree.heading(column, text=title)
+            report_tree.column(column, width=85, anchor=tk.E)
+        report_tree.pack(fill=tk.BOTH, expand=True)
+        
+        def refresh_report(event=None):
+            report_tree.delete(*report_tree.get_children())
+            rows = self.engine.usage_ledger.summarize(group_var.get(), self.engine.model_pricing)
+            for row in rows:
+                report_tree.insert("", tk.END, text=row["key"] or "(no folder)", values=(
+                    f"{row['requests']:,}", f"{row['prompt_tokens']:,}", f"{row['cached_tokens']:,}",
+                    f"{row['completion_tokens']:,}", f"${row['cost']:.4f}"))
+            total_var.set(f"Total: ${sum(row['cost'] for row in rows):.4f}")
+        
+        group_combo.bind('<<ComboboxSelected>>', refresh_report)
+        refresh_report()
+        
+        ttk.Button(main_frame, text="Close", command=report_window.destroy).pack(pady=(10, 0))
+    
+    def show_pricing_editor(self):
+        # Edit the per-model prices (USD per 1K tokens) used for cost estimates and the usage ledger
+        pricing_window = tk.Toplevel(self.root)
+        pricing_window.title("Model Pricing")
+        pricing_window.geometry("520x480")
+        pricing_window.transient(self.root)
+        pricing_window.grab_set()
+        
+        main_frame = ttk.Frame(pricing_window)
+        main_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
+        
+        ttk.Label(main_frame, text="USD per 1K tokens by model prefix (the longest matching prefix is used):",
+                  font=('Arial', 9)).pack(anchor=tk.W, pady=(0, 5))
+        pricing_text = scrolledtext.ScrolledText(main_frame, wrap=tk.NONE, font=('Consolas', 10))
+        pricing_text.pack(fill=tk.BOTH, expand=True)
+        pricing_text.insert(1.0, json.dumps(self.engine.model_pricing, indent=2))
+        
+        def save_pricing():
+            try:
+                pricing = json.loads(pricing_text.get(1.0, tk.END))
+                validate_pricing(pricing)
+            except ValueError as e:
+                messagebox.showerror("Invalid Pricing", str(e), parent=pricing_window)
+                return
+            self.engine.model_pricing = pricing
+            self.save_config()
+            self.update_token_status()
+            self.add_debug_log(f"Model pricing updated ({len(pricing)} models)", "SYSTEM")
+            pricing_window.destroy()
+        
+        def reset_pricing():
+            pricing_text.delete(1.0, tk.END)
+            pricing_text.insert(1.0, json.dumps(DEFAULT_MODEL_PRICING, indent=2))
+        
+        button_frame = ttk.Frame(main_frame)
+        button_frame.pack(pady=(10, 0))
+        ttk.Button(button_frame, text="Save", command=save_pricing).pack(side=tk.LEFT, padx=(0, 10))
+        ttk.Button(button_frame, text="Reset to Defaults", command=reset_pricing).pack(side=tk.LEFT, padx=(0, 10))
+        ttk.Button(button_frame, text="Cancel", command=pricing_window.destroy).pack(side=tk.LEFT)
+    
+    def format_metrics_summary(self):
+        # Latency percentiles and output speed per model, for the token usage details
+        summary = self.engine.request_metrics.summary_by_model()
+        if not summary:
+            return "• No API requests yet"
+        
+        labels = "/".join(f"p{p}" for p in METRICS_PERCENTILES)
+        lines = []
+        for model_name, stats in sorted(summary.items()):
+            lines.append(f"• {model_name} ({stats['requests']} requests)")
+            lines.append(f"    Latency {labels}: " + " / ".join(f"{value:.2f}s" for value in stats['latency']))
+            if stats['ttft'][0] is not None:
+                lines.append(f"    First token {labels}: " + " / ".join(f"{value:.2f}s" for value in stats['ttft']))
+            if stats['tokens_per_second']:
+                lines.append(f"    Output speed: {stats['tokens_per_second']:.1f} tokens/s")
+        return "\n".join(lines)
+    
+    def export_request_metrics(self):
+        # Save the per-request metrics of this session as JSONL or CSV
+        if not len(self.engine.request_metrics):
+            messagebox.showinfo("Export Metrics", "No API requests recorded yet in this session.")
+            return
+        path = filedialog.asksaveasfilename(
+            title="Export Request Metrics",
+            defaultextension=".jsonl",
+            initialfile=f"request_metrics_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.jsonl",
+            filetypes=[("JSON Lines", "*.jsonl"), ("CSV", "*.csv")]
+        )
+        if not path:
+            return
+        try:
+            if path.lower().endswith('.csv'):
+                count = self.engine.request_metrics.export_csv(path)
+            else:
+                count = self.engine.request_metrics.export_jsonl(path)
+            self.add_debug_log(f"Exported {count} request metrics to {path}", "SYSTEM")
+            messagebox.showinfo("Success", f"Exported {count} request metrics to {path}")
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to export request metrics: {str(e)}")
+    
     def add_debug_log(self, message, level="INFO"):
-        # Add a message to the debug console
-        
-        timestamp = datetime.datetime.now().strftime("%H:%M:%S.%f")[:-3]
-        
-        # Color coding for different log levels
-        level_colors = {
-            "INFO": "black",
-            "API": "blue",
-            "REQUEST": "green", 
-            "RESPONSE": "purple",
-            "ERROR": "red",
-            "WARNING": "orange",
-            "SYSTEM": "gray"
-        }
+        # Queue a message for the debug console - safe to call from any thread.
+        # Oversized messages are cut down here, before anything else formats them
+        self.debug_log_queue.append((time.time(), level, truncate_log_message(message)))
+        self.message_queue.wake()
+    
+    def flush_debug_log(self):
+        # Write all queued debug records in one insert, then drop the oldest lines beyond the limit.
+        # Until the Debug Console tab is built the records stay queued, capped at the same limit
+        if not hasattr(self, 'debug_log'):
+            while len(self.debug_log_queue) > self.debug_log_max_lines:
+                self.debug_log_queue.popleft()
+            return
+        records = []
+        while True:
+            try:
+                records.append(self.debug_log_queue.popleft())
+            except IndexError:
+                break
+        if not records:
+            return
         
-        color = level_colors.get(level, "black")
-        formatted_message = f"[{timestamp}] {level}: {message}\n"
+        # One (text, tag) pair per record; unknown levels are shown without a color
+        chunks = []
+        for record in records:
+            chunks.extend((format_debug_record(record), f"level_{record[1].lower()}"))
         
-        # Update debug log
-        self.debug_log.config(state=tk.NORMAL)
+        # Only follow new output if the user has not scrolled up to read older lines
+        follow = self.debug_log.yview()[1] >= 1.0
         
-        # Insert with color tag
-        tag_name = f"level_{level.lower()}"
-        self.debug_log.insert(tk.END, formatted_message, tag_name)
+        self.debug_log.config(state=tk.NORMAL)
+        self.debug_log.insert(tk.END, *chunks)
         
-        # Configure tag color
-        self.debug_log.tag_config(tag_name, foreground=color)
+        line_count = int(self.debug_log.index('end-1c').split('.')[0]) - 1
+        excess = line_count - self.debug_log_max_lines
+        if excess > 0:
+            self.debug_log.delete(1.0, f"{excess + 1}.0")
         
-        # Scroll to bottom
-        self.debug_log.see(tk.END)
         self.debug_log.config(state=tk.DISABLED)
+        if follow:
+            self.debug_log.see(tk.END)
     
-    def log_api_request(self, model, temperature, max_tokens, message_count, prompt_length):
-        # Log API request details
-        self.add_debug_log(f"API Request - Model: {model}, Temp: {temperature}, Max Tokens: {max_tokens}", "API")
-        self.add_debug_log(f"Request Details - Messages: {message_count}, Prompt Length: {prompt_length} chars", "REQUEST")
+    def filter_debug_log(self, level):
+        # Show or hide one level in the debug console
+        self.debug_log.tag_config(f"level_{level.lower()}", elide=not self.debug_level_vars[level].get())
     
-    def log_api_response(self, response_time, token_usage, model_used):
-        # Log API response details
-        self.add_debug_log(f"API Response - Time: {response_time:.2f}s, Tokens: {token_usage}, Model: {model_used}", "RESPONSE")
+    def snapshot_settings(self):
+        # Immutable copy of the settings a request runs with - taken on the UI thread when it is submitted,
+        # so workers never read Tk variables and a settings change never affects a request already running
+        model_name = self.model_var.get()
+        return RequestSettings(
+            model=model_name,
+            temperature=self.temperature,
+            max_tokens=self.max_completion_tokens if model_name.startswith('gpt-5') else self.max_tokens,
+            auto_max_tokens=self.auto_max_tokens,
+            stream=self.stream_responses,
+            cache_policy=self.response_cache_policy,
+            edit_protocol=self.edit_protocol,
+            parallel_workers=self.parallel_edit_workers,
+            project_folder=self.current_folder
+        )
+    
+    def confirm_request_size(self, estimate, model_name):
+        # Ask before sending a request that is not expected to fit the model's context window
+        self.add_debug_log(f"Pre-flight: {self.engine.format_estimate(estimate)} (output limit {estimate['output_tokens']:,})", "REQUEST")
+        if estimate['output_tokens'] < estimate['expected_output'] and 'sections' not in estimate:
+            self.add_debug_log(f"⚠️ Expected reply (~{estimate['expected_output']:,} tokens) is longer than the output limit - it may be cut off", "WARNING")
+        if estimate['headroom'] >= 0:
+            return True
+        self.add_debug_log(f"⚠️ Request may exceed the {estimate['context_window']:,} token context window of {model_name}", "WARNING")
+        return messagebox.askyesno(
+            "Request Too Large",
+            f"This request is estimated at {estimate['prompt_tokens']:,} prompt tokens plus {estimate['expected_output']:,} "
+            f"for the reply, more than the {estimate['context_window']:,} token context window of {model_name}.\n\nSend anyway?")
+    
+    def log_conversation_memory(self, dropped=0):
+        # Log the size of the remembered conversation after a turn is added
+        if dropped:
+            self.add_debug_log(f"Conversation history trimmed: dropped {dropped} oldest turn(s) to fit {self.conversation_history.token_budget} token budget", "INFO")
+        self.add_debug_log(f"Conversation memory: {len(self.conversation_history)} turns, ~{self.conversation_history.token_count()} tokens", "INFO")
+    
+    def log_cache_stats(self):
+        # Log response cache counters to the debug console
+        if self.engine.response_cache is None:
+            self.add_debug_log("Response cache unavailable", "WARNING")
+            return
+        stats = self.engine.response_cache.stats()
+        lookups = stats['hits'] + stats['misses']
+        hit_rate = stats['hits'] / lookups * 100 if lookups else 0
+        self.add_debug_log(f"Response cache - Hits: {stats['hits']}, Misses: {stats['misses']} ({hit_rate:.0f}% hit rate), "
+                           f"Entries: {stats['entries']}, Size: {stats['bytes'] / 1024:.1f} KB, Policy: {self.response_cache_policy}", "INFO")
+    
+    def log_connection_stats(self):
+        # Write HTTP connection reuse for API requests to the debug console
+        backend = f"{self.api_backend} backend, HTTP/2 {'available' if HTTP2_AVAILABLE else 'unavailable (pip install httpx[http2])'}"
+        self.add_debug_log(f"Connection stats ({backend}): {self.engine.connection_stats.summary()}", "INFO")
+        self.add_debug_log(f"Rate limits: {self.engine.rate_limiter.summary()}", "INFO")
+    
+    def clear_response_cache(self):
+        # Remove all cached responses
+        if self.engine.response_cache is not None:
+            self.engine.response_cache.clear()
+            self.add_debug_log("Response cache cleared", "SYSTEM")
     
     def log_error(self, error_message, context=""):
         # Log error messages
@@ -656,13 +4829,16 @@ Conversation Memory: Number of messages to keep for context (higher = more token
     
     def clear_debug_log(self):
         # Clear the debug console
+        self.build_debug_tab()
         self.debug_log.config(state=tk.NORMAL)
         self.debug_log.delete(1.0, tk.END)
         self.debug_log.config(state=tk.DISABLED)
         self.add_debug_log("Debug log cleared", "SYSTEM")
     
     def export_debug_log(self):
-        # Export debug log to file
+        # Export debug log to file (every level, including hidden ones)
+        self.build_debug_tab()
+        self.flush_debug_log()
         try:
             filename = f"debug_log_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
             with open(filename, 'w', encoding='utf-8') as f:
@@ -672,7 +4848,9 @@ Conversation Memory: Number of messages to keep for context (higher = more token
             messagebox.showerror("Error", f"Failed to export debug log: {str(e)}")
     
     def copy_debug_log(self):
-        # Copy debug log to clipboard
+        # Copy debug log to clipboard (every level, including hidden ones)
+        self.build_debug_tab()
+        self.flush_debug_log()
         try:
             log_content = self.debug_log.get(1.0, tk.END)
             self.root.clipboard_clear()
@@ -692,6 +4870,7 @@ Conversation Memory: Number of messages to keep for context (higher = more token
         if folder:
             self.current_folder = folder
             self.folder_label.config(text=f"Folder: {os.path.basename(folder)}")
+            self.setup_file_history()
             self.refresh_file_tree()
             self.status_var.set(f"Selected folder: {folder}")
             self.clear_file_context_indicator() # Clear indicator when folder changes
@@ -699,7 +4878,9 @@ Conversation Memory: Number of messages to keep for context (higher = more token
     def clear_current_file(self):
         # Clear the current file and update indicators
         self.current_file = None
+        self.tree_watcher.watch_file(None)
         self.code_editor.delete(1.0, tk.END)
+        self.syntax_highlighter.set_file(None)
         self.file_path_label.config(text="No file selected")
         self.clear_file_context_indicator()
         self.status_var.set("No file selected")
@@ -713,48 +4894,224 @@ Conversation Memory: Number of messages to keep for context (higher = more token
         if self.current_file and not self.current_file.startswith(self.current_folder):
             self.clear_current_file()
         
-        # Clear existing items
-        for item in self.file_tree.get_children():
-            self.file_tree.delete(item)
+        # Remember which folders were expanded so they can be opened again
+        self.tree_reopen = {path for path, (item, is_dir) in self.tree_items.items()
+                            if is_dir and self.file_tree.exists(item) and self.file_tree.item(item, 'open')}
+        
+        # Clear existing items and drop results of scans still in progress
+        self.tree_generation += 1
+        self.tree_unloaded.clear()
+        self.tree_loading.clear()
+        self.tree_items = {self.current_folder: ("", True)}
+        self.file_tree.delete(*self.file_tree.get_children())
+        self.tree_watcher.reset(self.tree_generation)
+        self.tree_watcher.start(self.tree_watch_interval)
+        
+        # Load .gitignore rules for the project root
+        self.gitignore_matcher = GitIgnoreMatcher(self.current_folder) if self.use_gitignore else None
         
-        # Add files recursively
-        self.add_files_to_tree("", self.current_folder)
+        # Rebuild the project index in the background with the same filters
+        self.project_indexer.set_root(self.current_folder, self.tree_ignore_patterns, self.gitignore_matcher)
+        
+        # Only the top level is listed now - folders are listed when first expanded
+        self.load_tree_directory("", self.current_folder)
     
-    def add_files_to_tree(self, parent, path):
-        # Recursively add files to the tree
-        try:
-            for item in os.listdir(path):
-                item_path = os.path.join(path, item)
-                if os.path.isfile(item_path):
-                    # Only show common code files
-                    if item.lower().endswith(('.py', '.js', '.ts', '.html', '.css', '.java', '.cpp', '.c', '.h', '.json', '.xml', '.md', '.txt', '.ino')):
-                        item_id = self.file_tree.insert(parent, 'end', text=item, values=(item_path,))
-                elif os.path.isdir(item_path):
-                    # Skip common directories
-                    if item not in ['.git', '__pycache__', 'node_modules', '.vscode', '.idea']:
-                        folder_id = self.file_tree.insert(parent, 'end', text=f"📁 {item}", values=(item_path,))
-                        self.add_files_to_tree(folder_id, item_path)
-        except PermissionError:
-            pass
+    def load_tree_directory(self, parent, path):
+        # Queue a folder to be listed by the background scan worker (once - expanding it again while
+        # the listing is on its way doesn't queue it twice)
+        if parent:
+            self.tree_loading[parent] = self.tree_unloaded.pop(parent, None)
+        if self.tree_scan_worker is None or not self.tree_scan_worker.is_alive():
+            self.tree_scan_worker = threading.Thread(target=self.run_tree_scan_worker, daemon=True)
+            self.tree_scan_worker.start()
+        self.tree_scan_queue.put((self.tree_generation, parent, path, list(self.tree_ignore_patterns), self.gitignore_matcher))
+    
+    def run_tree_scan_worker(self):
+        # Background worker that lists folders for the file tree
+        while True:
+            generation, parent, path, ignore_patterns, gitignore = self.tree_scan_queue.get()
+            if generation != self.tree_generation:
+                continue  # The tree was refreshed since this folder was queued
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except OSError:
+                mtime = None
+            entries = scan_directory(path, ignore_patterns, gitignore)
+            self.message_queue.put(('tree_entries', (generation, parent, entries, (path, mtime, ignore_patterns, gitignore))))
+    
+    def on_tree_open(self, event):
+        # List a folder the first time it is expanded
+        item = self.file_tree.focus()
+        if item in self.tree_unloaded:
+            self.load_tree_directory(item, self.file_tree.item(item, 'values')[0])
+    
+    def add_tree_entries(self, generation, parent, entries, watch, start=0):
+        # Insert scanned entries into the tree in batches so large folders don't block the UI.
+        # The folder is only watched once every entry is in the tree, so a change reported by the
+        # watcher always finds the nodes it refers to
+        if generation != self.tree_generation or (parent and not self.file_tree.exists(parent)):
+            return
+        
+        # Remove the "Loading..." placeholder
+        placeholder = self.tree_loading.pop(parent, None)
+        if placeholder and self.file_tree.exists(placeholder):
+            self.file_tree.delete(placeholder)
+        
+        end = min(start + TREE_INSERT_BATCH_SIZE, len(entries))
+        for entry in entries[start:end]:
+            self.insert_tree_entry(parent, 'end', entry)
+        
+        if end < len(entries):
+            self.root.after(1, self.add_tree_entries, generation, parent, entries, watch, end)
+        else:
+            path, mtime, ignore_patterns, gitignore = watch
+            self.tree_watcher.watch_folder(generation, path, mtime, entries, ignore_patterns, gitignore)
+    
+    def insert_tree_entry(self, parent, index, entry):
+        # Insert one scanned entry into the tree
+        name, path, is_dir, inode = entry
+        if is_dir:
+            folder_id = self.file_tree.insert(parent, index, text=f"📁 {name}", values=(path,))
+            # Placeholder child makes the folder expandable before it is listed
+            self.tree_unloaded[folder_id] = self.file_tree.insert(folder_id, 'end', text="Loading...", values=("",))
+            self.tree_items[path] = (folder_id, True)
+            
+            # Re-open folders that were expanded before a refresh
+            if path in self.tree_reopen:
+                self.tree_reopen.discard(path)
+                self.file_tree.item(folder_id, open=True)
+                self.load_tree_directory(folder_id, path)
+        else:
+            self.tree_items[path] = (self.file_tree.insert(parent, index, text=name, values=(path,)), False)
+    
+    def remove_tree_entry(self, path):
+        # Remove a node (and everything below it) from the tree
+        item, is_dir = self.tree_items.pop(path, (None, False))
+        if item is None:
+            return
+        if is_dir:
+            prefix = path.rstrip(os.sep) + os.sep
+            for child_path in [p for p in self.tree_items if p.startswith(prefix)]:
+                child_item, child_is_dir = self.tree_items.pop(child_path)
+                self.tree_unloaded.pop(child_item, None)
+                self.tree_loading.pop(child_item, None)
+            self.tree_unloaded.pop(item, None)
+            self.tree_loading.pop(item, None)
+            self.tree_watcher.unwatch_folder(path)
+        if self.file_tree.exists(item):
+            self.file_tree.delete(item)
+    
+    def apply_tree_changes(self, generation, folder, added, removed, renamed):
+        # Update only the nodes that changed in one folder, keeping the rest of the tree as it is
+        if generation != self.tree_generation or folder not in self.tree_items:
+            return
+        parent = self.tree_items[folder][0]
+        
+        for name, path, is_dir, inode in removed:
+            self.remove_tree_entry(path)
+            self.add_debug_log(f"Removed outside the editor: {path}", "SYSTEM")
+        
+        for old_entry, new_entry in renamed:
+            old_path, new_path = old_entry[1], new_entry[1]
+            item, is_dir = self.tree_items.get(old_path, (None, False))
+            if item is None:
+                added.append(new_entry)
+                continue
+            self.add_debug_log(f"Renamed outside the editor: {old_path} → {new_path}", "SYSTEM")
+            if is_dir:
+                # Paths below a renamed folder all change - list it again, keeping it expanded
+                was_open = self.file_tree.item(item, 'open')
+                self.remove_tree_entry(old_path)
+                if was_open:
+                    self.tree_reopen.add(new_path)
+                added.append(new_entry)
+            else:
+                self.tree_items[new_path] = self.tree_items.pop(old_path)
+                self.file_tree.item(item, text=new_entry[0], values=(new_path,))
+                if self.current_file == old_path:
+                    self.current_file = new_path
+                    self.file_path_label.config(text=f"File: {new_entry[0]}")
+                    self.tree_watcher.watch_file(new_path)
+        
+        for entry in added:
+            if entry[1] in self.tree_items:
+                continue
+            self.insert_tree_entry(parent, self.get_tree_insert_index(parent, entry), entry)
+            self.add_debug_log(f"Added outside the editor: {entry[1]}", "SYSTEM")
+    
+    def get_tree_insert_index(self, parent, entry):
+        # Position that keeps folders first and names in alphabetical order
+        key = (not entry[2], entry[0].lower())
+        for index, child in enumerate(self.file_tree.get_children(parent)):
+            values = self.file_tree.item(child, 'values')
+            child_path = values[0] if values else ""
+            if child_path not in self.tree_items:
+                continue
+            child_key = (not self.tree_items[child_path][1], os.path.basename(child_path).lower())
+            if child_key > key:
+                return index
+        return 'end'
+    
+    def on_file_changed_on_disk(self, file_path, stat):
+        # The open file was changed or deleted by another program
+        if file_path != self.current_file or stat == self.current_file_stat:
+            return  # Our own save, or a file that is no longer open
+        self.current_file_stat = stat
+        
+        name = os.path.basename(file_path)
+        if stat is None:
+            self.add_debug_log(f"⚠️ Open file was deleted on disk: {file_path}", "WARNING")
+            self.status_var.set(f"⚠️ {name} was deleted on disk - save to recreate it")
+            return
+        
+        self.add_debug_log(f"⚠️ Open file changed on disk: {file_path}", "WARNING")
+        self.status_var.set(f"⚠️ {name} changed on disk")
+        if self.large_file is not None:
+            if messagebox.askyesno("File Changed", f"{name} was changed outside the editor.\n\nReload it from disk?"):
+                self.large_file.modified = False  # the changes are replaced by the version on disk
+                self.code_editor.edit_modified(False)
+                self.open_large_file(file_path)
+            return
+        if messagebox.askyesno("File Changed", f"{name} was changed outside the editor.\n\nReload it from disk? Unsaved changes in the editor will be kept in the file history."):
+            try:
+                with open(file_path, 'r', encoding='utf-8') as f:
+                    content = f.read()
+            except Exception as e:
+                self.log_error(f"Could not reload file: {str(e)}", f"File: {file_path}")
+                return
+            self.add_file_version(file_path, self.code_editor.get(1.0, tk.END), "Before reload from disk")
+            self.code_editor.delete(1.0, tk.END)
+            self.code_editor.insert(1.0, content)
+            self.add_file_version(file_path, content, "Reloaded from disk")
+            self.status_var.set(f"Reloaded: {file_path}")
     
     def on_file_select(self, event):
         # Handle file selection in the tree
         selection = self.file_tree.selection()
-        if selection:
+        if len(selection) == 1:  # Ctrl/Shift-click selects files for a batch edit without opening them
             item = self.file_tree.item(selection[0])
-            file_path = item['values'][0]
+            file_path = item['values'][0] if item['values'] else ""
             if file_path and os.path.isfile(file_path):
                 self.open_file(file_path)
     
     def open_file(self, file_path):
         # Open a file in the editor
         try:
+            if os.path.getsize(file_path) > self.large_file_threshold_mb * 1024 * 1024:
+                self.open_large_file(file_path)
+                return
+            
             with open(file_path, 'r', encoding='utf-8') as f:
                 content = f.read()
             
+            self.large_file_loading = None
+            self.close_large_file()
             self.current_file = file_path
+            self.tree_watcher.watch_file(file_path)
+            self.current_file_stat = self.tree_watcher.get_file_stat(file_path)
             self.code_editor.delete(1.0, tk.END)
             self.code_editor.insert(1.0, content)
+            self.syntax_highlighter.set_file(file_path)
             self.file_path_label.config(text=f"File: {os.path.basename(file_path)}")
             self.status_var.set(f"Opened: {file_path}")
             
@@ -773,16 +5130,131 @@ Conversation Memory: Number of messages to keep for context (higher = more token
             self.add_debug_log(f"File opened: {os.path.basename(file_path)} ({len(content)} chars)", "SYSTEM")
             
             # Warn about large files for token usage
-            if len(content) > 10000:
-                self.add_debug_log(f"⚠️ Large file detected: {len(content)} chars - this may use significant tokens when included in chat context", "WARNING")
-            elif len(content) > 5000:
-                self.add_debug_log(f"📊 Medium file: {len(content)} chars - consider token usage when including in chat context", "INFO")
+            content_tokens = self.engine.token_estimator.count_text(content, self.model_var.get())
+            if content_tokens > LARGE_PROMPT_TOKENS:
+                self.add_debug_log(f"⚠️ Large file detected: ~{content_tokens:,} tokens ({len(content)} chars) - this may use significant tokens when included in chat context", "WARNING")
+            elif content_tokens > LARGE_PROMPT_TOKENS // 2:
+                self.add_debug_log(f"📊 Medium file: ~{content_tokens:,} tokens ({len(content)} chars) - consider token usage when including in chat context", "INFO")
             
         except Exception as e:
             error_msg = f"Could not open file: {str(e)}"
             self.log_error(error_msg, f"File: {file_path}")
             messagebox.showerror("Error", error_msg)
     
+    def open_large_file(self, file_path):
+        # Map and index a large file on a background thread; it is shown when the index is ready
+        self.large_file_loading = file_path
+        size_mb = os.path.getsize(file_path) / (1024 * 1024)
+        self.status_var.set(f"Opening large file {os.path.basename(file_path)} ({size_mb:.1f} MB)...")
+        
+        def load():
+            start_time = time.time()
+            try:
+                buffer = LargeFileBuffer(file_path)
+            except Exception as e:
+                self.message_queue.put(('large_file_error', (file_path, str(e))))
+                return
+            self.message_queue.put(('large_file_loaded', (file_path, buffer, time.time() - start_time)))
+        
+        threading.Thread(target=load, daemon=True).start()
+    
+    def on_large_file_loaded(self, file_path, buffer, load_time):
+        # Show a large file whose index is ready (unless another file was opened meanwhile)
+        if file_path != self.large_file_loading:
+            buffer.close()
+            return
+        self.large_file_loading = None
+        self.close_large_file()
+        
+        self.large_file = buffer
+        self.current_file = file_path
+        self.tree_watcher.watch_file(file_path)
+        self.current_file_stat = self.tree_watcher.get_file_stat(file_path)
+        self.large_file_bar.pack(fill=tk.X, padx=5, pady=(0, 5), before=self.code_editor)
+        self.syntax_highlighter.set_file(file_path)
+        self.show_large_file_lines(0)
+        self.file_path_label.config(text=f"File: {os.path.basename(file_path)} (large file)")
+        
+        # Clear conversation history when opening a new file
+        self.conversation_history.clear()
+        self.status_var.set(f"Opened: {file_path} (large file - AI edits and file context use the visible lines)")
+        if hasattr(self, 'file_context_label'):
+            self.file_context_label.config(text=f"📁 {os.path.basename(file_path)} available for context (visible lines)")
+        
+        self.add_debug_log(f"Large file opened: {os.path.basename(file_path)} ({buffer.size() / (1024 * 1024):.1f} MB, "
+                           f"{buffer.line_count():,} lines) indexed in {load_time:.2f}s - showing {LARGE_FILE_WINDOW_LINES} lines at a time, "
+                           f"file history is off for this file", "SYSTEM")
+    
+    def close_large_file(self):
+        # Leave large-file mode, offering to save changes that would otherwise be lost
+        if self.large_file is None:
+            return
+        self.commit_large_file_window()
+        if self.large_file.modified and messagebox.askyesno(
+                "Unsaved Changes", f"Save your changes to {os.path.basename(self.large_file.file_path)}?"):
+            self.save_file()
+        self.large_file.close()
+        self.large_file = None
+        self.large_file_bar.pack_forget()
+    
+    def commit_large_file_window(self):
+        # Put changes made to the window in the editor back into the large-file buffer
+        if self.large_file is not None and self.code_editor.edit_modified():
+            start, end = self.large_file_window
+            line_count = self.large_file.replace_lines(start, end, self.code_editor.get(1.0, 'end-1c'))
+            self.large_file_window = (start, start + line_count)
+            self.code_editor.edit_modified(False)
+    
+    def show_large_file_lines(self, first_line, anchor_line=None):
+        # Show the window of lines starting at first_line; anchor_line is scrolled into view
+        if self.streaming_edit_file or self.request_scheduler.pending('edit'):
+            self.status_var.set("Wait for the AI edit to finish before moving to other lines")
+            return
+        self.commit_large_file_window()
+        total = self.large_file.line_count()
+        first_line = max(0, min(first_line, total - LARGE_FILE_WINDOW_LINES))
+        last_line = min(total, first_line + LARGE_FILE_WINDOW_LINES)
+        self.code_editor.delete(1.0, tk.END)
+        self.code_editor.insert(1.0, self.large_file.get_text(first_line, last_line))
+        self.code_editor.edit_modified(False)
+        self.large_file_window = (first_line, last_line)
+        if anchor_line is not None:
+            self.code_editor.see(f"{anchor_line - first_line + 1}.0")
+        self.update_large_file_label()
+    
+    def update_large_file_label(self):
+        first_line, last_line = self.large_file_window
+        changes = " - unsaved changes" if self.large_file.modified else ""
+        self.large_file_label.config(text=f"Lines {first_line + 1:,}-{last_line:,} of {self.large_file.line_count():,}{changes}")
+    
+    def move_large_file_window(self, direction):
+        # Previous/Next: move the window by most of its size, keeping a few lines of overlap
+        if self.large_file is not None:
+            self.show_large_file_lines(self.large_file_window[0] + direction * (LARGE_FILE_WINDOW_LINES - 50))
+    
+    def goto_large_file_line(self):
+        # Show the window around a line number entered in the navigation bar
+        try:
+            line = int(self.large_file_goto_var.get().replace(',', '')) - 1
+        except ValueError:
+            return
+        if self.large_file is not None:
+            line = max(0, min(line, self.large_file.line_count() - 1))
+            self.show_large_file_lines(line - LARGE_FILE_WINDOW_LINES // 2, line)
+            self.code_editor.mark_set(tk.INSERT, f"{line - self.large_file_window[0] + 1}.0")
+    
+    def on_editor_scroll(self, event):
+        # In large-file mode, scrolling past either end of the window moves it by half its size
+        if self.large_file is None:
+            return
+        up = event.num == 4 or getattr(event, 'delta', 0) > 0
+        top, bottom = self.code_editor.yview()
+        start, end = self.large_file_window
+        if up and top <= 0.0 and start > 0:
+            self.show_large_file_lines(start - LARGE_FILE_WINDOW_LINES // 2, start)
+        elif not up and bottom >= 1.0 and end < self.large_file.line_count():
+            self.show_large_file_lines(start + LARGE_FILE_WINDOW_LINES // 2, end - 1)
+    
     def edit_code(self):
         # Edit code using AI prompt
         if not self.api_key:
@@ -801,193 +5273,259 @@ Conversation Memory: Number of messages to keep for context (higher = more token
         
         current_content = self.code_editor.get(1.0, tk.END)
         file_path = self.current_file
+        settings = self.snapshot_settings()
+        if self.large_file is not None:
+            first_line, last_line = self.large_file_window
+            self.add_debug_log(f"Large file: the AI edit covers the visible lines {first_line + 1:,}-{last_line:,}", "INFO")
+        history = self.conversation_history.messages()
+        
+        # The same edit twice (a double Enter) is coalesced into the one in flight; a different one has to wait
+        key = make_request_key('edit', settings, file_path, prompt, current_content)
+        if self.request_scheduler.is_in_flight(key):
+            self.add_debug_log("Duplicate edit request not sent - identical request already in flight", "INFO")
+            return
+        if self.request_scheduler.pending('edit'):
+            messagebox.showwarning("Warning", "An AI edit is already running - wait for it or click Cancel")
+            return
         
-        # Show status with context info
-        context_info = f" (with {len(self.conversation_history)//2} previous interactions)" if self.conversation_history else ""
-        self.status_var.set(f"AI is editing your code...{context_info}")
+        # Estimate the request size before sending anything
+        model_name = settings.model
+        planned = self.engine.plan_edit(prompt, current_content, file_path, settings)
+        protocol, user_message, edit_text, plan = planned
+        if protocol == 'parallel':
+            estimate = self.engine.combine_estimates([
+                self.engine.estimate_request(self.engine.build_edit_messages(message, file_path, protocol), settings,
+                                             self.engine.expected_output_tokens('full', text, model_name))
+                for start, end, message, text in plan])
+        else:
+            messages = self.engine.build_edit_messages(user_message, file_path, protocol, history)
+            estimate = self.engine.estimate_request(messages, settings,
+                                                    self.engine.expected_output_tokens(protocol, edit_text, model_name),
+                                                    protocol)
+        if not self.confirm_request_size(estimate, model_name):
+            return
+        
+        # Run AI interaction on the request scheduler
+        request, coalesced = self.request_scheduler.submit('edit', key, settings, self.run_ai_edit,
+                                                           prompt, current_content, file_path, planned, history)
+        if coalesced:
+            self.add_debug_log("Duplicate edit request not sent - identical request already in flight", "INFO")
+            return
         
-        # Run AI interaction in background
-        threading.Thread(target=self.run_ai_edit, 
-                       args=(prompt, current_content, file_path), 
-                       daemon=True).start()
+        # Show status with context info
+        context_info = f" (with {len(self.conversation_history)} previous interactions)" if self.conversation_history else ""
+        self.status_var.set(f"AI is editing your code...{context_info} | {self.engine.format_estimate(estimate)}")
     
-    def run_ai_edit(self, prompt, current_content, file_path):
-        # Run AI editing in background thread
+    def run_ai_edit(self, request, prompt, current_content, file_path, planned, history):
+        # Run AI editing on a scheduler worker; planned is plan_edit()'s result from the UI thread
         start_time = datetime.datetime.now()
         
+        # Full edits stream into the editor; patch replies only update the status until they are applied
+        def on_first_token(ttft, streams_code):
+            if streams_code:
+                self.message_queue.put(('edit_stream_start', (file_path, ttft)))
+            else:
+                self.message_queue.put(('edit_stream_progress', ttft))
+        
+        def on_progress(done, total):
+            self.message_queue.put(('edit_parallel_progress', (done, total)))
+        
         try:
+            request.check_cancelled()
+            
             # Log the start of the request
             self.add_debug_log(f"Starting AI edit for file: {os.path.basename(file_path)}", "INFO")
             self.add_debug_log(f"Prompt: {prompt[:100]}{'...' if len(prompt) > 100 else ''}", "REQUEST")
             
-            # Code editing mode - edit the code
-            system_message = f"""You are an expert code editor. You will receive a file path and current content, along with a user prompt describing what changes to make.
-
-File: {file_path}
-
-Please provide ONLY the edited code content. Do not include explanations, markdown formatting, or any other text - just the pure code that should replace the current content.
-
-If the user wants to add new functionality, modify existing code, fix bugs, or make any other changes, implement them directly in the code you return.
-
-IMPORTANT: Always work with the CURRENT content that is provided. Do not start from scratch unless explicitly requested. Make incremental changes based on the existing code."""
-
-            # Build messages array with conversation history
-            messages = [{"role": "system", "content": system_message}]
-            
-            # Add conversation history if this isn't the first prompt
-            if self.conversation_history:
-                messages.extend(self.conversation_history)
-            
-            # Add current file content and user prompt
-            messages.append({
-                "role": "user", 
-                "content": f"Current file content:\n{current_content}\n\nUser request: {prompt}"
-            })
+            edited_content = self.engine.edit(request, prompt, current_content, file_path, planned, history,
+                                              self.edit_stream_buffer.append, on_first_token, on_progress)
             
-            # Log API request details
-            model_name = self.model_var.get()
-            prompt_length = len(f"Current file content:\n{current_content}\n\nUser request: {prompt}")
+            # Queue the result for UI update (the conversation history is updated there)
+            self.message_queue.put(('edit_complete', (file_path, prompt, current_content, edited_content)))
+        
+        except RequestCancelled:
+            response_time = (datetime.datetime.now() - start_time).total_seconds()
+            self.add_debug_log(f"AI edit cancelled after {response_time:.2f}s", "WARNING")
+            self.message_queue.put(('edit_cancelled', file_path))
+        
+        except Exception as e:
+            # Calculate response time for errors
+            response_time = (datetime.datetime.now() - start_time).total_seconds()
             
-            # Warn about large files for code editing
-            if len(current_content) > 15000:
-                self.add_debug_log(f"⚠️ Large file for editing: {len(current_content)} chars - this will use significant tokens", "WARNING")
-            elif len(current_content) > 8000:
-                self.add_debug_log(f"📊 Medium file for editing: {len(current_content)} chars - moderate token usage expected", "INFO")
+            # Provide better error information for model-specific issues
+            error_msg = describe_api_error(e)
             
-            self.log_api_request(
-                model=model_name,
-                temperature=self.temperature,
-                max_tokens=self.max_tokens if not model_name.startswith('gpt-5') else self.max_completion_tokens,
-                message_count=len(messages),
-                prompt_length=prompt_length
-            )
+            # Log the error
+            self.log_error(error_msg, f"Response time: {response_time:.2f}s")
             
-            # Build API parameters based on model and user settings
-            api_params = {
-                "model": model_name,
-                "messages": messages,
-                "temperature": self.temperature
-            }
+            self.message_queue.put(('edit_error', error_msg))
+    
+    def start_stream_rendering(self):
+        # Start the per-frame loop that writes buffered stream deltas into the widgets
+        if not self.stream_frame_scheduled:
+            self.stream_frame_scheduled = True
+            self.root.after(STREAM_FRAME_MS, self.render_stream_frame)
+    
+    def render_stream_frame(self):
+        # Write everything streamed since the last frame with a single insert per widget
+        self.stream_frame_scheduled = False
+        self.flush_edit_stream()
+        self.flush_chat_stream()
+        
+        # Keep rendering while a stream is still active
+        if self.streaming_edit_file or self.chat_streaming:
+            self.start_stream_rendering()
+    
+    def flush_edit_stream(self):
+        # Append buffered edit text to the editor (only if the streamed file is still open)
+        text = self.edit_stream_buffer.drain()
+        if text and self.streaming_edit_file and self.current_file == self.streaming_edit_file:
+            self.code_editor.insert('end-1c', text)
+            self.code_editor.see(tk.END)
+    
+    def process_ui_messages(self, messages):
+        # Handle a batch of messages from background threads (dispatched by the message channel)
+        self.flush_debug_log()
+        for msg_type, data in messages:
+            if msg_type == 'edit_stream_start':
+                # First tokens of a streamed edit - save the current version and start rendering
+                file_path, ttft = data
+                self.streaming_edit_file = file_path
+                if self.current_file == file_path:
+                    self.streaming_edit_backup = self.code_editor.get(1.0, tk.END)
+                    self.add_file_version(file_path, self.streaming_edit_backup, "Before AI edit")
+                    self.code_editor.delete(1.0, tk.END)
+                self.status_var.set(f"AI is streaming edits... (first token after {ttft:.2f}s)")
+                self.start_stream_rendering()
             
-            # GPT-5 uses max_completion_tokens, others use max_tokens
-            if model_name.startswith('gpt-5'):
-                api_params["max_completion_tokens"] = self.max_completion_tokens
-            else:
-                api_params["max_tokens"] = self.max_tokens
+            elif msg_type == 'token_usage':
+                self.update_token_usage(*data)
             
-            # Log the actual API call
-            self.add_debug_log(f"Making API call with parameters: {api_params}", "API")
+            elif msg_type == 'edit_parallel_progress':
+                done, total = data
+                self.status_var.set(f"AI is editing {total} sections in parallel... ({done}/{total} done)")
             
-            # Make the API call
-            response = self.client.chat.completions.create(**api_params)
+            elif msg_type == 'edit_stream_progress':
+                # Search/replace edits are not rendered until they have been applied
+                self.status_var.set(f"AI is writing edits... (first token after {data:.2f}s)")
             
-            # Calculate response time
-            end_time = datetime.datetime.now()
-            response_time = (end_time - start_time).total_seconds()
+            elif msg_type == 'edit_complete':
+                file_path, prompt, before, data = data
+                self.flush_edit_stream()
+                streamed = self.streaming_edit_file is not None and self.current_file == self.streaming_edit_file
+                self.streaming_edit_file = None
+                self.streaming_edit_backup = None
+                
+                # Add to conversation history for context - the edit is remembered as a diff, not a file snapshot
+                dropped = self.conversation_history.add_edit_turn(file_path, prompt, before, data)
+                self.log_conversation_memory(dropped)
+                
+                if self.current_file != file_path:
+                    self.add_debug_log(f"⚠️ AI edit of {os.path.basename(file_path)} not applied - another file was opened meanwhile", "WARNING")
+                    self.status_var.set(f"AI edit of {os.path.basename(file_path)} discarded - another file is open")
+                    continue
+                
+                # Add current version to history before updating
+                if self.current_file and not streamed:
+                    current_content = self.code_editor.get(1.0, tk.END)
+                    self.add_file_version(self.current_file, current_content, "Before AI edit")
+                
+                # Streamed edits are already in the editor
+                if not streamed or self.code_editor.get(1.0, 'end-1c') != data:
+                    self.code_editor.delete(1.0, tk.END)
+                    self.code_editor.insert(1.0, data)
+                
+                # Add new AI-edited version to history
+                if self.current_file:
+                    self.add_file_version(self.current_file, data, "AI edit")
+                
+                # Clear the prompt input after successful editing
+                self.prompt_text.delete(1.0, tk.END)
+                self.status_var.set("AI editing completed")
+                messagebox.showinfo("Success", "Code has been edited by AI!")
             
-            # Get the response
-            ai_response = response.choices[0].message.content.strip()
+            elif msg_type == 'batch_file_started':
+                self.on_batch_file_started(*data)
             
-            # Log API response details
-            token_usage = response.usage.total_tokens if hasattr(response, 'usage') and response.usage else "Unknown"
-            self.log_api_response(response_time, token_usage, model_name)
+            elif msg_type == 'batch_file_done':
+                self.on_batch_file_done(*data)
             
-            # Track token usage if available
-            if hasattr(response, 'usage') and response.usage and hasattr(response.usage, 'total_tokens'):
-                self.update_token_usage(response.usage.total_tokens, model_name)
+            elif msg_type == 'tree_entries':
+                # A folder has been listed by the scan worker
+                self.add_tree_entries(*data)
             
-            # Log response summary
-            self.add_debug_log(f"AI Response Length: {len(ai_response)} characters", "RESPONSE")
+            elif msg_type == 'tree_changes':
+                # The watcher found added, removed or renamed entries in a listed folder
+                self.apply_tree_changes(*data)
             
-            # Add to conversation history for context
-            self.conversation_history.append({
-                "role": "user", 
-                "content": f"Current file content:\n{current_content}\n\nUser request: {prompt}"
-            })
-            self.conversation_history.append({
-                "role": "assistant", 
-                "content": ai_response
-            })
+            elif msg_type == 'file_changed_on_disk':
+                self.on_file_changed_on_disk(*data)
             
-            # Keep only last N messages to prevent context from getting too long
-            if len(self.conversation_history) > self.conversation_memory_limit:
-                old_count = len(self.conversation_history)
-                self.conversation_history = self.conversation_history[-self.conversation_memory_limit:]
-                self.add_debug_log(f"Conversation history trimmed: {old_count} → {self.conversation_memory_limit} messages", "INFO")
+            elif msg_type == 'large_file_loaded':
+                self.on_large_file_loaded(*data)
             
-            # Code editing mode - replace code content
-            # Remove markdown code blocks if present
-            edited_content = ai_response
-            if edited_content.startswith('```'):
-                lines = edited_content.split('\n')
-                if len(lines) > 2:
-                    edited_content = '\n'.join(lines[1:-1])
-                    self.add_debug_log("Removed markdown code blocks from response", "INFO")
+            elif msg_type == 'batch_files':
+                self.on_batch_files_collected(data)
             
-            # Queue the result for UI update
-            self.message_queue.put(('edit_complete', edited_content))
+            elif msg_type == 'chat_context':
+                self.submit_chat(*data)
             
-        except Exception as e:
-            # Calculate response time for errors
-            end_time = datetime.datetime.now()
-            response_time = (end_time - start_time).total_seconds()
+            elif msg_type == 'syntax_tokens':
+                self.syntax_highlighter.on_tokens(data)
             
-            # Provide better error information for model-specific issues
-            error_msg = str(e)
-            if "max_tokens" in error_msg and "gpt-5" in error_msg.lower():
-                error_msg = "GPT-5 model error: This model uses 'max_completion_tokens' instead of 'max_tokens'. Please try again."
-            elif "unsupported parameter" in error_msg:
-                error_msg = f"Model parameter error: {error_msg}. This may be a model-specific issue."
-            elif "temperature" in error_msg.lower():
-                error_msg = f"Temperature error: {error_msg}. Try adjusting the temperature in Settings."
+            elif msg_type == 'large_file_error':
+                file_path, error = data
+                if file_path == self.large_file_loading:
+                    self.large_file_loading = None
+                    self.log_error(f"Could not open large file: {error}", f"File: {file_path}")
+                    messagebox.showerror("Error", f"Could not open file: {error}")
             
-            # Log the error
-            self.log_error(error_msg, f"Response time: {response_time:.2f}s")
+            elif msg_type == 'chat_stream_start':
+                # First tokens of a streamed chat reply - add the AI header and start rendering
+                self.begin_chat_stream("AI")
+                self.status_var.set(f"AI is responding... (first token after {data:.2f}s)")
             
-            self.message_queue.put(('edit_error', error_msg))
-    
-    def check_queue(self):
-        # Check for messages from background threads
-        try:
-            while True:
-                msg_type, data = self.message_queue.get_nowait()
+            elif msg_type == 'chat_complete':
+                # Add AI response to chat history
+                message, ai_response = data
+                if self.chat_streaming:
+                    self.end_chat_stream()
+                else:
+                    self.add_chat_message("AI", ai_response, "assistant")
                 
-                if msg_type == 'edit_complete':
-                    # Add current version to history before updating
-                    if self.current_file:
-                        current_content = self.code_editor.get(1.0, tk.END)
-                        self.add_file_version(self.current_file, current_content, "Before AI edit")
-                    
+                # Add to conversation history for context
+                dropped = self.conversation_history.add_chat_turn(message, ai_response)
+                self.log_conversation_memory(dropped)
+                self.status_var.set("AI chat completed")
+            
+            elif msg_type in ('edit_error', 'edit_cancelled'):
+                # Restore the editor if a streamed edit failed or was cancelled part way through
+                self.edit_stream_buffer.drain()
+                if self.streaming_edit_backup is not None and self.current_file == self.streaming_edit_file:
                     self.code_editor.delete(1.0, tk.END)
-                    self.code_editor.insert(1.0, data)
-                    
-                    # Add new AI-edited version to history
-                    if self.current_file:
-                        self.add_file_version(self.current_file, data, "AI edit")
-                    
-                    # Clear the prompt input after successful editing
-                    self.prompt_text.delete(1.0, tk.END)
-                    self.status_var.set("AI editing completed")
-                    messagebox.showinfo("Success", "Code has been edited by AI!")
-                
-                elif msg_type == 'chat_complete':
-                    # Add AI response to chat history
-                    self.add_chat_message("AI", data, "assistant")
-                    self.status_var.set("AI chat completed")
+                    self.code_editor.insert(1.0, self.streaming_edit_backup)
+                self.streaming_edit_file = None
+                self.streaming_edit_backup = None
                 
-                elif msg_type == 'edit_error':
+                if msg_type == 'edit_cancelled':
+                    self.status_var.set("AI edit cancelled")
+                else:
                     self.status_var.set(f"Error: {data}")
                     messagebox.showerror("AI Error", f"Failed to edit code: {data}")
-                
-                elif msg_type == 'chat_error':
-                    self.status_var.set(f"Chat Error: {data}")
-                    messagebox.showerror("AI Chat Error", f"Failed to get AI response: {data}")
-                
-        except queue.Empty:
-            pass
-        
-        # Schedule next check
-        self.root.after(100, self.check_queue)
+            
+            elif msg_type == 'chat_error':
+                # Close off a partially streamed reply
+                if self.chat_streaming:
+                    self.end_chat_stream()
+                self.status_var.set(f"Chat Error: {data}")
+                messagebox.showerror("AI Chat Error", f"Failed to get AI response: {data}")
+            
+            elif msg_type == 'chat_cancelled':
+                self.flush_chat_stream()
+                if self.chat_streaming:
+                    self.end_chat_stream()
+                self.add_chat_message("System", "Reply cancelled", "system")
+                self.status_var.set("AI chat cancelled")
     
     def save_file(self):
         # Save the current file
@@ -995,10 +5533,17 @@ IMPORTANT: Always work with the CURRENT content that is provided. Do not start f
             messagebox.showwarning("Warning", "No file to save")
             return
         
+        if self.large_file is not None:
+            self.save_large_file()
+            return
+        
         try:
             content = self.code_editor.get(1.0, tk.END)
             with open(self.current_file, 'w', encoding='utf-8') as f:
                 f.write(content)
+            self.current_file_stat = self.tree_watcher.get_file_stat(self.current_file)
+            self.tree_watcher.watch_file(self.current_file)
+            self.project_indexer.refresh()
             
             # Add saved version to history
             self.add_file_version(self.current_file, content, "Manual save")
@@ -1012,6 +5557,23 @@ IMPORTANT: Always work with the CURRENT content that is provided. Do not start f
             self.log_error(error_msg, f"File: {self.current_file}")
             messagebox.showerror("Error", error_msg)
     
+    def save_large_file(self):
+        # Save a large file by streaming its pieces to disk (unchanged ranges come straight from the mapping)
+        try:
+            start_time = time.time()
+            self.commit_large_file_window()
+            self.large_file.save()
+            self.current_file_stat = self.tree_watcher.get_file_stat(self.current_file)
+            self.tree_watcher.watch_file(self.current_file)
+            self.update_large_file_label()
+            self.status_var.set(f"Saved: {self.current_file}")
+            self.add_debug_log(f"Large file saved: {os.path.basename(self.current_file)} "
+                               f"({self.large_file.size() / (1024 * 1024):.1f} MB) in {time.time() - start_time:.2f}s", "SYSTEM")
+        except Exception as e:
+            error_msg = f"Could not save file: {str(e)}"
+            self.log_error(error_msg, f"File: {self.current_file}")
+            messagebox.showerror("Error", error_msg)
+    
     def revert_file(self):
         # Revert file to original content
         if not self.current_file:
@@ -1021,6 +5583,15 @@ IMPORTANT: Always work with the CURRENT content that is provided. Do not start f
         # Show file history dialog for reverting
         self.show_file_history()
     
+    def cancel_requests(self, kind):
+        # Cancel the in-flight AI request of one kind; a streaming reply stops at its next chunk
+        cancelled = self.request_scheduler.cancel(kind)
+        if cancelled:
+            self.add_debug_log(f"Cancelling {cancelled} {kind} request(s)", "INFO")
+            self.status_var.set(f"Cancelling AI {kind}...")
+        else:
+            self.status_var.set(f"No AI {kind} in progress")
+    
     def clear_conversation_history(self):
         # Clear the AI conversation history to start fresh
         self.conversation_history.clear()
@@ -1036,13 +5607,63 @@ IMPORTANT: Always work with the CURRENT content that is provided. Do not start f
         if not message:
             return
         
+        # One reply streams into the transcript at a time
+        if self.request_scheduler.pending('chat') or self.chat_preparing:
+            messagebox.showwarning("Warning", "The AI is still replying - wait for it or click Cancel")
+            return
+        
+        # Get file context if available and checkbox is checked
+        file_context = ""
+        if self.include_file_context.get() and self.current_file:
+            file_context = self.get_file_context_for_chat()
+        context_file = self.current_file if file_context else None  # another file may be opened meanwhile
+        
+        # Find project snippets relevant to the message on a worker thread (their files are read
+        # from disk); the message is sent when they arrive
+        settings = self.snapshot_settings()
+        if not (self.include_project_context.get() and self.current_folder):
+            self.submit_chat(message, file_context, context_file, settings, "", 0)
+            return
+        folder = self.current_folder
+        self.chat_preparing = True
+        self.status_var.set("Finding project snippets...")
+        
+        def find_snippets():
+            try:
+                project_context, snippet_count = self.get_project_context(message, settings.model, folder, context_file)
+            except Exception as e:
+                self.add_debug_log(f"⚠️ Could not attach project snippets: {str(e)}", "WARNING")
+                project_context, snippet_count = "", 0
+            self.message_queue.put(('chat_context', (message, file_context, context_file, settings, project_context, snippet_count)))
+        
+        threading.Thread(target=find_snippets, daemon=True).start()
+    
+    def submit_chat(self, message, file_context, context_file, settings, project_context, snippet_count):
+        # Estimate, confirm and send a chat message once its context is ready
+        self.chat_preparing = False
+        model_name = settings.model
+        
+        # Estimate the request size before sending anything
+        messages = self.engine.build_chat_messages(message, file_context, project_context, self.conversation_history.messages())
+        estimate = self.engine.estimate_request(messages, settings, self.engine.expected_output_tokens('chat', message, model_name))
+        if not self.confirm_request_size(estimate, model_name):
+            self.status_var.set("Ready")
+            return
+        
+        if file_context:
+            self.add_debug_log(f"File context included: {os.path.basename(context_file)}", "INFO")
+        else:
+            self.add_debug_log("No file context included", "INFO")
+        
         # Add user message to chat history
         self.add_chat_message("You", message, "user")
         
         # Show file context if available and checkbox is checked
-        if self.current_file and self.include_file_context.get():
-            file_info = f"📁 {os.path.basename(self.current_file)}"
+        if file_context:
+            file_info = f"📁 {os.path.basename(context_file)}"
             self.add_chat_message("System", file_info, "system")
+        if project_context:
+            self.add_chat_message("System", f"🔎 {snippet_count} project snippets attached", "system")
         
         # Clear input
         self.chat_input.delete(1.0, tk.END)
@@ -1051,13 +5672,15 @@ IMPORTANT: Always work with the CURRENT content that is provided. Do not start f
         self.notebook.select(self.chat_tab)
         
         # Show status
-        self.status_var.set("AI is thinking...")
+        self.status_var.set(f"AI is thinking... | {self.engine.format_estimate(estimate)}")
         
-        # Run AI chat in background
-        threading.Thread(target=self.run_ai_chat, args=(message,), daemon=True).start()
+        # Run AI chat on the request scheduler
+        key = make_request_key('chat', settings, messages)
+        self.request_scheduler.submit('chat', key, settings, self.run_ai_chat, message, messages)
     
     def add_chat_message(self, sender, message, role):
         # Add a message to the chat history display
+        self.build_chat_tab()
         self.chat_history.config(state=tk.NORMAL)
         
         # Add timestamp and sender
@@ -1082,145 +5705,79 @@ IMPORTANT: Always work with the CURRENT content that is provided. Do not start f
         self.chat_history.see(tk.END)
         self.chat_history.config(state=tk.DISABLED)
     
-    def run_ai_chat(self, message):
-        # Run AI chat in background thread
+    def begin_chat_stream(self, sender):
+        # Add the sender header for a reply that will be streamed into the chat history
+        self.build_chat_tab()
+        self.chat_history.config(state=tk.NORMAL)
+        timestamp = datetime.datetime.now().strftime("%H:%M")
+        self.chat_history.insert(tk.END, f"[{timestamp}] {sender}: ", "sender")
+        self.chat_history.see(tk.END)
+        self.chat_history.config(state=tk.DISABLED)
+        
+        self.chat_streaming = True
+        self.chat_stream_has_text = False
+        self.start_stream_rendering()
+    
+    def flush_chat_stream(self):
+        # Append buffered chat text to the chat history in one insert (text that arrives before
+        # 'chat_stream_start' is processed stays buffered for the first frame after it)
+        if not self.chat_streaming:
+            return
+        text = self.chat_stream_buffer.drain()
+        
+        # Match the stripped output of non-streamed replies
+        if not self.chat_stream_has_text:
+            text = text.lstrip()
+        if not text:
+            return
+        
+        self.chat_stream_has_text = True
+        self.chat_history.config(state=tk.NORMAL)
+        self.chat_history.insert(tk.END, text, "message")
+        self.chat_history.see(tk.END)
+        self.chat_history.config(state=tk.DISABLED)
+    
+    def end_chat_stream(self):
+        # Write any remaining text and close off the streamed reply
+        self.flush_chat_stream()
+        self.chat_streaming = False
+        
+        self.chat_history.config(state=tk.NORMAL)
+        self.chat_history.insert(tk.END, "\n\n", "message")
+        self.chat_history.see(tk.END)
+        self.chat_history.config(state=tk.DISABLED)
+    
+    def run_ai_chat(self, request, message, messages):
+        # Run AI chat on a scheduler worker; messages were built on the UI thread
         start_time = datetime.datetime.now()
         
         try:
+            request.check_cancelled()
+            
             # Log the start of the chat request
             self.add_debug_log(f"Starting AI chat request", "INFO")
             self.add_debug_log(f"Message: {message[:100]}{'...' if len(message) > 100 else ''}", "REQUEST")
             
-            # Get file context if available and checkbox is checked
-            file_context = ""
-            if self.include_file_context.get() and self.current_file:
-                file_context = self.get_file_context_for_chat()
-                self.add_debug_log(f"File context included: {os.path.basename(self.current_file)}", "INFO")
-                
-                # Warn about large file context
-                if len(file_context) > 15000:
-                    self.add_debug_log(f"⚠️ Large file context included: {len(file_context)} chars - this will use significant tokens", "WARNING")
-                elif len(file_context) > 8000:
-                    self.add_debug_log(f"📊 Medium file context: {len(file_context)} chars - moderate token usage expected", "INFO")
-            else:
-                self.add_debug_log("No file context included", "INFO")
-            
-            # Build system message for chat
-            if file_context:
-                system_message = f"""You are an expert programming assistant and code reviewer. You will receive user messages asking questions or seeking advice.
-
-Current File Context:
-{file_context}
-
-Please provide helpful, informative responses about programming concepts, code, or any questions the user asks. You can:
-- Explain how the current code works
-- Suggest improvements to the code
-- Answer programming questions
-- Provide code examples
-- Give best practice advice
-- Help debug issues
-
-You can reference and discuss the attached file content. Be conversational, helpful, and provide practical guidance."""
-            else:
-                system_message = """You are an expert programming assistant and code reviewer. You will receive user messages asking questions or seeking advice.
-
-Please provide helpful, informative responses about programming concepts, code, or any questions the user asks. You can:
-- Answer programming questions
-- Provide code examples
-- Give best practice advice
-- Help debug issues
-- Explain programming concepts
-
-Be conversational, helpful, and provide practical guidance."""
-            
-            # Build messages array with conversation history
-            messages = [{"role": "system", "content": system_message}]
-            
-            # Add conversation history if this isn't the first message
-            if self.conversation_history:
-                messages.extend(self.conversation_history)
-            
-            # Add current user message
-            messages.append({"role": "user", "content": message})
-            
-            # Log API request details
-            model_name = self.model_var.get()
-            prompt_length = len(system_message) + len(message)
-            
-            self.log_api_request(
-                model=model_name,
-                temperature=self.temperature,
-                max_tokens=self.max_tokens if not model_name.startswith('gpt-5') else self.max_completion_tokens,
-                message_count=len(messages),
-                prompt_length=prompt_length
-            )
-            
-            # Make API call with correct parameters for different models
-            model_name = self.model_var.get()
-            
-            # Build API parameters based on model and user settings
-            api_params = {
-                "model": model_name,
-                "messages": messages,
-                "temperature": self.temperature
-            }
-            
-            # GPT-5 uses max_completion_tokens, others use max_tokens
-            if model_name.startswith('gpt-5'):
-                api_params["max_completion_tokens"] = self.max_completion_tokens
-            else:
-                api_params["max_tokens"] = self.max_tokens
-            
-            # Log the actual API call
-            self.add_debug_log(f"Making chat API call with parameters: {api_params}", "API")
-            
-            # Make the API call
-            response = self.client.chat.completions.create(**api_params)
-            
-            # Calculate response time
-            end_time = datetime.datetime.now()
-            response_time = (end_time - start_time).total_seconds()
-            
-            # Get the response
-            ai_response = response.choices[0].message.content.strip()
-            
-            # Log API response details
-            token_usage = response.usage.total_tokens if hasattr(response, 'usage') and response.usage else "Unknown"
-            self.log_api_response(response_time, token_usage, model_name)
-            
-            # Track token usage if available
-            if hasattr(response, 'usage') and response.usage and hasattr(response.usage, 'total_tokens'):
-                self.update_token_usage(response.usage.total_tokens, model_name)
-            
-            # Log response summary
-            self.add_debug_log(f"Chat Response Length: {len(ai_response)} characters", "RESPONSE")
+            # Stream the reply into the chat history; deltas are batched per frame by the UI
+            def on_first_token(ttft):
+                self.message_queue.put(('chat_stream_start', ttft))
             
-            # Add to conversation history for context
-            self.conversation_history.append({"role": "user", "content": message})
-            self.conversation_history.append({"role": "assistant", "content": ai_response})
-            
-            # Keep only last N messages to prevent context from getting too long
-            if len(self.conversation_history) > self.conversation_memory_limit:
-                old_count = len(self.conversation_history)
-                self.conversation_history = self.conversation_history[-self.conversation_memory_limit:]
-                self.add_debug_log(f"Conversation history trimmed: {old_count} → {self.conversation_memory_limit} messages", "INFO")
-            
-            # Queue the result for UI update
-            self.message_queue.put(('chat_complete', ai_response))
+            ai_response = self.engine.chat(request, message, messages, self.chat_stream_buffer.append, on_first_token)
             
+            # Queue the result for UI update (the conversation history is updated there)
+            self.message_queue.put(('chat_complete', (message, ai_response)))
+        
+        except RequestCancelled:
+            response_time = (datetime.datetime.now() - start_time).total_seconds()
+            self.add_debug_log(f"AI chat cancelled after {response_time:.2f}s", "WARNING")
+            self.message_queue.put(('chat_cancelled', None))
+        
         except Exception as e:
             # Calculate response time for errors
-            end_time = datetime.datetime.now()
-            response_time = (end_time - start_time).total_seconds()
+            response_time = (datetime.datetime.now() - start_time).total_seconds()
             
             # Provide better error information for model-specific issues
-            error_msg = str(e)
-            if "max_tokens" in error_msg and "gpt-5" in error_msg.lower():
-                error_msg = "GPT-5 model error: This model uses 'max_completion_tokens' instead of 'max_tokens'. Please try again."
-            elif "unsupported parameter" in error_msg:
-                error_msg = f"Model parameter error: {error_msg}. This may be a model-specific issue."
-            elif "temperature" in error_msg.lower():
-                error_msg = f"Temperature error: {error_msg}. Try adjusting the temperature in Settings."
+            error_msg = describe_api_error(e)
             
             # Log the error
             self.log_error(error_msg, f"Chat response time: {response_time:.2f}s")
@@ -1229,6 +5786,7 @@ Be conversational, helpful, and provide practical guidance."""
     
     def clear_chat_history(self):
         # Clear the chat display (but keep conversation history for context)
+        self.build_chat_tab()
         self.chat_history.config(state=tk.NORMAL)
         self.chat_history.delete(1.0, tk.END)
         self.chat_history.config(state=tk.DISABLED)
@@ -1236,6 +5794,8 @@ Be conversational, helpful, and provide practical guidance."""
 
     def get_current_file_content(self):
         # Get the content of the currently selected file for AI context
+        if self.large_file is not None:
+            return self.code_editor.get(1.0, 'end-1c')  # only the visible lines of a large file
         if self.current_file and os.path.exists(self.current_file):
             try:
                 with open(self.current_file, 'r', encoding='utf-8') as f:
@@ -1244,6 +5804,48 @@ Be conversational, helpful, and provide practical guidance."""
                 return f"Error reading file: {str(e)}"
         return None
     
+    def get_project_context(self, query, model_name, folder, exclude=None):
+        # Top project snippets for a chat message, packed under the project context token budget.
+        # Returns (context text, snippet count); runs on a worker thread since snippets are read from disk
+        if not self.project_index.snippet_count():
+            self.add_debug_log("Project index is still being built - no project snippets attached", "WARNING")
+            return "", 0
+        
+        start_time = time.time()
+        parts = []
+        used_tokens = 0
+        file_lines = {}
+        for score, file_path, start, end in self.project_index.search(query, limit=16):
+            if file_path == exclude:
+                continue  # Already attached in full
+            if file_path not in file_lines:
+                try:
+                    with open(file_path, 'r', encoding='utf-8', errors='replace') as f:
+                        file_lines[file_path] = f.read().splitlines()
+                except OSError:
+                    file_lines[file_path] = []
+            text = "\n".join(file_lines[file_path][start - 1:end])
+            if not text.strip():
+                continue
+            snippet = f"{os.path.relpath(file_path, folder)} (lines {start}-{end}):\n```\n{text}\n```"
+            tokens = self.engine.token_estimator.count_text(snippet, model_name)
+            if used_tokens + tokens > self.project_context_tokens:
+                continue
+            parts.append(snippet)
+            used_tokens += tokens
+        
+        self.add_debug_log(f"Project context: {len(parts)} snippets, ~{used_tokens} tokens "
+                           f"(searched {self.project_index.snippet_count()} snippets in {(time.time() - start_time) * 1000:.1f}ms)", "INFO")
+        return "\n\n".join(parts), len(parts)
+    
+    def on_project_indexed(self, root, indexed, removed, seconds, first_pass):
+        # Called from the indexer thread after a pass that changed the index
+        if first_pass:
+            self.add_debug_log(f"Project index built: {self.project_index.file_count()} files, "
+                               f"{self.project_index.snippet_count()} snippets in {seconds:.2f}s", "SYSTEM")
+        else:
+            self.add_debug_log(f"Project index updated: {indexed} files re-indexed, {removed} removed", "INFO")
+    
     def get_file_context_for_chat(self):
         # Get file context information for chat
         if not self.current_file:
@@ -1259,11 +5861,9 @@ Be conversational, helpful, and provide practical guidance."""
 
     def on_model_change(self, event):
         # Callback for model selection changes
+        # The model is a request parameter, so the client (and its warm connections) is kept
         selected_model = self.model_var.get()
         self.model = selected_model
-        self.client = None # Clear client if model changes
-        if self.api_key:
-            self.client = openai.OpenAI(api_key=self.api_key)
         
         # Log the model change
         self.add_debug_log(f"Model changed to: {selected_model}", "SYSTEM")
@@ -1272,9 +5872,11 @@ Be conversational, helpful, and provide practical guidance."""
     def on_api_key_change(self, event):
         # Callback for API key changes
         new_api_key = self.api_key_var.get()
+        if new_api_key == self.api_key:
+            return  # Focus left the field without a change - keep the client and its connections
         if new_api_key:
             self.api_key = new_api_key
-            self.client = openai.OpenAI(api_key=self.api_key)
+            self.engine.setup_api_client(self.api_key, self.api_backend)
             
             # Log the API key change (masked for security)
             masked_key = new_api_key[:8] + "..." + new_api_key[-4:] if len(new_api_key) > 12 else "***"
@@ -1282,31 +5884,53 @@ Be conversational, helpful, and provide practical guidance."""
             messagebox.showinfo("API Key Changed", "API key updated successfully!")
         else:
             self.api_key = ""
-            self.client = None
+            self.engine.setup_api_client(self.api_key, self.api_backend)
             self.add_debug_log("API key cleared", "SYSTEM")
             messagebox.showwarning("API Key Error", "API key cannot be empty. Please enter a valid key.")
 
+    def setup_file_history(self):
+        # Use a persistent per-project history store when enabled, otherwise keep history in memory
+        if self.persistent_history and self.current_folder:
+            if self.history_folder == self.current_folder:
+                return
+            db_path = SQLiteVersionStore.path_for_folder(self.current_folder)
+            try:
+                store = SQLiteVersionStore(db_path)
+            except (sqlite3.Error, OSError) as e:
+                self.log_error(f"Could not open history database: {str(e)}", f"Database: {db_path}")
+                return
+            self.add_debug_log(f"Persistent history: {db_path}", "SYSTEM")
+            self.history_folder = self.current_folder
+        elif isinstance(self.file_history, SQLiteVersionStore):
+            store = FileVersionStore(max_versions=20)
+            self.history_folder = None
+            self.add_debug_log("File history kept in memory for this session", "SYSTEM")
+        else:
+            return
+        
+        self.file_history.close()
+        self.file_history = store
+        self.current_history_index.clear()
+    
     def add_file_version(self, file_path, content, description="Manual edit"):
         # Add a new version of a file to its history
         
-        if file_path not in self.file_history:
-            self.file_history[file_path] = []
-            self.current_history_index[file_path] = -1
+        # Large files have no history - a version would only hold the visible lines
+        if self.large_file is not None and file_path == self.current_file:
+            return
         
-        # Add new version
+        # Add new version (the store keeps the last 20 and skips exact repeats of the latest one)
         timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        self.file_history[file_path].append((content, timestamp, description))
+        added = self.file_history.add_version(file_path, content, timestamp, description)
         
         # Update current index
-        self.current_history_index[file_path] = len(self.file_history[file_path]) - 1
-        
-        # Keep only last 20 versions to prevent memory issues
-        if len(self.file_history[file_path]) > 20:
-            self.file_history[file_path] = self.file_history[file_path][-20:]
-            self.current_history_index[file_path] = len(self.file_history[file_path]) - 1
+        self.current_history_index[file_path] = self.file_history.version_count(file_path) - 1
         
         # Log version addition
-        self.add_debug_log(f"File version added: {os.path.basename(file_path)} - {description} ({len(content)} chars)", "SYSTEM")
+        if added:
+            self.add_debug_log(f"File version added: {os.path.basename(file_path)} - {description} ({len(content)} chars, history store: {self.file_history.stored_bytes() / 1024:.1f} KB)", "SYSTEM")
+        else:
+            self.add_debug_log(f"File version unchanged: {os.path.basename(file_path)} - {description} (same as latest version, not stored)", "SYSTEM")
     
     def get_file_history_info(self, file_path):
         # Get information about file history for display
@@ -1314,19 +5938,22 @@ Be conversational, helpful, and provide practical guidance."""
             return []
         
         history_info = []
-        for i, (content, timestamp, description) in enumerate(self.file_history[file_path]):
-            status = "🔄 Current" if i == self.current_history_index[file_path] else "📝 Version"
+        history = self.file_history.get_history(file_path)
+        current_index = self.current_history_index.get(file_path, len(history) - 1)
+        for i, (timestamp, description) in enumerate(history):
+            status = "🔄 Current" if i == current_index else "📝 Version"
             history_info.append(f"{status} {i+1}: {timestamp} - {description}")
         
         return history_info
     
     def revert_to_version(self, file_path, version_index):
         # Revert file to a specific version
-        if file_path not in self.file_history or version_index >= len(self.file_history[file_path]):
+        if version_index >= self.file_history.version_count(file_path):
             return False
         
-        # Get the version content
-        content, timestamp, description = self.file_history[file_path][version_index]
+        # Rebuild the version content from the store
+        content_hash, timestamp, description = self.file_history.get_version(file_path, version_index)
+        content = self.file_history.get_content(file_path, version_index)
         
         # Update the editor
         self.code_editor.delete(1.0, tk.END)
@@ -1340,6 +5967,304 @@ Be conversational, helpful, and provide practical guidance."""
         
         return True
     
+    def get_selected_tree_paths(self):
+        # Paths of the files and folders selected in the file tree
+        paths = []
+        for item in self.file_tree.selection():
+            values = self.file_tree.item(item, 'values')
+            if values and values[0]:
+                paths.append(values[0])
+        return paths
+    
+    def collect_batch_files(self, paths):
+        # Code files for a batch edit; a folder adds every code file below it (runs on a worker thread).
+        # Files above the large-file threshold are left out - they are only edited a window at a time
+        files = []
+        for path in paths:
+            if os.path.isdir(path):
+                files.extend(walk_code_files(path, self.tree_ignore_patterns, self.gitignore_matcher))
+            elif os.path.isfile(path):
+                files.append(path)
+        threshold = self.large_file_threshold_mb * 1024 * 1024
+        large = [path for path in files if os.path.getsize(path) > threshold]
+        if large:
+            self.add_debug_log(f"Batch edit skips {len(large)} file(s) above the large-file threshold: "
+                               f"{', '.join(os.path.basename(path) for path in large[:5])}", "WARNING")
+        large = set(large)
+        return [path for path in dict.fromkeys(files) if path not in large]
+    
+    def show_batch_edit(self):
+        # Dialog to run one edit prompt over the files selected in the tree and review the results.
+        # Selected folders are walked on a worker thread; the dialog opens when the file list is ready
+        if self.batch_job and self.batch_job['window'].winfo_exists():
+            self.batch_job['window'].lift()
+            return
+        if not self.api_key:
+            messagebox.showerror("Error", "Please enter your OpenAI API key")
+            return
+        paths = self.get_selected_tree_paths()
+        if not paths:
+            messagebox.showwarning("Warning", "Select files or folders in the file tree first (Ctrl/Shift-click for several)")
+            return
+        if self.batch_collecting:
+            return
+        self.batch_collecting = True
+        self.status_var.set("Collecting files for the batch edit...")
+        
+        def collect():
+            try:
+                files = self.collect_batch_files(paths)
+            except OSError as e:
+                self.add_debug_log(f"⚠️ Could not list files for the batch edit: {str(e)}", "WARNING")
+                files = []
+            self.message_queue.put(('batch_files', files))
+        
+        threading.Thread(target=collect, daemon=True).start()
+    
+    def on_batch_files_collected(self, files):
+        # The selected folders have been walked - open the batch edit dialog
+        self.batch_collecting = False
+        self.status_var.set("Ready")
+        if not files:
+            messagebox.showwarning("Warning", "No code files in the selected folders")
+            return
+        
+        batch_window = tk.Toplevel(self.root)
+        batch_window.title(f"Batch Edit - {len(files)} files")
+        batch_window.geometry("900x700")
+        batch_window.transient(self.root)
+        
+        main_frame = ttk.Frame(batch_window)
+        main_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
+        
+        # Prompt
+        ttk.Label(main_frame, text=f"Edit prompt for {len(files)} files:", font=('Arial', 10, 'bold')).pack(anchor=tk.W)
+        prompt_text = scrolledtext.ScrolledText(main_frame, height=4, wrap=tk.WORD)
+        prompt_text.pack(fill=tk.X, pady=(5, 10))
+        
+        # Results list
+        results_frame = ttk.LabelFrame(main_frame, text="Results")
+        results_frame.pack(fill=tk.BOTH, expand=True)
+        results_tree = ttk.Treeview(results_frame, columns=("status", "tokens", "time"), height=10)
+        results_tree.heading("#0", text="File")
+        results_tree.heading("status", text="Status")
+        results_tree.heading("tokens", text="Tokens")
+        results_tree.heading("time", text="Time")
+        results_tree.column("#0", width=420)
+        results_tree.column("status", width=180)
+        results_tree.column("tokens", width=90, anchor=tk.E)
+        results_tree.column("time", width=80, anchor=tk.E)
+        results_tree.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+        
+        # Diff of the selected result
+        diff_view = scrolledtext.ScrolledText(main_frame, height=14, wrap=tk.NONE, font=('Consolas', 9), state=tk.DISABLED)
+        diff_view.pack(fill=tk.BOTH, expand=True, pady=(10, 0))
+        diff_view.tag_config("added", foreground='dark green')
+        diff_view.tag_config("removed", foreground='red')
+        diff_view.tag_config("hunk", foreground='blue')
+        
+        summary_var = tk.StringVar(value=f"{len(files)} files selected")
+        ttk.Label(main_frame, textvariable=summary_var, foreground='gray').pack(anchor=tk.W, pady=(5, 0))
+        
+        results = {}
+        for path in files:
+            label = os.path.relpath(path, self.current_folder) if self.current_folder else path
+            item = results_tree.insert("", tk.END, text=label, values=("Waiting", "", ""))
+            results[path] = {"item": item, "status": "waiting"}
+        
+        self.batch_job = {
+            "id": (self.batch_job or {}).get("id", 0) + 1,
+            "window": batch_window,
+            "files": files,
+            "results": results,
+            "results_tree": results_tree,
+            "summary_var": summary_var,
+            "running": False
+        }
+        job = self.batch_job
+        
+        def selected_paths():
+            items = set(results_tree.selection())
+            return [path for path, result in results.items() if result["item"] in items]
+        
+        def show_diff(event=None):
+            paths = selected_paths()
+            diff_view.config(state=tk.NORMAL)
+            diff_view.delete(1.0, tk.END)
+            if paths:
+                result = results[paths[0]]
+                if result.get("error"):
+                    diff_view.insert(tk.END, f"Failed: {result['error']}")
+                for line in result.get("diff", []):
+                    tag = "hunk" if line.startswith('@@') else "added" if line.startswith('+') else "removed" if line.startswith('-') else ""
+                    diff_view.insert(tk.END, line + "\n", tag)
+            diff_view.config(state=tk.DISABLED)
+        
+        def run_batch():
+            prompt = prompt_text.get(1.0, tk.END).strip()
+            if not prompt:
+                messagebox.showwarning("Warning", "Please enter a prompt", parent=batch_window)
+                return
+            if job["running"]:
+                return
+            pending = [path for path, result in results.items() if result["status"] in ("waiting", "failed", "stopped")]
+            if not pending:
+                return
+            job["running"] = True
+            job["settings"] = self.snapshot_settings()
+            job["start_time"] = time.time()
+            job["totals"] = {"done": 0, "failed": 0, "stopped": 0, "tokens": 0, "count": len(pending)}
+            for path in pending:
+                results[path].update(status="queued", error=None)
+                results_tree.item(results[path]["item"], values=("Queued", "", ""))
+            self.add_debug_log(f"Batch edit started: {len(pending)} files, {self.parallel_edit_workers} workers - {prompt[:80]}", "INFO")
+            
+            # Background priority - the scheduler keeps a worker free for edits and chat in the meantime
+            for path in pending:
+                self.request_scheduler.submit('batch', None, job["settings"], self.run_batch_edit,
+                                              job["id"], prompt, path, priority=PRIORITY_BACKGROUND)
+        
+        def accept(paths):
+            for path in paths:
+                self.accept_batch_result(path)
+            show_diff()
+        
+        def reject(paths):
+            for path in paths:
+                result = results[path]
+                if result["status"] == "ready":
+                    result["status"] = "rejected"
+                    results_tree.item(result["item"], values=("Rejected",) + tuple(results_tree.item(result["item"], 'values'))[1:])
+        
+        def close():
+            self.request_scheduler.cancel('batch')
+            batch_window.destroy()
+        
+        results_tree.bind('<<TreeviewSelect>>', show_diff)
+        
+        button_frame = ttk.Frame(main_frame)
+        button_frame.pack(pady=(10, 0))
+        ttk.Button(button_frame, text="Run", command=run_batch).pack(side=tk.LEFT, padx=(0, 10))
+        ttk.Button(button_frame, text="Stop", command=lambda: self.request_scheduler.cancel('batch')).pack(side=tk.LEFT, padx=(0, 10))
+        ttk.Button(button_frame, text="Accept Selected", command=lambda: accept(selected_paths())).pack(side=tk.LEFT, padx=(0, 10))
+        ttk.Button(button_frame, text="Accept All",
+                  command=lambda: accept([p for p, r in results.items() if r["status"] == "ready"])).pack(side=tk.LEFT, padx=(0, 10))
+        ttk.Button(button_frame, text="Reject Selected", command=lambda: reject(selected_paths())).pack(side=tk.LEFT, padx=(0, 10))
+        ttk.Button(button_frame, text="Close", command=close).pack(side=tk.LEFT)
+        batch_window.protocol("WM_DELETE_WINDOW", close)
+    
+    def run_batch_edit(self, request, job_id, prompt, file_path):
+        # Edit one file of a batch job on a scheduler worker and report the outcome to the UI thread
+        try:
+            request.check_cancelled()
+            self.message_queue.put(('batch_file_started', (job_id, file_path)))
+            result = self.engine.edit_file(request, prompt, file_path)
+        except RequestCancelled:
+            result = {"status": "stopped"}
+        except Exception as e:
+            result = {"status": "failed", "error": str(e)}
+        self.message_queue.put(('batch_file_done', (job_id, file_path, result)))
+    
+    def on_batch_file_started(self, job_id, file_path):
+        job = self.batch_job
+        if job and job["id"] == job_id and job["window"].winfo_exists():
+            result = job["results"][file_path]
+            result["status"] = "running"
+            job["results_tree"].item(result["item"], values=("Running...", "", ""))
+    
+    def on_batch_file_done(self, job_id, file_path, outcome):
+        # Record one finished file of the batch job and update the throughput summary
+        job = self.batch_job
+        if not job or job["id"] != job_id:
+            return
+        result = job["results"][file_path]
+        result.update(outcome)
+        totals = job["totals"]
+        tokens = outcome.get("tokens", 0)
+        if tokens:
+            totals["tokens"] += tokens
+            self.update_token_usage(tokens, job["settings"].model)
+        name = os.path.basename(file_path)
+        if outcome["status"] == "failed":
+            totals["failed"] += 1
+            self.add_debug_log(f"⚠️ Batch edit failed for {name}: {outcome.get('error')}", "WARNING")
+        elif outcome["status"] == "stopped":
+            totals["stopped"] += 1
+        else:
+            totals["done"] += 1
+            self.add_debug_log(f"Batch edit {name}: {outcome['status']} in {outcome['seconds']:.2f}s, {tokens:,} tokens ({outcome['protocol']})", "RESPONSE")
+        
+        if job["window"].winfo_exists():
+            changed = sum(1 for line in outcome.get('diff', [])[2:] if line[:1] in '+-')
+            status = {"ready": f"Ready ({changed} lines changed)",
+                      "unchanged": "No changes", "failed": "Failed", "stopped": "Stopped"}[outcome["status"]]
+            job["results_tree"].item(result["item"], values=(
+                status, f"{tokens:,}" if tokens else "", f"{outcome['seconds']:.1f}s" if 'seconds' in outcome else ""))
+            job["summary_var"].set(self.format_batch_summary(job))
+        if totals["done"] + totals["failed"] + totals["stopped"] == totals["count"]:
+            self.on_batch_done(job_id)
+    
+    def on_batch_done(self, job_id):
+        job = self.batch_job
+        if not job or job["id"] != job_id:
+            return
+        job["running"] = False
+        summary = self.format_batch_summary(job)
+        self.add_debug_log(f"Batch edit finished: {summary}", "INFO")
+        self.status_var.set(f"Batch edit finished: {summary}")
+        if job["window"].winfo_exists():
+            job["summary_var"].set(summary + " - review the diffs and accept the changes you want")
+    
+    def format_batch_summary(self, job):
+        totals = job["totals"]
+        elapsed = max(0.001, time.time() - job["start_time"])
+        finished = totals["done"] + totals["failed"]
+        return (f"{finished}/{totals['count']} files, {totals['failed']} failed, {totals['tokens']:,} tokens, "
+                f"{elapsed:.1f}s ({finished / elapsed * 60:.1f} files/min)")
+    
+    def accept_batch_result(self, file_path):
+        # Write an accepted batch edit to disk, keeping both versions in the file history
+        job = self.batch_job
+        result = job["results"][file_path]
+        if result["status"] != "ready":
+            return
+        try:
+            with open(file_path, 'r', encoding='utf-8') as f:
+                on_disk = f.read()
+            if on_disk != result["original"]:
+                messagebox.showwarning("File Changed", f"{os.path.basename(file_path)} changed since the batch edit ran - run it again for this file",
+                                       parent=job["window"])
+                result["status"] = "failed"
+                result["error"] = "File changed on disk after the edit was made"
+                job["results_tree"].item(result["item"], values=("Changed on disk",) + tuple(job["results_tree"].item(result["item"], 'values'))[1:])
+                return
+            with open(file_path, 'w', encoding='utf-8') as f:
+                f.write(result["edited"])
+        except Exception as e:
+            self.log_error(f"Could not save batch edit: {str(e)}", f"File: {file_path}")
+            return
+        
+        # Keep anything typed in the editor since the file was opened before replacing it
+        if file_path == self.current_file:
+            unsaved = self.code_editor.get(1.0, 'end-1c')
+            if unsaved != result["original"]:
+                self.add_file_version(file_path, unsaved, "Before batch edit (unsaved)")
+                self.add_debug_log(f"Unsaved changes to {os.path.basename(file_path)} were kept in the file history", "WARNING")
+        
+        self.add_file_version(file_path, result["original"], "Before batch edit")
+        self.add_file_version(file_path, result["edited"], "Batch edit")
+        if file_path == self.current_file:
+            self.code_editor.delete(1.0, tk.END)
+            self.code_editor.insert(1.0, result["edited"])
+            self.current_file_stat = self.tree_watcher.get_file_stat(file_path)
+            self.tree_watcher.watch_file(file_path)
+        self.project_indexer.refresh()
+        
+        result["status"] = "accepted"
+        values = tuple(job["results_tree"].item(result["item"], 'values'))
+        job["results_tree"].item(result["item"], values=("Accepted ✓",) + values[1:])
+        self.add_debug_log(f"Batch edit accepted: {os.path.basename(file_path)}", "SYSTEM")
+    
     def show_file_history(self):
         # Show file history dialog for reverting
         if not self.current_file:
@@ -1380,9 +6305,10 @@ Be conversational, helpful, and provide practical guidance."""
             history_listbox.insert(tk.END, info)
         
         # Select current version
-        current_index = self.current_history_index.get(file_path, -1)
+        current_index = self.current_history_index.get(file_path, len(history_info) - 1)
         if current_index >= 0:
             history_listbox.selection_set(current_index)
+            history_listbox.see(current_index)
         
         # Buttons
         button_frame = ttk.Frame(main_frame)
@@ -1434,6 +6360,20 @@ Be conversational, helpful, and provide practical guidance."""
         # Allow Shift+Enter for new lines in the chat input area
         return None  # Allow default newline behavior
 
+    def show_tree_context_menu(self, event):
+        # Context menu for the file tree
+        item = self.file_tree.identify_row(event.y)
+        if item and item not in self.file_tree.selection():
+            self.file_tree.selection_set(item)
+        menu = tk.Menu(self.root, tearoff=0)
+        menu.add_command(label=f"Batch Edit Selected ({len(self.file_tree.selection())} items)...", command=self.show_batch_edit)
+        menu.add_command(label="Refresh", command=self.refresh_file_tree)
+        
+        try:
+            menu.tk_popup(event.x_root, event.y_root)
+        finally:
+            menu.grab_release()
+    
     def show_status_context_menu(self, event):
         # Show a context menu for the status bar
         menu = tk.Menu(self.root, tearoff=0)
@@ -1454,10 +6394,180 @@ Be conversational, helpful, and provide practical guidance."""
         finally:
             menu.grab_release()
 
-def main():
+# Command line: file patterns are expanded relative to the working directory, and directories are
+# walked with the same filters as the file tree
+CLI_EDIT_PROTOCOLS = ['auto', 'full', 'search_replace', 'chunked', 'parallel']
+
+def load_cli_config(config_file):
+    # Settings saved by the GUI (config.json), or an empty dict if there are none
+    if not config_file or not os.path.exists(config_file):
+        return {}
+    with open(config_file, 'r') as f:
+        return json.load(f)
+
+def expand_cli_paths(patterns, ignore_patterns=(), gitignore=None):
+    # Files named by the command line arguments - plain paths, globs (** included) and directories
+    files = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern, recursive=True)) if glob.has_magic(pattern) else [pattern]
+        for path in matches:
+            if os.path.isdir(path):
+                files.extend(sorted(walk_code_files(path, ignore_patterns, gitignore)))
+            elif os.path.isfile(path):
+                files.append(path)
+    # Keep the first occurrence of each file
+    seen = set()
+    return [path for path in files if not (os.path.abspath(path) in seen or seen.add(os.path.abspath(path)))]
+
+def cli_settings(config, args):
+    # Request settings from the saved configuration, overridden by command line options
+    model_name = args.model or config.get('model', 'gpt-4')
+    if model_name.startswith('gpt-5'):
+        max_tokens = config.get('max_completion_tokens', 4000)
+    else:
+        max_tokens = config.get('max_tokens', 4000)
+    return RequestSettings(
+        model=model_name,
+        temperature=config.get('temperature', 1.0),
+        max_tokens=max_tokens,
+        auto_max_tokens=config.get('auto_max_tokens', True),
+        stream=config.get('stream_responses', True),
+        cache_policy=config.get('response_cache_policy', 'all'),
+        edit_protocol=args.protocol or config.get('edit_protocol', 'auto'),
+        parallel_workers=args.workers or config.get('parallel_edit_workers', 4),
+        project_folder=os.getcwd()
+    )
+
+def cli_log(message, level="INFO"):
+    # Debug log of the command line: warnings and errors go to stderr, the rest only with --verbose
+    if level in ("WARNING", "ERROR") or cli_log.verbose:
+        print(f"[{level}] {truncate_log_message(message)}", file=sys.stderr)
+cli_log.verbose = False
+
+def run_cli_edit(args):
+    # Edit files without the GUI: print the diffs (or write the files with --write) and a summary
+    if args.json == '-' and not args.write:
+        print("--json - needs --write: without it the diffs are printed to stdout", file=sys.stderr)
+        return 2
+    config = load_cli_config(args.config)
+    cli_log.verbose = args.verbose
+    api_key = config.get('api_key') or os.environ.get('OPENAI_API_KEY', '')
+    if not api_key:
+        print("No API key - set api_key in config.json or the OPENAI_API_KEY environment variable", file=sys.stderr)
+        return 2
+    
+    gitignore = GitIgnoreMatcher(os.getcwd()) if config.get('use_gitignore', True) else None
+    files = expand_cli_paths(args.paths, config.get('tree_ignore_patterns', DEFAULT_TREE_IGNORE_PATTERNS), gitignore)
+    if not files:
+        print("No files match the given paths", file=sys.stderr)
+        return 2
+    
+    settings = cli_settings(config, args)
+    engine = EditEngine(api_key, 'threads', config.get('rate_limits', {}), config.get('token_calibration', {}),
+                        dict(DEFAULT_MODEL_PRICING, **config.get('model_pricing', {})), cli_log)
+    
+    def edit_one(file_path):
+        request = ScheduledRequest('cli', None, PRIORITY_BACKGROUND, settings, None, ())
+        request.started_at = time.time()
+        try:
+            return engine.edit_file(request, args.prompt, file_path)
+        except Exception as e:
+            return {"status": "failed", "error": describe_api_error(e)}
+    
+    start_time = time.time()
+    print(f"Editing {len(files)} files with {settings.model} ({settings.parallel_workers} workers)", file=sys.stderr)
+    summary_files = []
+    with ThreadPoolExecutor(max_workers=max(1, settings.parallel_workers)) as executor:
+        futures = {executor.submit(edit_one, path): path for path in files}
+        results = {}
+        for future in as_completed(futures):
+            file_path = futures[future]
+            result = results[file_path] = future.result()
+            if result["status"] == "failed":
+                print(f"{file_path}: failed - {result['error']}", file=sys.stderr)
+            else:
+                print(f"{file_path}: {result['status']} in {result['seconds']:.1f}s, "
+                      f"{result['tokens']:,} tokens ({result['protocol']})", file=sys.stderr)
+    
+    # Output in the order the files were given
+    for file_path in files:
+        result = results[file_path]
+        if result["status"] == "ready":
+            if args.write:
+                # A file that can't be written fails on its own; the others are still written
+                try:
+                    with open(file_path, 'r', encoding='utf-8') as f:
+                        on_disk = f.read()
+                    if on_disk != result["original"]:
+                        result.update(status="failed", error="File changed on disk after the edit was made")
+                    else:
+                        with open(file_path, 'w', encoding='utf-8') as f:
+                            f.write(result["edited"])
+                        result["status"] = "written"
+                except OSError as e:
+                    result.update(status="failed", error=str(e))
+                if result["status"] == "failed":
+                    print(f"{file_path}: not written - {result['error']}", file=sys.stderr)
+            else:
+                for line in result["diff"]:
+                    print(line)
+        summary_files.append({"path": file_path, "status": result["status"], "error": result.get("error"),
+                              "tokens": result.get("tokens", 0), "seconds": round(result.get("seconds", 0.0), 3),
+                              "protocol": result.get("protocol")})
+    
+    failed = sum(1 for entry in summary_files if entry["status"] == "failed")
+    summary = {
+        "model": settings.model,
+        "files": summary_files,
+        "failed": failed,
+        "tokens": sum(entry["tokens"] for entry in summary_files),
+        "seconds": round(time.time() - start_time, 3),
+        "estimated_cost": round(engine.calculate_estimated_cost(), 6),
+        "latency": engine.request_metrics.summary_by_model()
+    }
+    print(f"{len(files) - failed}/{len(files)} files edited, {summary['tokens']:,} tokens, "
+          f"${summary['estimated_cost']:.4f}, {summary['seconds']:.1f}s", file=sys.stderr)
+    if args.json:
+        if args.json == '-':
+            json.dump(summary, sys.stdout, indent=2)
+            print()
+        else:
+            with open(args.json, 'w') as f:
+                json.dump(summary, f, indent=2)
+    return 1 if failed else 0
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(prog="code_editor.py",
+                                     description="AI Code Editor - run without a command to open the editor")
+    parser.add_argument("--profile-startup", action="store_true",
+                        help="Print the time spent in each startup phase of the editor to stderr")
+    subparsers = parser.add_subparsers(dest="command")
+    edit_parser = subparsers.add_parser("edit", help="Edit files with a prompt, without the GUI")
+    edit_parser.add_argument("prompt", help="What to change in each file")
+    edit_parser.add_argument("paths", nargs="+", help="Files, directories or glob patterns (quote ** patterns)")
+    edit_parser.add_argument("--write", action="store_true", help="Write the edits to the files instead of printing diffs")
+    edit_parser.add_argument("--workers", type=int, help="Files edited at the same time (default: parallel_edit_workers)")
+    edit_parser.add_argument("--model", help="Model to use (default: the model in config.json)")
+    edit_parser.add_argument("--protocol", choices=CLI_EDIT_PROTOCOLS, help="Edit protocol (default: edit_protocol)")
+    edit_parser.add_argument("--config", default="config.json", help="Settings file (default: config.json)")
+    edit_parser.add_argument("--json", metavar="PATH", help="Write a JSON summary to PATH ('-' for stdout, with --write)")
+    edit_parser.add_argument("--verbose", action="store_true", help="Print the debug log to stderr")
+    return parser
+
+def main(argv=None):
+    args = build_arg_parser().parse_args(sys.argv[1:] if argv is None else argv)
+    if args.command == "edit":
+        return run_cli_edit(args)
+    
+    profiler = StartupProfiler(args.profile_startup)
+    profiler.mark("import modules")
+    import_tkinter()
+    profiler.mark("import tkinter")
     root = tk.Tk()
-    app = CodeEditor(root)
+    profiler.mark("create window")
+    app = CodeEditor(root, profiler)
     root.mainloop()
+    return 0
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())